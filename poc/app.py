@@ -1,27 +1,59 @@
-import os, json, datetime
+import os, json, datetime, asyncio
+from typing import Optional
 from dotenv import load_dotenv
 # from poc.db.init_database import init_db
 from poc.graph.dag_builder import build_graph
 from poc.audit.log_manager import save_run
 from poc.audit.replay import replay
+from poc.db.config import settings
+from poc.utils.deadline import Deadline
 
 
 load_dotenv()
 
-def run_pipeline(nl_query: str):
+_ASYNC_GRAPH = None
+
+def _initial_state(nl_query: str, timeout_s: Optional[float], approximate: bool = False) -> dict:
+    # 请求级 deadline：从这里开始计时，覆盖意图解析与执行
+    timeout_s = settings.REQUEST_TIMEOUT_S if timeout_s is None else timeout_s
+    return {"user_input": nl_query, "deadline_at": Deadline.after(timeout_s).expires_at, "approximate": approximate}
+
+def run_pipeline(nl_query: str, timeout_s: Optional[float] = None, approximate: bool = False):
+    """
+    :param timeout_s: 请求级超时（秒），默认 settings.REQUEST_TIMEOUT_S；0 表示不限时
+    :param approximate: 近似模式：读抽样表 feasibility_sample，返回估计值与置信区间（默认精确）
+    """
     graph = build_graph()
-    result = graph.invoke({"user_input": nl_query})
+    result = graph.invoke(_initial_state(nl_query, timeout_s, approximate))
+    return _save_result(result)
+
+async def run_pipeline_async(nl_query: str, timeout_s: Optional[float] = None, approximate: bool = False):
+    """
+    run_pipeline 的异步版本：LLM 与数据库往返均不阻塞事件循环，
+    同一进程可在一个事件循环中并发处理大量问题
+    """
+    global _ASYNC_GRAPH
+    if _ASYNC_GRAPH is None:
+        _ASYNC_GRAPH = build_graph(async_mode=True)
+    result = await _ASYNC_GRAPH.ainvoke(_initial_state(nl_query, timeout_s, approximate))
+    return await asyncio.to_thread(_save_result, result)
+
+def _save_result(result: dict):
     # 组织审计 JSON
-    ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    # 并发运行时同一秒内会有多个 run，追加微秒避免 run_id 冲突
+    ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
     run_id = f"RUN_{ts}"
     run_obj = {
         "run_id": run_id,
         "timestamp": datetime.datetime.utcnow().isoformat(),
         "omop_version": os.getenv("OMOP_VERSION", "OMOP1"),
         "intent": result.get("intent"),
+        "intent_meta": result.get("intent_meta"),
         "plan": result.get("plan"),
         "execution_dag": result.get("execution_dag"),
         "summary": result.get("summary"),
+        "timed_out": result.get("timed_out", False),
+        "approximate": result.get("approximate", False),
         "env": {
             "llm_mode": os.getenv("LLM_MODE", "local"),
             "llm_model": os.getenv("LLM_MODEL", ""),
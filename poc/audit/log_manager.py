@@ -1,9 +1,11 @@
-import os, json, datetime
+import os, json, datetime, uuid
+from typing import Iterable, List, Dict, Any, Optional
 from dotenv import load_dotenv
 load_dotenv()
 
 RUNS_DIR = os.path.join(os.getcwd(), "poc", "runs") if os.getcwd().endswith("poc") else os.path.join(os.getcwd(), "runs")
 os.makedirs(RUNS_DIR, exist_ok=True)
+RESULTS_DIR = os.path.join(RUNS_DIR, "results")
 
 def save_run(run_obj: dict) -> str:
     filename = f"{run_obj['run_id']}.json"
@@ -12,7 +14,71 @@ def save_run(run_obj: dict) -> str:
         json.dump(run_obj, f, ensure_ascii=False, indent=2)
     return run_obj["run_id"], path
 
+def save_batch(batch_obj: dict) -> str:
+    """批量运行的汇总审计（一个文件记录整批问题）"""
+    filename = f"{batch_obj['batch_id']}.json"
+    path = os.path.join(RUNS_DIR, filename)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(batch_obj, f, ensure_ascii=False, indent=2, default=str)
+    return batch_obj["batch_id"], path
+
 def load_run(run_id: str) -> dict:
     path = os.path.join(RUNS_DIR, f"{run_id}.json")
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
+
+class ResultBatchWriter:
+    """
+    逐批消费查询结果，不在内存中物化完整结果集（同步 / 异步执行路径共用）
+    - 前 inline_rows 行内联到审计记录（rows）
+    - spill=True 时，完整结果逐批追加写入 runs/results/<id>.jsonl
+    """
+
+    def __init__(self, inline_rows: int, spill: bool = False):
+        self.inline_rows = inline_rows
+        self.preview: List[Dict[str, Any]] = []
+        self.row_count = 0
+        self.spill_path: Optional[str] = None
+        self._f = None
+        if spill:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            self.spill_path = os.path.join(RESULTS_DIR, f"RESULT_{uuid.uuid4().hex}.jsonl")
+            self._f = open(self.spill_path, "w", encoding="utf-8")
+
+    def add(self, batch: List[Dict[str, Any]]):
+        if len(self.preview) < self.inline_rows:
+            self.preview.extend(batch[: self.inline_rows - len(self.preview)])
+        self.row_count += len(batch)
+        if self._f is not None:
+            for row in batch:
+                self._f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+    def close(self) -> Dict[str, Any]:
+        """
+        Returns:
+            {"rows": 内联行, "row_count": 总行数, "truncated": 是否截断, "spill_path": 文件路径或 None}
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        return {
+            "rows": self.preview,
+            "row_count": self.row_count,
+            "truncated": self.row_count > len(self.preview),
+            "spill_path": self.spill_path,
+        }
+
+
+def write_result_batches(
+    batches: Iterable[List[Dict[str, Any]]],
+    inline_rows: int,
+    spill: bool = False,
+) -> Dict[str, Any]:
+    """同步消费结果批次，返回值见 ResultBatchWriter.close()"""
+    writer = ResultBatchWriter(inline_rows, spill)
+    try:
+        for batch in batches:
+            writer.add(batch)
+    finally:
+        collected = writer.close()
+    return collected
@@ -1,6 +1,36 @@
 from .log_manager import load_run
 from poc.execution.executor import run_sql
-from poc.utils.sqlglot_utils import is_read_only
+from poc.db.parquet_extract import get_parquet_extract
+from poc.utils.sqlglot_utils import analyze_sql
+
+def _find_upstream_sql(steps, step):
+    """
+    沿 depends_on 向上查找生成该步骤 SQL 的 generate_sql 步骤（旧审计没有 depends_on 时取最后一个）
+    Returns:
+        (sql, params, source)；旧审计没有 params（SQL 内联字面量）时 params 为 {}，没有 source 时为 {}
+    """
+    by_id = {s["step_id"]: s for s in steps}
+    if "depends_on" not in step:
+        found = (None, {}, {})
+        for prev in steps:
+            if prev.get("action") == "generate_sql":
+                outputs = prev.get("outputs", {})
+                found = (outputs.get("sql"), outputs.get("params") or {}, outputs.get("source") or {})
+        return found
+
+    frontier = list(step.get("depends_on", []))
+    seen = set()
+    while frontier:
+        sid = frontier.pop(0)
+        if sid in seen or sid not in by_id:
+            continue
+        seen.add(sid)
+        prev = by_id[sid]
+        if prev.get("action") == "generate_sql":
+            outputs = prev.get("outputs", {})
+            return outputs.get("sql"), outputs.get("params") or {}, outputs.get("source") or {}
+        frontier.extend(prev.get("depends_on", []))
+    return None, {}, {}
 
 def replay(run_id: str):
     run = load_run(run_id)
@@ -8,22 +38,23 @@ def replay(run_id: str):
     re_results = []
     for s in steps:
         action = s.get("action")
-        if action in ("run_dry_run", "summarize_result", "resolve_concepts", "generate_sql"):
+        if action in ("run_dry_run", "summarize_result", "resolve_concepts", "generate_sql", "create_snapshot"):
             # 这些为只读或推理步骤；可选择性重建，但此处演示只复核 SQL/dry-run 关键结果
             re_results.append({"step_id": s["step_id"], "action": action, "status": "skipped"})
         elif action == "run_sql":
-            sql = None
-            # 在 generate_sql 的输出里找 sql（简易做法）
-            for prev in steps:
-                if prev.get("action") == "generate_sql":
-                    sql = prev.get("outputs", {}).get("sql")
+            # 在上游 generate_sql 的输出里找 sql
+            sql, params, source = _find_upstream_sql(steps, s)
             if not sql:
                 re_results.append({"step_id": s["step_id"], "action": action, "status": "error", "error": "no sql"})
                 continue
-            if not is_read_only(sql):
+            if not analyze_sql(sql).read_only:
                 re_results.append({"step_id": s["step_id"], "action": action, "status": "blocked"})
                 continue
-            res = run_sql(sql)
+            # Parquet 抽取上生成的 SQL（DuckDB 方言）在抽取上重放
+            if source.get("path") == "extract":
+                res = get_parquet_extract().run(sql, params)
+            else:
+                res = run_sql(sql, params)
             re_results.append({"step_id": s["step_id"], "action": action, "status": "replayed", "result": res})
         else:
             re_results.append({"step_id": s["step_id"], "action": action, "status": "unknown"})
@@ -0,0 +1,276 @@
+"""
+批量可行性扫描：一次运行成百上千个自然语言问题
+
+- LLM 解析与数据库执行分别限流（两个独立的并发上限）
+- 多个问题打包成一次 LLM 请求解析（parse_intents，每批 INTENT_BATCH_SIZE 个），审计记录平摊到每个问题的 token
+- SQL 阶段之前按规范化 intent 去重，相同 intent 只执行一次
+- 整批写入一个审计文件（runs/BATCH_*.json），附吞吐量与各阶段延迟分位数
+
+用法:
+    python -m poc.batch questions.txt --llm-concurrency 8 --db-concurrency 4 --intent-batch-size 10
+    （questions.txt 每行一个问题；也支持 .jsonl，每行 {"question": "..."}）
+"""
+import os, json, math, time, asyncio, argparse, datetime
+from typing import Iterable, List, Dict, Any, Optional, Union
+
+from poc.intent.parser import parse_intents_async
+from poc.intent.schema import FeasibilityIntent, ParseContext
+from poc.plan.builder import build_plan
+from poc.execution.executor import execute_plan_steps_async
+from poc.graph.dag_builder import _apply_execution
+from poc.audit.log_manager import save_batch
+from poc.db.config import settings
+from poc.utils.deadline import Deadline, deadline_scope
+
+# 去重时忽略的字段：只影响展示，不影响生成的 SQL
+_DEDUP_IGNORED_FIELDS = {"research_question", "rejection_reason"}
+
+
+def load_questions(source: Union[str, Iterable[str]]) -> List[str]:
+    """从文件路径（.txt 每行一个 / .jsonl 每行 {"question": ...}）或字符串迭代器读取问题"""
+    if not isinstance(source, str):
+        return [q.strip() for q in source if q and q.strip()]
+
+    questions = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if source.endswith(".jsonl"):
+                questions.append(json.loads(line)["question"])
+            else:
+                questions.append(line)
+    return questions
+
+
+def intent_key(intent: Dict[str, Any]) -> str:
+    """规范化 intent（去掉展示字段后排序序列化），用于去重"""
+    core = {k: v for k, v in intent.items() if k not in _DEDUP_IGNORED_FIELDS}
+    return json.dumps(core, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _count_sources(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    """意图来源统计：fast_path / cache / llm"""
+    counts: Dict[str, int] = {}
+    for r in results:
+        source = (r.get("intent_meta") or {}).get("source")
+        if source:
+            counts[source] = counts.get(source, 0) + 1
+    return counts
+
+
+def _token_stats(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """LLM token 统计：总量与每个经 LLM 解析的问题的平摊量（含单独重试）"""
+    total, questions = 0.0, 0
+    for r in results:
+        meta = r.get("intent_meta") or {}
+        if meta.get("source") != "llm":
+            continue
+        questions += 1
+        for tokens in ((meta.get("tokens") or {}), ((meta.get("retry") or {}).get("tokens") or {})):
+            total += tokens.get("total_tokens", 0)
+    return {
+        "total": round(total),
+        "llm_questions": questions,
+        "per_question": round(total / questions, 1) if questions else None,
+    }
+
+
+def percentiles(values: List[float], ps=(50, 90, 95, 99)) -> Dict[str, float]:
+    """最近秩法计算分位数（毫秒，保留 1 位小数）"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    out = {}
+    for p in ps:
+        idx = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        out[f"p{p}"] = round(ordered[idx] * 1000, 1)
+    out["max"] = round(ordered[-1] * 1000, 1)
+    out["count"] = len(ordered)
+    return out
+
+
+async def run_batch_async(
+    questions: Union[str, Iterable[str]],
+    llm_concurrency: int = 8,
+    db_concurrency: int = 4,
+    omop_version: Optional[str] = None,
+    timeout_s: Optional[float] = None,
+    intent_batch_size: Optional[int] = None,
+    approximate: bool = False,
+):
+    """
+    批量运行流水线
+    Args:
+        questions: 问题文件路径或问题迭代器
+        llm_concurrency: 同时进行的 LLM 解析请求上限
+        intent_batch_size: 每次 LLM 请求打包的问题数，默认 settings.INTENT_BATCH_SIZE；1 表示逐条解析
+        db_concurrency: 同时执行的 SQL 计划上限
+        timeout_s: 每个阶段（解析 / 执行）的超时秒数，从占用并发槽位开始计时；默认 settings.REQUEST_TIMEOUT_S
+        approximate: 近似模式（读抽样表，返回估计值与置信区间），默认精确
+    Returns:
+        (batch_id, batch_obj)
+    """
+    questions = load_questions(questions)
+    ctx = ParseContext(omop_version=omop_version or os.getenv("OMOP_VERSION", "OMOP1"))
+    llm_sem = asyncio.Semaphore(llm_concurrency)
+    db_sem = asyncio.Semaphore(db_concurrency)
+    latencies: Dict[str, List[float]] = {"intent": [], "execute": [], "total": []}
+    timeout_s = settings.REQUEST_TIMEOUT_S if timeout_s is None else timeout_s
+    intent_batch_size = max(1, intent_batch_size or settings.INTENT_BATCH_SIZE)
+    started = time.perf_counter()
+
+    # -----------------------
+    # 1）并发解析 intent（每 intent_batch_size 个问题一次 LLM 请求）
+    # -----------------------
+    async def _parse(chunk: List[str]) -> List[Dict[str, Any]]:
+        chunk_items = [{"question": q, "intent_meta": {}} for q in chunk]
+        async with llm_sem:
+            # 只统计占用并发槽位后的耗时，不含排队等待
+            t0 = time.perf_counter()
+            try:
+                with deadline_scope(Deadline.after(timeout_s)):
+                    intents = await parse_intents_async(
+                        chunk, ctx, audits=[it["intent_meta"] for it in chunk_items], batch_size=len(chunk)
+                    )
+                for it, intent in zip(chunk_items, intents):
+                    if intent is None:
+                        it["error"] = f"intent: {it['intent_meta'].get('error')}"
+                    else:
+                        it["intent"] = intent.model_dump()
+            except Exception as e:
+                for it in chunk_items:
+                    it["error"] = f"intent: {e}"
+            elapsed = time.perf_counter() - t0
+        for it in chunk_items:
+            it["intent_ms"] = round(elapsed * 1000, 1)
+            latencies["intent"].append(elapsed)
+        return chunk_items
+
+    chunks = [questions[i:i + intent_batch_size] for i in range(0, len(questions), intent_batch_size)]
+    items = [it for chunk_items in await asyncio.gather(*[_parse(c) for c in chunks]) for it in chunk_items]
+
+    # -----------------------
+    # 2）按规范化 intent 去重
+    # -----------------------
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for item in items:
+        intent = item.get("intent")
+        if not intent or not intent.get("is_database_query", True):
+            continue
+        key = intent_key(intent)
+        item["intent_key"] = key
+        groups.setdefault(key, []).append(item)
+
+    # -----------------------
+    # 3）每个唯一 intent 执行一次
+    # -----------------------
+    executions: Dict[str, Dict[str, Any]] = {}
+
+    async def _execute(key: str, intent: Dict[str, Any]):
+        async with db_sem:
+            t0 = time.perf_counter()
+            audit_steps: List[Dict[str, Any]] = []
+            try:
+                plan = [s.model_dump() for s in build_plan(intent=FeasibilityIntent(**intent))]
+                await execute_plan_steps_async(
+                    plan=plan, intent=intent, audit_steps=audit_steps, deadline=Deadline.after(timeout_s),
+                    approximate=approximate,
+                )
+                state = _apply_execution({"plan": plan}, audit_steps)
+                executions[key] = {
+                    "plan": plan,
+                    "execution_dag": audit_steps,
+                    "summary": state.get("summary"),
+                    "timed_out": state.get("timed_out", False),
+                }
+            except Exception as e:
+                executions[key] = {"execution_dag": audit_steps, "error": f"execute: {e}"}
+            elapsed = time.perf_counter() - t0
+        executions[key]["execute_ms"] = round(elapsed * 1000, 1)
+        latencies["execute"].append(elapsed)
+
+    await asyncio.gather(*[_execute(k, members[0]["intent"]) for k, members in groups.items()])
+
+    # -----------------------
+    # 4）汇总审计
+    # -----------------------
+    unique_ids = {key: f"U{i + 1}" for i, key in enumerate(groups)}
+    results = []
+    for item in items:
+        key = item.pop("intent_key", None)
+        if key is not None:
+            execution = executions[key]
+            item["execution_id"] = unique_ids[key]
+            item["summary"] = execution.get("summary")
+            if execution.get("error"):
+                item["error"] = execution["error"]
+            latencies["total"].append((item["intent_ms"] + execution["execute_ms"]) / 1000)
+        elif "error" not in item:
+            item["summary"] = (item.get("intent") or {}).get("rejection_reason") or "not a database query"
+        results.append(item)
+
+    elapsed = time.perf_counter() - started
+    ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
+    batch_obj = {
+        "batch_id": f"BATCH_{ts}",
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "omop_version": ctx.omop_version,
+        "config": {
+            "llm_concurrency": llm_concurrency,
+            "db_concurrency": db_concurrency,
+            "intent_batch_size": intent_batch_size,
+            "timeout_s": timeout_s,
+            "approximate": approximate,
+        },
+        "stats": {
+            "questions": len(questions),
+            "unique_intents": len(groups),
+            "deduplicated": sum(len(m) for m in groups.values()) - len(groups),
+            "intent_sources": _count_sources(results),
+            "llm_tokens": _token_stats(results),
+            "errors": sum(1 for r in results if r.get("error")),
+            "timed_out_executions": sum(1 for e in executions.values() if e.get("timed_out")),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_qps": round(len(questions) / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {stage: percentiles(v) for stage, v in latencies.items()},
+        },
+        "executions": {unique_ids[k]: v for k, v in executions.items()},
+        "results": results,
+    }
+    batch_id, path = save_batch(batch_obj)
+    print(f"✅ Batch saved: {path}")
+    return batch_id, batch_obj
+
+
+def run_batch(
+    questions: Union[str, Iterable[str]],
+    llm_concurrency: int = 8,
+    db_concurrency: int = 4,
+    timeout_s: Optional[float] = None,
+    intent_batch_size: Optional[int] = None,
+    approximate: bool = False,
+):
+    """run_batch_async 的同步入口"""
+    return asyncio.run(run_batch_async(
+        questions, llm_concurrency, db_concurrency, timeout_s=timeout_s, intent_batch_size=intent_batch_size,
+        approximate=approximate,
+    ))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Run the OMOP feasibility pipeline over a question set")
+    ap.add_argument("questions", help="questions file (.txt one per line, or .jsonl with a 'question' key)")
+    ap.add_argument("--llm-concurrency", type=int, default=8)
+    ap.add_argument("--db-concurrency", type=int, default=4)
+    ap.add_argument("--timeout", type=float, default=None, help="per-stage timeout in seconds (0 = unbounded)")
+    ap.add_argument("--intent-batch-size", type=int, default=None, help="questions per LLM request (1 = one by one)")
+    ap.add_argument("--approximate", action="store_true", help="estimate counts from the sample table with confidence intervals")
+    args = ap.parse_args()
+
+    batch_id, batch_obj = run_batch(
+        args.questions, args.llm_concurrency, args.db_concurrency, args.timeout, args.intent_batch_size,
+        args.approximate,
+    )
+    print(json.dumps(batch_obj["stats"], ensure_ascii=False, indent=2))
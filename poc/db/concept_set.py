@@ -0,0 +1,62 @@
+"""
+概念集合表（concept_set_member）
+
+后代很多的概念（如糖尿病的全部子类型，常有上千个）不适合写成 IN (...) 列表：
+SQL 文本过长、解析 / 规划开销随列表线性增长。此时把集合写入数据库中的
+concept_set_member(set_id, concept_id)，查询改为半连接
+    c.condition_concept_id IN (SELECT concept_id FROM concept_set_member WHERE set_id = '...')
+
+set_id 由集合内容哈希得到：同一集合只写入一次，之后所有请求（包括其他进程、审计重放）直接复用；
+查询仍是一条独立的只读语句，dry-run / 结果缓存 / 重放都不需要额外状态。
+"""
+import hashlib
+import threading
+from array import array
+from typing import Iterable, Set
+
+from sqlalchemy import text
+
+from poc.db.database import get_db_manager
+
+CONCEPT_SET_TABLE = "concept_set_member"
+
+_KNOWN: Set[str] = set()
+_LOCK = threading.Lock()
+
+
+def concept_set_id(concept_ids: Iterable[int]) -> str:
+    """集合内容哈希（与顺序、重复无关）"""
+    ids = array("I", sorted(set(concept_ids)))
+    return hashlib.sha256(ids.tobytes()).hexdigest()[:16]
+
+
+def ensure_concept_set(concept_ids: Iterable[int]) -> str:
+    """
+    确保集合已写入 concept_set_member，返回 set_id
+    进程内记住已确认的 set_id，之后的调用不再访问数据库
+    """
+    ids = sorted(set(concept_ids))
+    set_id = concept_set_id(ids)
+    if set_id in _KNOWN:
+        return set_id
+    with _LOCK:
+        if set_id in _KNOWN:
+            return set_id
+        db = get_db_manager()
+        with db.session() as s:
+            s.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {CONCEPT_SET_TABLE} ("
+                "set_id VARCHAR(16) NOT NULL, concept_id INTEGER NOT NULL, "
+                "PRIMARY KEY (set_id, concept_id))"
+            ))
+            exists = s.execute(
+                text(f"SELECT 1 FROM {CONCEPT_SET_TABLE} WHERE set_id = :set_id LIMIT 1"),
+                {"set_id": set_id},
+            ).first()
+            if exists is None:
+                s.execute(
+                    text(f"INSERT INTO {CONCEPT_SET_TABLE} (set_id, concept_id) VALUES (:set_id, :concept_id)"),
+                    [{"set_id": set_id, "concept_id": cid} for cid in ids],
+                )
+        _KNOWN.add(set_id)
+    return set_id
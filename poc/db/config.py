@@ -10,7 +10,112 @@ class Settings:
     # 2. 读取环境变量，如果没有读取到，则使用后面的默认值
     # 这样即使没配置 .env，代码也能跑起来（例如跑个默认的 SQLite 测试）
     DB_URL = os.getenv("DATABASE_URL", "sqlite:///./test_default.db")
-    
+
+    # 3. 连接池配置（进程内按 URL 共享同一个 engine，见 database.get_engine）
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))      # 等待空闲连接的秒数
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))    # 连接回收周期（秒）
+
+    # 单条语句超时（毫秒），0 表示不限制；目前对 PostgreSQL 生效
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+    # SQLAlchemy 日志级别：WARNING（默认，不打印 SQL）/ INFO（打印 SQL）/ DEBUG（连同结果行）
+    DB_LOG_LEVEL = os.getenv("DB_LOG_LEVEL", "WARNING").upper()
+
+    # dry-run 模式：estimate（规划器估算，不可用时回退精确计数）/ count（总是 COUNT(*) 精确计数）
+    DRY_RUN_MODE = os.getenv("DRY_RUN_MODE", "estimate").lower()
+
+    # 风险阈值：估算行数超过 RISK_ROW_THRESHOLD 或代价超过 RISK_COST_THRESHOLD（0 表示不启用）时提升风险
+    RISK_ROW_THRESHOLD = int(os.getenv("RISK_ROW_THRESHOLD", "10000"))
+    RISK_COST_THRESHOLD = float(os.getenv("RISK_COST_THRESHOLD", "0"))
+
+    # 流式结果：每批行数，以及审计记录中最多内联的结果行数
+    RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "1000"))
+    AUDIT_INLINE_ROWS = int(os.getenv("AUDIT_INLINE_ROWS", "100"))
+    # 是否把完整结果逐批写入 runs/results/*.jsonl（审计记录只保存路径）
+    AUDIT_SPILL_RESULTS = os.getenv("AUDIT_SPILL_RESULTS", "false").lower() == "true"
+
+    # 查询结果缓存：内存 LRU 条目数 / TTL（秒，0 = 不过期）/ 磁盘层目录（为空则不启用）
+    RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+    RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+    RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+
+    # 执行 DAG：同步路径并发执行就绪步骤的线程数
+    DAG_MAX_WORKERS = int(os.getenv("DAG_MAX_WORKERS", "4"))
+
+    # 请求级 deadline（秒）：覆盖意图解析与整个执行 DAG，0 表示不限时
+    # 到期时 LLM 请求超时、运行中的 SQL 被取消（审计状态 timeout），其余步骤直接 skipped
+    REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "120"))
+
+    # 意图缓存（parse_intent 之前）：内存 LRU 条目数 / TTL（秒，0 = 不过期）/ 磁盘层目录（为空则只用内存）
+    INTENT_CACHE_ENABLED = os.getenv("INTENT_CACHE_ENABLED", "true").lower() == "true"
+    INTENT_CACHE_MAX_ENTRIES = int(os.getenv("INTENT_CACHE_MAX_ENTRIES", "1024"))
+    INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", "86400"))
+    INTENT_CACHE_DIR = os.getenv("INTENT_CACHE_DIR", ".intent_cache")
+
+    # 确定性解析：固定 temperature=0 与 seed，同一问题的解析结果可复现，缓存条目长期有效
+    LLM_DETERMINISTIC = os.getenv("LLM_DETERMINISTIC", "false").lower() == "true"
+    LLM_SEED = int(os.getenv("LLM_SEED", "42"))
+
+    # LLM 客户端：每个后端的并发上限 / keep-alive 连接保留时间 / 单次请求超时（秒）
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+    LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+    LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", "60"))
+    # 重试：最大重试次数，指数退避基数 / 上限（秒，全抖动）
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+    LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+    # 连续失败 LLM_FAILURE_THRESHOLD 次的后端冷却 LLM_COOLDOWN_S 秒，期间路由到其他后端
+    LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))
+    LLM_COOLDOWN_S = float(os.getenv("LLM_COOLDOWN_S", "30"))
+
+    # 批量解析（parse_intents）：每次 LLM 请求打包的问题数
+    INTENT_BATCH_SIZE = int(os.getenv("INTENT_BATCH_SIZE", "10"))
+
+    # 规则快速路径：简单的 count / trend / distribution 问题不调用 LLM；置信度低于阈值时回退 LLM
+    FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+    FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.8"))
+
+    # 流式解析单条意图：顶层 JSON 对象闭合即停止读取，condition 字段完成即预取概念
+    LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() == "true"
+
+    # OMOP 概念索引（python -m poc.vocab.concept_index build 生成）：目录 / 模糊匹配最低 Dice 系数
+    CONCEPT_INDEX_DIR = os.getenv("CONCEPT_INDEX_DIR", ".concept_index")
+    CONCEPT_FUZZY_MIN_SCORE = float(os.getenv("CONCEPT_FUZZY_MIN_SCORE", "0.6"))
+    # 条件同时匹配全部后代概念（索引中有 concept_ancestor 闭包时）；后代超过 CONCEPT_IN_LIST_MAX 个改用 concept_set_member 半连接
+    CONCEPT_DESCENDANTS_ENABLED = os.getenv("CONCEPT_DESCENDANTS_ENABLED", "true").lower() == "true"
+    CONCEPT_IN_LIST_MAX = int(os.getenv("CONCEPT_IN_LIST_MAX", "500"))
+
+    # 可行性统计立方体（python -m poc.db.feasibility_cube build 构建）：可改写的 count / trend / distribution 直接读立方体
+    FEASIBILITY_CUBE_ENABLED = os.getenv("FEASIBILITY_CUBE_ENABLED", "true").lower() == "true"
+
+    # 人群缓存后端：cohort / compare 任务按 person_id 位图（pyroaring BitMap64）执行；
+    # 内存层位图总大小上限（MB）/ TTL（秒）/ 磁盘目录（为空时只用内存层）/ 磁盘层总大小上限（MB，按最近使用淘汰）
+    COHORT_BACKEND_ENABLED = os.getenv("COHORT_BACKEND_ENABLED", "true").lower() == "true"
+    COHORT_CACHE_MAX_MB = float(os.getenv("COHORT_CACHE_MAX_MB", "256"))
+    COHORT_CACHE_TTL = float(os.getenv("COHORT_CACHE_TTL", "3600"))
+    COHORT_CACHE_DIR = os.getenv("COHORT_CACHE_DIR", ".cohort_cache")
+    COHORT_CACHE_DISK_MAX_MB = float(os.getenv("COHORT_CACHE_DISK_MAX_MB", "512"))
+
+    # 近似模式（按请求选择，默认精确）：抽样表 feasibility_sample 的抽样率（构建时生效）/ 置信区间的置信度
+    APPROX_ENABLED = os.getenv("APPROX_ENABLED", "true").lower() == "true"
+    APPROX_SAMPLE_RATE = float(os.getenv("APPROX_SAMPLE_RATE", "0.05"))
+    APPROX_CONFIDENCE = float(os.getenv("APPROX_CONFIDENCE", "0.95"))
+
+    # Parquet 抽取 + DuckDB（python -m poc.db.parquet_extract build，需要 pip install duckdb）：
+    # 只读可行性查询改在抽取上执行；目录 / 每批抽取行数 / DuckDB 线程数（0 为默认，即 CPU 核数）
+    EXTRACT_ENABLED = os.getenv("EXTRACT_ENABLED", "true").lower() == "true"
+    EXTRACT_DIR = os.getenv("EXTRACT_DIR", ".omop_extract")
+    EXTRACT_BATCH_ROWS = int(os.getenv("EXTRACT_BATCH_ROWS", "500000"))
+    EXTRACT_THREADS = int(os.getenv("EXTRACT_THREADS", "0"))
+
+    # 立方体 / 抽样表 / Parquet 抽取的过期控制：构建后最长使用时间（秒，0 为不限）/
+    # 后台重新计算来源表校验和的间隔（秒，0 为不校验；发现绕过 run_write 的 UPDATE / DELETE 后标记 stale 并重建）
+    PREAGG_MAX_AGE_S = float(os.getenv("PREAGG_MAX_AGE_S", "86400"))
+    PREAGG_VERIFY_INTERVAL_S = float(os.getenv("PREAGG_VERIFY_INTERVAL_S", "300"))
+
     # 你还可以在这里放其他的配置，比如:
     # SECRET_KEY = os.getenv("SECRET_KEY")
     # DEBUG = os.getenv("DEBUG") == "True"
@@ -0,0 +1,378 @@
+"""
+可行性统计立方体（feasibility_cube）
+
+几乎所有问题都是 条件 × 时间 × 性别 × 出生年 上的 count / trend / 性别分布。
+立方体把 condition_occurrence ⋈ person 预先聚合到
+    (condition_concept_id, month_start, gender_concept_id, year_of_birth) -> n
+n 是记录数（与基础表查询的 COUNT(*) 口径一致），可以在任意维度组合上直接 SUM：
+条件（含后代 IN 列表 / concept_set_member 半连接）、按月对齐的时间窗口、性别、出生年范围。
+
+- 构建：python -m poc.db.feasibility_cube build（全量，INSERT ... SELECT ... GROUP BY）
+- 增量刷新：记录已聚合的最大 condition_occurrence_id（高水位）；新追加的记录只聚合增量并追加到立方体
+  （同一格可以有多行，查询时 SUM 合并；全量重建时压实）。每次使用前检查一次高水位，追加写入对查询立即可见
+- 失效：对 condition_occurrence / person 的非追加写入（UPDATE / DELETE / 写 person）把立方体标记为 stale，
+  之后的请求回退到基础表，并在后台全量重建；重建失败时记录日志并指数退避，不会每个请求都触发一次重建
+- 绕过 run_write 的写入（ETL 直接 UPDATE / DELETE）：构建时记录来源表的校验和（行数 + 被聚合列之和），
+  每 PREAGG_VERIFY_INTERVAL_S 秒在后台重新计算一次，不一致即标记 stale；
+  构建超过 PREAGG_MAX_AGE_S 秒的立方体同样视为 stale（兜底校验和覆盖不到的修改，如改日期）
+"""
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from typing import Dict, Any, Optional
+
+from sqlalchemy import text
+
+from poc.db.config import settings
+from poc.db.database import get_db_manager
+from poc.utils.sqlglot_utils import transpile_sql
+
+CUBE_TABLE = "feasibility_cube"
+CUBE_META_TABLE = "feasibility_cube_meta"
+# 立方体的来源表：对它们的写入需要刷新或重建立方体
+SOURCE_TABLES = ("condition_occurrence", "person")
+
+# 立方体不存在时，隔多久再检查一次（秒）；避免每个请求都查询一张不存在的表
+_ABSENT_RECHECK_S = 60
+# 后台重建失败后的重试间隔：从 _ABSENT_RECHECK_S 开始每次失败翻倍，最长 _MAX_BACKOFF_S
+_MAX_BACKOFF_S = 3600
+
+logger = logging.getLogger(__name__)
+
+# 来源表校验和覆盖的列：表 -> (主键, 被聚合 / 抽样的列)
+_CHECKSUM_COLUMNS = {
+    "condition_occurrence": ("condition_occurrence_id", ("person_id", "condition_concept_id")),
+    "person": ("person_id", ("gender_concept_id", "year_of_birth")),
+}
+
+# 聚合 (since, until] 区间内的记录；全量构建时 since = -1
+_AGGREGATE_SQL = f"""
+    INSERT INTO {CUBE_TABLE} (condition_concept_id, month_start, gender_concept_id, year_of_birth, n)
+    SELECT c.condition_concept_id,
+           DATE_TRUNC('month', c.condition_start_date),
+           p.gender_concept_id,
+           p.year_of_birth,
+           COUNT(*)
+    FROM condition_occurrence c
+    JOIN person p ON p.person_id = c.person_id
+    WHERE c.condition_occurrence_id > :since AND c.condition_occurrence_id <= :until
+    GROUP BY c.condition_concept_id, DATE_TRUNC('month', c.condition_start_date), p.gender_concept_id, p.year_of_birth
+"""
+
+_DDL = (
+    f"CREATE TABLE IF NOT EXISTS {CUBE_TABLE} ("
+    "condition_concept_id INTEGER, month_start DATE, gender_concept_id INTEGER, "
+    "year_of_birth INTEGER, n BIGINT NOT NULL)",
+    f"CREATE INDEX IF NOT EXISTS ix_{CUBE_TABLE}_concept ON {CUBE_TABLE} (condition_concept_id, month_start)",
+    f"CREATE TABLE IF NOT EXISTS {CUBE_META_TABLE} ("
+    "meta_key VARCHAR(32) PRIMARY KEY, meta_value VARCHAR(64))",
+)
+
+
+def is_append_only(statement_type: str, tables) -> bool:
+    """只向 condition_occurrence 追加记录的写入可以增量刷新，不需要重建"""
+    return statement_type == "INSERT" and {t.lower() for t in tables} == {"condition_occurrence"}
+
+
+def max_source_id(conn, table: str) -> int:
+    key, _ = _CHECKSUM_COLUMNS[table]
+    return int(conn.execute(text(f"SELECT MAX({key}) FROM {table}")).scalar() or 0)
+
+
+def source_checksum(conn, bounds: Dict[str, int]) -> str:
+    """
+    来源表主键上界以内的行数与各列之和的摘要（bounds: 表 -> 主键上界）
+    上界之后追加的行由增量刷新吸收，不计入；UPDATE / DELETE 会改变摘要
+    """
+    parts = []
+    for table, until in sorted(bounds.items()):
+        key, cols = _CHECKSUM_COLUMNS[table]
+        sums = ", ".join(f"SUM({c})" for c in cols)
+        row = conn.execute(text(f"SELECT COUNT(*), {sums} FROM {table} WHERE {key} <= :until"),
+                           {"until": until}).fetchone()
+        parts.append(f"{table}:" + ",".join(str(v or 0) for v in row))
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+def expired(built_at: Optional[str]) -> bool:
+    """构建时间超过 PREAGG_MAX_AGE_S（0 为不限）"""
+    if not settings.PREAGG_MAX_AGE_S or not built_at:
+        return False
+    age = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(built_at)
+    return age.total_seconds() > settings.PREAGG_MAX_AGE_S
+
+
+class BackgroundMaintenance:
+    """
+    后台重建 / 校验：同一时刻各最多一个线程；重建失败记录日志并指数退避
+    子类实现 build() 与 verify()，并在构建成功后调用 _built()
+    """
+    name = "aggregate"
+
+    def __init__(self):
+        # 只保护下面这些状态，不与构建共用锁：构建期间的请求不会被阻塞
+        self._state_lock = threading.Lock()
+        self._rebuilding = False
+        self._verifying = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._verified_at = 0.0
+        self._threads: Dict[str, threading.Thread] = {}
+
+    def _built(self):
+        with self._state_lock:
+            self._failures = 0
+            self._retry_at = 0.0
+            self._verified_at = time.monotonic()
+
+    def _start(self, kind: str, target):
+        thread = threading.Thread(target=target, name=f"{self.name}-{kind}", daemon=True)
+        self._threads[kind] = thread
+        thread.start()
+
+    def _rebuild_in_background(self):
+        with self._state_lock:
+            if self._rebuilding or time.monotonic() < self._retry_at:
+                return
+            self._rebuilding = True
+
+        def _run():
+            try:
+                self.build(log=lambda *_: None)
+            except Exception:
+                with self._state_lock:
+                    self._failures += 1
+                    delay = min(_ABSENT_RECHECK_S * 2 ** (self._failures - 1), _MAX_BACKOFF_S)
+                    self._retry_at = time.monotonic() + delay
+                logger.exception("%s rebuild failed (attempt %d), retrying in %ds", self.name, self._failures, delay)
+            finally:
+                self._rebuilding = False
+
+        self._start("rebuild", _run)
+
+    def _verify_in_background(self):
+        interval = settings.PREAGG_VERIFY_INTERVAL_S
+        with self._state_lock:
+            if not interval or self._verifying or time.monotonic() - self._verified_at < interval:
+                return
+            self._verifying = True
+
+        def _run():
+            try:
+                if not self.verify():
+                    logger.warning("%s: source tables changed outside run_write, marked stale", self.name)
+            except Exception:
+                logger.exception("%s source checksum failed", self.name)
+            finally:
+                self._verifying = False
+                self._verified_at = time.monotonic()
+
+        self._start("verify", _run)
+
+    def wait(self, timeout: Optional[float] = None):
+        """等待进行中的后台重建 / 校验结束（需要同步结果的调用方与测试使用）"""
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+
+    def _maintenance_stats(self) -> Dict[str, Any]:
+        return {"rebuilding": self._rebuilding, "rebuild_failures": self._failures}
+
+
+class FeasibilityCube(BackgroundMaintenance):
+    """
+    立方体句柄；构建 / 高水位增量刷新 / stale 后台重建的流程由预聚合表的类属性参数化，
+    抽样表（feasibility_sample.py）复用同一流程
+    """
+    table = CUBE_TABLE
+    meta_table = CUBE_META_TABLE
+    source_tables = SOURCE_TABLES
+    enabled_setting = "FEASIBILITY_CUBE_ENABLED"
+    aggregate_sql = _AGGREGATE_SQL
+    ddl = _DDL
+
+    def __init__(self):
+        super().__init__()
+        self.name = self.table
+        self._lock = threading.Lock()
+        self._absent_until = 0.0
+        self._stats = {"refreshes": 0, "rebuilds": 0, "cells_added": 0}
+        # 最近一次刷新时元数据中的构建参数（见 _build_params）
+        self.params: Dict[str, int] = {}
+
+    # -----------------------
+    # 元数据（高水位 / stale 标记）
+    # -----------------------
+    def _meta(self, conn) -> Dict[str, str]:
+        rows = conn.execute(text(f"SELECT meta_key, meta_value FROM {self.meta_table}")).fetchall()
+        return {k: v for k, v in rows}
+
+    def _set_meta(self, conn, **values):
+        for k, v in values.items():
+            conn.execute(text(f"DELETE FROM {self.meta_table} WHERE meta_key = :k"), {"k": k})
+            conn.execute(text(f"INSERT INTO {self.meta_table} (meta_key, meta_value) VALUES (:k, :v)"),
+                         {"k": k, "v": str(v)})
+
+    @staticmethod
+    def _max_occurrence_id(conn) -> int:
+        return max_source_id(conn, "condition_occurrence")
+
+    def _checksum_bounds(self, conn) -> Dict[str, int]:
+        return {t: max_source_id(conn, t) for t in self.source_tables}
+
+    def _encode_bounds(self, bounds: Dict[str, int]) -> str:
+        return ",".join(str(bounds[t]) for t in self.source_tables)
+
+    def _decode_bounds(self, value: str) -> Dict[str, int]:
+        return dict(zip(self.source_tables, map(int, value.split(","))))
+
+    def _build_params(self) -> Dict[str, int]:
+        """聚合 SQL 的额外绑定参数：构建时取当前配置并写入元数据，增量刷新沿用元数据中的值"""
+        return {}
+
+    def _aggregate(self, conn, since: int, until: int, params: Dict[str, int]) -> int:
+        rs = conn.execute(text(transpile_sql(self.aggregate_sql)), {"since": since, "until": until, **params})
+        return max(rs.rowcount, 0)
+
+    # -----------------------
+    # 构建 / 刷新
+    # -----------------------
+    def build(self, log=print) -> Dict[str, Any]:
+        """全量构建（或重建）立方体"""
+        t0 = time.perf_counter()
+        db = get_db_manager()
+        with self._lock, db.session() as s:
+            conn = s.connection()
+            for ddl in self.ddl:
+                conn.execute(text(ddl))
+            conn.execute(text(f"DELETE FROM {self.table}"))
+            bounds = self._checksum_bounds(conn)
+            until = bounds["condition_occurrence"]
+            params = self._build_params()
+            cells = self._aggregate(conn, -1, until, params)
+            now = datetime.datetime.utcnow().isoformat(timespec="seconds")
+            self._set_meta(conn, high_water=until, stale=0, built_at=now, refreshed_at=now,
+                           checksum=source_checksum(conn, bounds), checksum_until=self._encode_bounds(bounds),
+                           **params)
+            self._absent_until = 0.0
+            self._stats["rebuilds"] += 1
+        self._built()
+        elapsed = round((time.perf_counter() - t0) * 1000, 1)
+        log(f"{self.table}: {cells} cells, high water {until}, {elapsed} ms")
+        return {"cells": cells, "high_water": until, "elapsed_ms": elapsed}
+
+    def refresh(self) -> Dict[str, Any]:
+        """
+        增量刷新：只聚合高水位之后追加的记录
+        高水位用条件 UPDATE 推进，多个进程同时刷新时只有一个会写入增量，不会重复计数
+        """
+        db = get_db_manager()
+        with db.session() as s:
+            conn = s.connection()
+            meta = self._meta(conn)
+            if meta.get("stale") == "1" or "high_water" not in meta or expired(meta.get("built_at")):
+                return {"mode": "stale"}
+            params = {k: int(meta[k]) for k in self._build_params()}
+            since = int(meta["high_water"])
+            until = self._max_occurrence_id(conn)
+            if until <= since:
+                return {"mode": "noop", "high_water": since, "params": params}
+            claimed = conn.execute(
+                text(f"UPDATE {self.meta_table} SET meta_value = :until "
+                     "WHERE meta_key = 'high_water' AND meta_value = :since"),
+                {"until": str(until), "since": str(since)},
+            ).rowcount
+            if claimed != 1:
+                return {"mode": "concurrent", "high_water": since, "params": params}
+            cells = self._aggregate(conn, since, until, params)
+        with self._lock:
+            self._stats["refreshes"] += 1
+            self._stats["cells_added"] += cells
+        return {"mode": "incremental", "high_water": until, "cells": cells, "params": params}
+
+    def absorbs_write(self, statement_type: str, tables) -> bool:
+        """写入能否由增量刷新吸收（否则需要重建）"""
+        return is_append_only(statement_type, tables)
+
+    def mark_stale(self):
+        """基础表有非追加写入：标记失效（之后的请求回退基础表并触发后台重建）"""
+        db = get_db_manager()
+        try:
+            with db.session() as s:
+                self._set_meta(s.connection(), stale=1)
+        except Exception:
+            # 立方体尚未构建
+            pass
+
+    def verify(self) -> bool:
+        """重新计算构建时记录的来源表校验和；不一致（有绕过 run_write 的修改）时标记 stale"""
+        db = get_db_manager()
+        with db.session() as s:
+            conn = s.connection()
+            meta = self._meta(conn)
+            if "checksum" not in meta or meta.get("stale") == "1":
+                return True
+            ok = source_checksum(conn, self._decode_bounds(meta["checksum_until"])) == meta["checksum"]
+        if not ok:
+            self.mark_stale()
+        return ok
+
+    def ensure_fresh(self) -> Optional[str]:
+        """
+        请求前调用：立方体可用时先追上基础表的追加写入，返回 None；
+        不可用时返回原因（disabled / not_built / stale / error），调用方回退到基础表
+        """
+        if not getattr(settings, self.enabled_setting):
+            return "disabled"
+        if time.monotonic() < self._absent_until:
+            return "not_built"
+        try:
+            result = self.refresh()
+        except Exception:
+            # 表不存在（尚未构建）或数据库错误：一段时间内不再尝试
+            self._absent_until = time.monotonic() + _ABSENT_RECHECK_S
+            return "not_built"
+        if result["mode"] == "stale":
+            self._rebuild_in_background()
+            return "stale"
+        self.params = result["params"]
+        self._verify_in_background()
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, **self._maintenance_stats())
+
+
+_CUBE: Optional[FeasibilityCube] = None
+_CUBE_LOCK = threading.Lock()
+
+
+def get_feasibility_cube() -> FeasibilityCube:
+    """获取进程内共享的立方体句柄"""
+    global _CUBE
+    if _CUBE is None:
+        with _CUBE_LOCK:
+            if _CUBE is None:
+                _CUBE = FeasibilityCube()
+    return _CUBE
+
+
+# =====================================================
+# 命令行：构建 / 增量刷新
+# =====================================================
+
+if __name__ == "__main__":
+    import sys
+
+    cube = get_feasibility_cube()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if cmd == "build":
+        cube.build()
+    elif cmd == "refresh":
+        print(cube.refresh())
+    elif cmd == "verify":
+        print({"consistent": cube.verify()})
+    else:
+        print("usage: python -m poc.db.feasibility_cube [build|refresh|verify]")
+        sys.exit(1)
@@ -0,0 +1,135 @@
+"""
+近似计数的抽样表（feasibility_sample）
+
+早期可行性评估只需要 ±几个百分点的答案。抽样表按 person_id 哈希保留一部分人员
+（比例 APPROX_SAMPLE_RATE）的全部诊断记录：
+    hash(person_id) % 1000000 < sample_cutoff
+近似模式（run_pipeline(..., approximate=True)）的查询改为读这张小表，再按抽样率放大。
+
+- 按人抽样（整群抽样）：同一个人的记录要么全部在样本中、要么全部不在，
+  因此既能估计记录数，也能估计不同人数（不需要 HyperLogLog）
+- 估计量（Horvitz-Thompson，抽样率 f，样本中每人的记录数 n_i）：
+      记录数 = Σn_i / f，方差 = (1 - f) / f² · Σn_i²
+      人数   = m / f，  方差 = (1 - f) / f² · m
+  置信区间取正态近似（APPROX_CONFIDENCE），下界不低于样本中实际观察到的数
+- 维护与立方体相同（见 feasibility_cube.py）：构建 python -m poc.db.feasibility_sample build，
+  追加写入按高水位增量吸收，其他写入标记 stale 后回退精确查询并后台重建；
+  表中只存诊断记录，人员属性查询时 JOIN person，写 person 不需要重建
+"""
+import math
+import threading
+from statistics import NormalDist
+from typing import Dict, Any, List, Optional
+
+from poc.db.config import settings
+from poc.db.feasibility_cube import FeasibilityCube
+
+SAMPLE_TABLE = "feasibility_sample"
+SAMPLE_META_TABLE = "feasibility_sample_meta"
+
+# person_id 哈希分桶数：sample_cutoff = 抽样率 × 分桶数
+HASH_BUCKETS = 1000000
+# 乘法哈希（Knuth）：连续的 person_id 也能均匀分散到各桶；乘积在 BIGINT 范围内
+_HASH_EXPR = f"(c.person_id * 2654435761) % {HASH_BUCKETS}"
+
+_SAMPLE_SQL = f"""
+    INSERT INTO {SAMPLE_TABLE} (person_id, condition_concept_id, condition_start_date)
+    SELECT c.person_id, c.condition_concept_id, c.condition_start_date
+    FROM condition_occurrence c
+    WHERE c.condition_occurrence_id > :since AND c.condition_occurrence_id <= :until
+      AND {_HASH_EXPR} < :sample_cutoff
+"""
+
+_DDL = (
+    f"CREATE TABLE IF NOT EXISTS {SAMPLE_TABLE} ("
+    "person_id BIGINT NOT NULL, condition_concept_id INTEGER, condition_start_date DATE)",
+    f"CREATE INDEX IF NOT EXISTS ix_{SAMPLE_TABLE}_concept ON {SAMPLE_TABLE} (condition_concept_id, condition_start_date)",
+    f"CREATE TABLE IF NOT EXISTS {SAMPLE_META_TABLE} ("
+    "meta_key VARCHAR(32) PRIMARY KEY, meta_value VARCHAR(64))",
+)
+
+
+class FeasibilitySample(FeasibilityCube):
+    table = SAMPLE_TABLE
+    meta_table = SAMPLE_META_TABLE
+    source_tables = ("condition_occurrence",)
+    enabled_setting = "APPROX_ENABLED"
+    aggregate_sql = _SAMPLE_SQL
+    ddl = _DDL
+
+    def _build_params(self) -> Dict[str, int]:
+        rate = min(max(settings.APPROX_SAMPLE_RATE, 0.0), 1.0)
+        return {"sample_cutoff": int(round(rate * HASH_BUCKETS))}
+
+    @property
+    def sample_rate(self) -> Optional[float]:
+        """最近一次刷新时抽样表的实际抽样率（构建时写入元数据）"""
+        cutoff = self.params.get("sample_cutoff")
+        return cutoff / HASH_BUCKETS if cutoff else None
+
+
+_SAMPLE: Optional[FeasibilitySample] = None
+_SAMPLE_LOCK = threading.Lock()
+
+
+def get_feasibility_sample() -> FeasibilitySample:
+    """获取进程内共享的抽样表句柄"""
+    global _SAMPLE
+    if _SAMPLE is None:
+        with _SAMPLE_LOCK:
+            if _SAMPLE is None:
+                _SAMPLE = FeasibilitySample()
+    return _SAMPLE
+
+
+# =====================================================
+# 估计量与置信区间
+# =====================================================
+
+def _interval(observed: float, sum_sq: float, rate: float, z: float) -> Dict[str, int]:
+    est = observed / rate
+    half = z * math.sqrt((1 - rate) / rate ** 2 * sum_sq)
+    return {"estimate": int(round(est)), "low": int(math.floor(max(observed, est - half))),
+            "high": int(math.ceil(est + half))}
+
+def estimate_rows(rows: List[Dict[str, Any]], rate: float, confidence: float) -> List[Dict[str, Any]]:
+    """
+    抽样查询的结果行 -> 估计值行
+    抽样模板对每个计数列 x 返回 x（样本记录数）、x_sq（每人记录数的平方和）、x_persons（样本人数）；
+    输出中 x 为放大后的估计值，并附 x_low / x_high 与 x_persons / x_persons_low / x_persons_high，
+    其余列（分组维度）原样保留
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    out = []
+    for r in rows:
+        row: Dict[str, Any] = {}
+        for k, v in r.items():
+            if f"{k}_sq" in r:
+                n = _interval(float(v or 0), float(r[f"{k}_sq"] or 0), rate, z)
+                m = float(r.get(f"{k}_persons") or 0)
+                persons = _interval(m, m, rate, z)
+                row.update({k: n["estimate"], f"{k}_low": n["low"], f"{k}_high": n["high"],
+                            f"{k}_persons": persons["estimate"], f"{k}_persons_low": persons["low"],
+                            f"{k}_persons_high": persons["high"]})
+            elif not (k.endswith("_sq") or k.endswith("_persons")):
+                row[k] = v
+        out.append(row)
+    return out
+
+
+# =====================================================
+# 命令行：构建 / 增量刷新
+# =====================================================
+
+if __name__ == "__main__":
+    import sys
+
+    sample = get_feasibility_sample()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if cmd == "build":
+        sample.build()
+    elif cmd == "refresh":
+        print(sample.refresh())
+    else:
+        print("usage: python -m poc.db.feasibility_sample [build|refresh]")
+        sys.exit(1)
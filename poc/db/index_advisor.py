@@ -0,0 +1,383 @@
+"""
+索引顾问（生成查询形状的复合 / 覆盖索引）
+
+sql_generator 生成的查询形状固定：condition_occurrence 上按 condition_concept_id 等值、condition_start_date 范围过滤，
+按 person_id 连接 person，再按 gender_concept_id / year_of_birth 过滤。顾问：
+1. 编译各代表形状（count / trend / distribution / grouped / compare，条件为单个概念 / IN 列表 / 概念集半连接）
+2. 从 sqlglot AST 中提取每张表的 等值 / 范围 / 连接 列与引用列
+3. 推导候选索引：驱动表 = 等值列 + 第一个范围列，其余引用列作为覆盖列（PostgreSQL 用 INCLUDE，其他库追加到键尾）；
+   按主键连接的探查侧 = 主键 + 过滤列（聚簇主键的表不需要）
+4. 与 inspect() 读到的现有索引 / 主键比较（前缀相同且覆盖列齐全即视为已有）
+5. 报告每个形状建索引前后的规划器代价（见 estimator.explain_estimate_on）：
+   - advise：不执行任何 DDL（MySQL 的 DDL 会隐式提交，PostgreSQL 普通 CREATE INDEX 会阻塞写入）；
+     PostgreSQL 装有 hypopg 扩展时用假设索引（只存在于本会话，不建物理索引）估计建索引后的代价，
+     否则只给出推荐与当前代价，不报告建索引后的代价
+   - apply：PostgreSQL 在事务外 CREATE INDEX CONCURRENTLY（不阻塞写入；失败时删除留下的无效索引），
+     其他库直接建索引；之后 ANALYZE 并重新 EXPLAIN
+
+用法：python -m poc.db.index_advisor [advise|apply]
+"""
+import re
+import json
+import hashlib
+from datetime import date
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlglot import exp
+
+from poc.db.database import get_db_manager, sql_dialect
+from poc.utils.sqlglot_utils import analyze_sql
+
+# 代表形状的过滤条件（全部出现）；compare 的条件由各组给出
+_FILTERS = ("condition", "time_window", "gender", "birth_year_max", "birth_year_min")
+_SHAPES = (
+    # (形状名, 模板, 过滤条件键, 分组)
+    ("count", "count", _FILTERS, None),
+    ("count_in_list", "count", ("condition_in",) + _FILTERS[1:], None),
+    ("count_concept_set", "count", ("condition_set",) + _FILTERS[1:], None),
+    ("trend", "trend", _FILTERS, "year"),
+    ("distribution", "distribution", _FILTERS, None),
+    ("grouped", "grouped", _FILTERS, ("gender", "age_group")),
+    ("compare", "compare", _FILTERS[1:], ("condition", "condition_in")),
+)
+
+# EXPLAIN 用的示例绑定参数（compare 各组的参数带 _<组序号> 后缀）
+_SAMPLE_PARAMS = {
+    "condition_concept_id": 201826,
+    "condition_concept_ids": [201826, 201254, 443238],
+    "concept_set_id": "0" * 16,
+    "time_window_start": date(2020, 1, 1),
+    "time_window_end_excl": date(2025, 1, 1),
+    "gender_concept_id": 8532,
+    "birth_year_max": 1990,
+    "birth_year_min": 1940,
+    "age_reference_year": date.today().year,
+}
+_ARM_SUFFIX_RE = re.compile(r"_\d+$")
+
+# 更新统计信息（规划器代价依赖统计信息）
+_ANALYZE = {
+    "sqlite": lambda tables: ["ANALYZE"],
+    "postgres": lambda tables: [f"ANALYZE {t}" for t in tables],
+    "mysql": lambda tables: [f"ANALYZE TABLE {t}" for t in tables],
+}
+
+
+# =====================================================
+# 查询形状
+# =====================================================
+
+def sample_params(sql: str) -> Dict[str, Any]:
+    """SQL 中出现的绑定参数 -> 示例取值"""
+    names = {p.name for p in analyze_sql(sql).ast.find_all(exp.Placeholder) if p.name}
+    return {n: _SAMPLE_PARAMS.get(n, _SAMPLE_PARAMS.get(_ARM_SUFFIX_RE.sub("", n))) for n in names}
+
+def query_shapes(dialect: Optional[str] = None) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    sql_generator 生成的代表查询形状（基础表）
+    Returns:
+        [(形状名, 参数化 SQL, 示例绑定参数)]
+    """
+    from poc.execution.sql_generator import compile_template
+
+    dialect = dialect or sql_dialect()
+    shapes = []
+    for name, template, filters, grouping in _SHAPES:
+        sql = compile_template(template, filters, grouping, dialect).sql
+        shapes.append((name, sql, sample_params(sql)))
+    return shapes
+
+
+# =====================================================
+# AST 分析：每张表的 等值 / 范围 / 连接 列
+# =====================================================
+
+def _predicates(node: exp.Expression) -> List[Tuple[exp.Column, str]]:
+    """一个合取项 -> [(列, eq | range | join)]；列上套了函数或两侧都不是列时不可用索引，返回空"""
+    node = node.unnest()
+    if isinstance(node, exp.Or):
+        # 同一列上的等值条件取 OR（compare 各组的条件）等价于 IN 列表，仍可走索引
+        parts = [_predicates(x) for x in node.flatten()]
+        if all(len(p) == 1 and p[0][1] == "eq" for p in parts) and len({p[0][0] for p in parts}) == 1:
+            return parts[0]
+        return []
+    if isinstance(node, (exp.EQ, exp.GT, exp.GTE, exp.LT, exp.LTE)):
+        left, right = node.this, node.expression
+        if isinstance(left, exp.Column) and isinstance(right, exp.Column):
+            return [(left, "join"), (right, "join")]
+        col, other = (left, right) if isinstance(left, exp.Column) else (right, left)
+        if not isinstance(col, exp.Column) or other.find(exp.Column):
+            return []
+        return [(col, "eq" if isinstance(node, exp.EQ) else "range")]
+    if isinstance(node, exp.In) and isinstance(node.this, exp.Column):
+        return [(node.this, "eq")]
+    if isinstance(node, exp.Between) and isinstance(node.this, exp.Column):
+        return [(node.this, "range")]
+    return []
+
+def _conjuncts(node: Optional[exp.Expression]) -> List[exp.Expression]:
+    if node is None:
+        return []
+    node = node.unnest()
+    return list(node.flatten()) if isinstance(node, exp.And) else [node]
+
+def shape_usage(sql: str) -> Dict[str, Dict[str, List[str]]]:
+    """
+    一个查询形状对每张表的列使用情况（按出现顺序去重）
+    Returns:
+        {表名: {"eq": [...], "range": [...], "join": [...], "columns": [全部引用列]}}
+    """
+    ast = analyze_sql(sql).ast
+    if ast is None:
+        return {}
+    aliases = {t.alias_or_name: t.name for t in ast.find_all(exp.Table)}
+    only = next(iter(aliases.values())) if len(set(aliases.values())) == 1 else None
+    usage: Dict[str, Dict[str, List[str]]] = {
+        t: {"eq": [], "range": [], "join": [], "columns": []} for t in aliases.values()
+    }
+
+    def _add(col: exp.Column, kind: str):
+        table = aliases.get(col.table) if col.table else only
+        if table and col.name not in usage[table][kind]:
+            usage[table][kind].append(col.name)
+
+    predicates = _conjuncts(ast.args.get("where") and ast.args["where"].this)
+    for join in ast.args.get("joins") or []:
+        predicates += _conjuncts(join.args.get("on"))
+    for pred in predicates:
+        for col, kind in _predicates(pred):
+            _add(col, kind)
+    for col in ast.find_all(exp.Column):
+        _add(col, "columns")
+    return usage
+
+
+# =====================================================
+# 候选索引
+# =====================================================
+
+def _candidate(use: Dict[str, List[str]], pk: Tuple[str, ...]) -> Optional[Tuple[Tuple[str, ...], Tuple[str, ...]]]:
+    """一张表在一个形状中的候选索引：(键列, 覆盖列)；没有可用的过滤 / 连接列时返回 None"""
+    eq, rng, join = use["eq"], use["range"], use["join"]
+    if join and pk and set(join) <= set(pk):
+        # 按主键连接的探查侧：主键之后接过滤列，探查与过滤都在索引内完成
+        key = tuple(join) + tuple(c for c in eq + rng[:1] if c not in join)
+    else:
+        # 驱动表：等值列在前，第一个范围列收尾（之后的列不能再用于定位）
+        key = tuple(eq) + tuple(rng[:1]) or tuple(join)
+    if not key:
+        return None
+    include = tuple(c for c in use["columns"] if c not in key)
+    return key, include
+
+def _merge(candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """同表同键的候选合并覆盖列；键是另一候选键前缀、且列都被其包含的候选去掉"""
+    merged: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Any]] = {}
+    for c in candidates:
+        cur = merged.setdefault((c["table"], c["columns"]), {**c, "include": (), "shapes": []})
+        cur["include"] += tuple(x for x in c["include"] if x not in cur["include"])
+        cur["shapes"] += [s for s in c["shapes"] if s not in cur["shapes"]]
+    out = list(merged.values())
+
+    def _subsumed(a, b):
+        return (a is not b and a["table"] == b["table"] and b["columns"][:len(a["columns"])] == a["columns"]
+                and set(a["include"]) <= set(b["columns"] + b["include"]))
+
+    kept = [a for a in out if not any(_subsumed(a, b) for b in out)]
+    for a in out:
+        if a not in kept:
+            wider = next(b for b in kept if _subsumed(a, b))
+            wider["shapes"] += [s for s in a["shapes"] if s not in wider["shapes"]]
+    return kept
+
+def _existing_indexes(insp, table: str, dialect: str) -> List[Tuple[Tuple[str, ...], Tuple[str, ...], bool]]:
+    """现有索引与主键：[(键列, 全部列, 是否唯一)]"""
+    found = []
+    pk = tuple(insp.get_pk_constraint(table).get("constrained_columns") or ())
+    if pk:
+        columns = insp.get_columns(table)
+        cols = pk
+        # 聚簇主键：主键查找直接得到整行（SQLite 的 INTEGER PRIMARY KEY 即 rowid、MySQL InnoDB）
+        if dialect == "mysql" or (dialect == "sqlite" and len(pk) == 1 and any(
+                c["name"] == pk[0] and str(c["type"]).upper() == "INTEGER" for c in columns)):
+            cols = tuple(c["name"] for c in columns)
+        found.append((pk, cols, True))
+    for ix in insp.get_indexes(table):
+        keys = tuple(c for c in ix.get("column_names") or () if c)
+        include = tuple(ix.get("include_columns") or ix.get("dialect_options", {}).get("postgresql_include") or ())
+        found.append((keys, keys + include, bool(ix.get("unique"))))
+    return found
+
+def _covers(existing: Tuple[Tuple[str, ...], Tuple[str, ...], bool], columns: Tuple[str, ...],
+            include: Tuple[str, ...]) -> bool:
+    """现有索引能否代替候选：键列是其前缀（唯一索引时候选以其全部键列开头即可）且包含全部列"""
+    keys, cols, unique = existing
+    prefix = keys[:len(columns)] == columns or (unique and columns[:len(keys)] == keys)
+    return prefix and set(columns + include) <= set(cols)
+
+def _index_name(table: str, columns: Tuple[str, ...]) -> str:
+    name = f"ix_adv_{table}_{'_'.join(columns)}"
+    if len(name) > 60:
+        name = f"{name[:51]}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+    return name
+
+def index_ddl(table: str, columns: Tuple[str, ...], include: Tuple[str, ...], dialect: str,
+              concurrently: bool = False, if_not_exists: bool = True) -> str:
+    """
+    建索引语句：PostgreSQL 覆盖列用 INCLUDE（不参与排序），其他库追加到键尾
+    :param concurrently: PostgreSQL 的 CREATE INDEX CONCURRENTLY（必须在事务外执行）
+    :param if_not_exists: hypopg 的假设索引不使用 IF NOT EXISTS
+    """
+    name = _index_name(table, columns)
+    create = "CREATE INDEX CONCURRENTLY" if concurrently and dialect == "postgres" else "CREATE INDEX"
+    exists = "IF NOT EXISTS " if if_not_exists and dialect != "mysql" else ""
+    if include and dialect == "postgres":
+        return f"{create} {exists}{name} ON {table} ({', '.join(columns)}) INCLUDE ({', '.join(include)})"
+    return f"{create} {exists}{name} ON {table} ({', '.join(columns + include)})"
+
+def recommend(shapes: List[Tuple[str, str, Dict[str, Any]]], insp, dialect: str) -> List[Dict[str, Any]]:
+    """
+    对比形状所需索引与现有 schema
+    Returns:
+        [{"table", "columns", "include", "name", "ddl", "status": "exists" | "recommended", "shapes"}]
+    """
+    tables = set(insp.get_table_names())
+    candidates = []
+    for name, sql, _ in shapes:
+        for table, use in shape_usage(sql).items():
+            if table not in tables:
+                continue
+            pk = tuple(insp.get_pk_constraint(table).get("constrained_columns") or ())
+            cand = _candidate(use, pk)
+            if cand:
+                candidates.append({"table": table, "columns": cand[0], "include": cand[1], "shapes": [name]})
+
+    recs = []
+    for c in _merge(candidates):
+        existing = _existing_indexes(insp, c["table"], dialect)
+        covered = any(_covers(e, c["columns"], c["include"]) for e in existing)
+        recs.append({
+            **c,
+            "name": _index_name(c["table"], c["columns"]),
+            "ddl": index_ddl(c["table"], c["columns"], c["include"], dialect),
+            "status": "exists" if covered else "recommended",
+        })
+    return recs
+
+
+# =====================================================
+# 建索引前后的 EXPLAIN 代价
+# =====================================================
+
+def _explain(conn, sql: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    from poc.execution.estimator import explain_estimate_on
+
+    try:
+        est = explain_estimate_on(conn, sql, params)
+    except Exception as e:
+        return {"error": str(e)}
+    if est is None:
+        return {"cost": None}
+    return {"cost": est["estimated_cost"], "rows": est["estimated_rows"], "plan": est.get("plan")}
+
+def _analyze(conn, dialect: str, tables: List[str]):
+    for stmt in _ANALYZE.get(dialect, lambda _: [])(tables):
+        conn.execute(text(stmt))
+
+def _explain_all(conn, shapes) -> Dict[str, Dict[str, Any]]:
+    return {name: _explain(conn, sql, params) for name, sql, params in shapes}
+
+def _hypothetical(conn, todo: List[Dict[str, Any]], shapes) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    PostgreSQL + hypopg：在本会话中创建假设索引后 EXPLAIN（不写表、不加锁，结束时 hypopg_reset）
+    Returns:
+        各形状建索引后的代价；没有安装 hypopg 时返回 None
+    """
+    installed = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")).first()
+    if installed is None:
+        return None
+    try:
+        for r in todo:
+            ddl = index_ddl(r["table"], r["columns"], r["include"], "postgres", if_not_exists=False)
+            conn.execute(text("SELECT * FROM hypopg_create_index(:ddl)"), {"ddl": ddl})
+        return _explain_all(conn, shapes)
+    finally:
+        conn.execute(text("SELECT hypopg_reset()"))
+
+def _create_indexes(db, todo: List[Dict[str, Any]], dialect: str):
+    """建索引：PostgreSQL 在事务外 CONCURRENTLY 构建，不阻塞写入"""
+    if dialect != "postgres":
+        with db.engine.begin() as conn:
+            for r in todo:
+                conn.execute(text(r["ddl"]))
+                r["status"] = "created"
+        return
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT")
+        for r in todo:
+            try:
+                conn.execute(text(index_ddl(r["table"], r["columns"], r["include"], dialect, concurrently=True)))
+            except Exception:
+                # 失败的并发构建会留下 INVALID 索引，之后的 IF NOT EXISTS 会跳过它
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {r['name']}"))
+                raise
+            r["status"] = "created"
+
+def advise(apply: bool = False, shapes: Optional[List[Tuple[str, str, Dict[str, Any]]]] = None,
+           log=print) -> Dict[str, Any]:
+    """
+    推荐（apply=True 时创建）索引，并报告每个形状建索引前后的规划器代价
+    只建议时不执行 DDL；建索引后的代价来自 hypopg 假设索引，不可用时为 None
+    :param shapes: [(形状名, 参数化 SQL, 绑定参数)]，默认为 query_shapes()
+    """
+    db = get_db_manager()
+    dialect = sql_dialect()
+    shapes = shapes or query_shapes(dialect)
+    recs = recommend(shapes, inspect(db.engine), dialect)
+    todo = [r for r in recs if r["status"] == "recommended"]
+    tables = sorted({r["table"] for r in recs})
+
+    with db.engine.connect() as conn:
+        before = _explain_all(conn, shapes)
+        after, method = (before, "unchanged") if not todo else (None, None)
+        if todo and not apply and dialect == "postgres":
+            after = _hypothetical(conn, todo, shapes)
+            method = "hypopg" if after is not None else None
+        conn.rollback()
+
+    if todo and apply:
+        _create_indexes(db, todo, dialect)
+        with db.engine.begin() as conn:
+            _analyze(conn, dialect, tables)
+        with db.engine.connect() as conn:
+            after, method = _explain_all(conn, shapes), "applied"
+
+    report = []
+    for name, _, _ in shapes:
+        b = before[name].get("cost")
+        a = after[name].get("cost") if after else None
+        report.append({"shape": name, "before": before[name], "after": after[name] if after else None,
+                       "speedup": round(b / a, 1) if b and a else None})
+        log(f"{name}: cost {b} -> {a if after else 'n/a'}")
+    if todo and after is None:
+        log("cost after indexing not estimated (advise mode runs no DDL; install hypopg on PostgreSQL for estimates)")
+    for r in recs:
+        log(f"[{r['status']}] {r['ddl']}  ({', '.join(r['shapes'])})")
+    return {"dialect": dialect, "applied": apply, "after_method": method, "indexes": recs, "shapes": report}
+
+
+# =====================================================
+# 命令行：只建议 / 创建
+# =====================================================
+
+if __name__ == "__main__":
+    import sys
+
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "advise"
+    if cmd not in ("advise", "apply"):
+        print("usage: python -m poc.db.index_advisor [advise|apply]")
+        sys.exit(1)
+    result = advise(apply=cmd == "apply")
+    if "--json" in sys.argv:
+        print(json.dumps(result, ensure_ascii=False, default=str, indent=2))
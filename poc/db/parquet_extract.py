@@ -0,0 +1,415 @@
+"""
+列式分析引擎：OMOP 表的 Parquet 抽取 + 嵌入式 DuckDB
+
+趋势 / 分布这类大范围扫描放在事务库上会和 ETL 写入争抢资源。这里把 person、condition_occurrence
+抽取成 Parquet（condition_occurrence 按 condition_start_date 的年份 hive 分区：start_year=2020/），
+只读的可行性 SQL 转译到 duckdb 方言后在进程内 DuckDB 上执行（列式向量化聚合；
+时间窗口同时写成分区列上的条件，只读取相关年份的分区文件）。
+
+- 依赖：pip install duckdb（未安装时 ensure_fresh 返回 duckdb_not_installed，查询留在事务库）；写 Parquet 时经 pandas 交给 DuckDB
+- 构建：python -m poc.db.parquet_extract build，写入 EXTRACT_DIR 下新的一代目录（g<时间戳>/），完成后切换 meta.json
+- 增量刷新：每张表记录已抽取的最大主键（高水位）；新追加的行写成新的分区文件（文件名带主键区间），
+  上次刷新中断留下的文件在下次刷新前删除，不会重复计数
+- 失效：对来源表的非追加写入把抽取标记为 stale，之后的请求回退事务库，并在后台重新构建
+  （重建失败记录日志并退避；绕过 run_write 的修改由来源表校验和 / PREAGG_MAX_AGE_S 发现，同 feasibility_cube.py）
+- 抽取由单个进程维护（进程内锁）；查询与刷新可以并发
+"""
+import os
+import re
+import json
+import glob
+import shutil
+import logging
+import datetime
+import threading
+import contextlib
+from typing import Dict, Any, Optional, Iterator, List, Tuple
+
+from sqlalchemy import text
+
+from poc.db.config import settings
+from poc.db.database import get_db_manager
+from poc.db.feasibility_cube import BackgroundMaintenance, source_checksum, expired
+from poc.utils.deadline import current_deadline, DeadlineExceeded
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# 抽取的表 -> (高水位列（单调递增的主键）, 按年份分区的日期列)
+EXTRACT_TABLES = {
+    "person": ("person_id", None),
+    "condition_occurrence": ("condition_occurrence_id", "condition_start_date"),
+}
+# hive 分区列；与结果中的分组列 year 区分开
+PARTITION_COLUMN = "start_year"
+
+_META_FILE = "meta.json"
+# 保留的旧一代目录数：切换后仍在读旧文件的查询不受影响
+_KEEP_GENERATIONS = 1
+_PARAM_RE = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+_RANGE_RE = re.compile(r"^r(\d+)-(\d+)_")
+
+logger = logging.getLogger(__name__)
+
+
+def _quote(path: str) -> str:
+    return "'" + path.replace("'", "''") + "'"
+
+def bind_duckdb(sql: str, params: Optional[Dict[str, Any]] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    :name 占位符 -> DuckDB 的 $name
+    列表参数展开为 ($name__0, $name__1, ...)，与 SQLAlchemy 的 expanding 参数（database.bind_statement）一致
+    """
+    params = params or {}
+    args: Dict[str, Any] = {}
+
+    def _sub(m):
+        name = m.group(1)
+        value = params[name]
+        if isinstance(value, (list, tuple)):
+            names = [f"{name}__{i}" for i in range(len(value))]
+            args.update(zip(names, value))
+            return "(" + ", ".join(f"${n}" for n in names) + ")"
+        args[name] = value
+        return f"${name}"
+
+    return _PARAM_RE.sub(_sub, sql), args
+
+def _typed(col: str) -> str:
+    # SQLite 中日期是文本：按 OMOP 列名约定转成 DATE / TIMESTAMP，Parquet 中保存为日期类型
+    if col.endswith("_date"):
+        return f"CAST({col} AS DATE) AS {col}"
+    if col.endswith("_datetime"):
+        return f"CAST({col} AS TIMESTAMP) AS {col}"
+    return col
+
+@contextlib.contextmanager
+def _interrupt_at_deadline(cursor):
+    """请求级 deadline 到期时中断 DuckDB 查询（与事务库的 statement_deadline 对应）"""
+    deadline = current_deadline()
+    if deadline is None or deadline.expires_at is None:
+        yield
+        return
+    deadline.check("extract query")
+    timer = threading.Timer(max(deadline.remaining(), 0), cursor.interrupt)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except duckdb.InterruptException as e:
+        raise DeadlineExceeded(f"Extract query cancelled at request deadline: {e}") from e
+    finally:
+        timer.cancel()
+
+
+def _estimated_rows(node: Dict[str, Any]) -> Optional[int]:
+    """从计划根节点向下找第一个带基数估计的算子；不分组聚合只产出一行"""
+    while node:
+        if node.get("name") == "UNGROUPED_AGGREGATE":
+            return 1
+        info = node.get("extra_info")
+        card = info.get("Estimated Cardinality") if isinstance(info, dict) else None
+        if card is not None:
+            digits = re.sub(r"\D", "", str(card))
+            return int(digits) if digits else None
+        children = node.get("children") or []
+        node = children[0] if children else None
+    return None
+
+
+class ParquetExtract(BackgroundMaintenance):
+    source_tables = tuple(EXTRACT_TABLES)
+    table = None    # 抽取不在事务库中建表
+    name = "parquet-extract"
+
+    def __init__(self, root: Optional[str] = None):
+        super().__init__()
+        self.root = root or settings.EXTRACT_DIR
+        self._lock = threading.Lock()        # 构建 / 刷新
+        self._view_lock = threading.Lock()   # DuckDB 视图
+        self._con = None
+        self._view_gen: Optional[str] = None
+        self._generation: Optional[str] = None
+        self._stats = {"builds": 0, "refreshes": 0, "rows_added": 0, "queries": 0}
+
+    # -----------------------
+    # 元数据（一代目录 / 高水位 / stale 标记）
+    # -----------------------
+    def _read_meta(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.root, _META_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, meta: Dict[str, Any]):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, _META_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _max_id(conn, table: str) -> int:
+        key, _ = EXTRACT_TABLES[table]
+        return int(conn.execute(text(f"SELECT MAX({key}) FROM {table}")).scalar() or 0)
+
+    # -----------------------
+    # 抽取
+    # -----------------------
+    def _export(self, con, conn, table: str, since: int, until: int, gen_dir: str) -> int:
+        """把 (since, until] 区间内的行写成 Parquet；文件名带主键区间 r<since+1>-<until>_"""
+        import pandas as pd
+
+        key, date_col = EXTRACT_TABLES[table]
+        out_dir = os.path.join(gen_dir, table)
+        os.makedirs(out_dir, exist_ok=True)
+        tag = f"r{since + 1}-{until}"
+        rs = conn.execution_options(stream_results=True, yield_per=settings.EXTRACT_BATCH_ROWS).execute(
+            text(f"SELECT * FROM {table} WHERE {key} > :since AND {key} <= :until ORDER BY {key}"),
+            {"since": since, "until": until},
+        )
+        cols = list(rs.keys())
+        select = ", ".join(_typed(c) for c in cols)
+        rows = 0
+        for b, part in enumerate(rs.partitions(settings.EXTRACT_BATCH_ROWS)):
+            con.register("_batch", pd.DataFrame.from_records(part, columns=cols))
+            if date_col:
+                con.execute(
+                    f"COPY (SELECT {select}, YEAR(CAST({date_col} AS DATE)) AS {PARTITION_COLUMN} FROM _batch) "
+                    f"TO {_quote(out_dir)} (FORMAT PARQUET, PARTITION_BY ({PARTITION_COLUMN}), "
+                    f"FILENAME_PATTERN '{tag}_b{b}_{{i}}', OVERWRITE_OR_IGNORE)"
+                )
+            else:
+                con.execute(f"COPY (SELECT {select} FROM _batch) TO {_quote(os.path.join(out_dir, f'{tag}_b{b}.parquet'))} "
+                            "(FORMAT PARQUET)")
+            con.unregister("_batch")
+            rows += len(part)
+        return rows
+
+    def _remove_orphans(self, gen_dir: str, table: str, high_water: int):
+        """删除高水位之后的文件（上次刷新写了文件但没来得及更新元数据）"""
+        for path in glob.glob(os.path.join(gen_dir, table, "**", "r*.parquet"), recursive=True):
+            m = _RANGE_RE.match(os.path.basename(path))
+            if m and int(m.group(1)) > high_water:
+                os.remove(path)
+
+    def _prune_generations(self, current: str):
+        gens = sorted(d for d in os.listdir(self.root) if d.startswith("g") and d != current)
+        for d in gens[:max(len(gens) - _KEEP_GENERATIONS, 0)]:
+            shutil.rmtree(os.path.join(self.root, d), ignore_errors=True)
+
+    def build(self, log=print) -> Dict[str, Any]:
+        """全量抽取到新的一代目录，完成后切换"""
+        if duckdb is None:
+            raise RuntimeError("duckdb is not installed (pip install duckdb)")
+        t0 = datetime.datetime.utcnow()
+        gen = "g" + t0.strftime("%Y%m%d%H%M%S%f")
+        gen_dir = os.path.join(self.root, gen)
+        with self._lock:
+            os.makedirs(gen_dir, exist_ok=True)
+            con = duckdb.connect()
+            high_water, rows = {}, {}
+            try:
+                with get_db_manager().engine.connect() as conn:
+                    for table in EXTRACT_TABLES:
+                        high_water[table] = self._max_id(conn, table)
+                        rows[table] = self._export(con, conn, table, -1, high_water[table], gen_dir)
+                    checksum = source_checksum(conn, high_water)
+            finally:
+                con.close()
+            now = datetime.datetime.utcnow().isoformat(timespec="seconds")
+            self._write_meta({"generation": gen, "high_water": high_water, "stale": False,
+                              "built_at": now, "refreshed_at": now,
+                              "checksum": checksum, "checksum_until": dict(high_water)})
+            self._generation = gen
+            self._prune_generations(gen)
+            self._stats["builds"] += 1
+        self._built()
+        elapsed = round((datetime.datetime.utcnow() - t0).total_seconds() * 1000, 1)
+        log(f"parquet extract {gen}: {rows}, high water {high_water}, {elapsed} ms")
+        return {"generation": gen, "rows": rows, "high_water": high_water, "elapsed_ms": elapsed}
+
+    def refresh(self) -> Dict[str, Any]:
+        """增量刷新：每张表只抽取高水位之后追加的行"""
+        with self._lock:
+            meta = self._read_meta()
+            if meta is None or meta.get("stale"):
+                return {"mode": "stale"}
+            gen_dir = os.path.join(self.root, meta["generation"])
+            high_water = meta["high_water"]
+            with get_db_manager().engine.connect() as conn:
+                latest = {table: self._max_id(conn, table) for table in EXTRACT_TABLES}
+                pending = [t for t in EXTRACT_TABLES if latest[t] > high_water.get(t, 0)]
+                if not pending:
+                    self._generation = meta["generation"]
+                    return {"mode": "noop", "high_water": high_water}
+                con = duckdb.connect()
+                added = {}
+                try:
+                    for table in pending:
+                        self._remove_orphans(gen_dir, table, high_water.get(table, 0))
+                        added[table] = self._export(con, conn, table, high_water.get(table, 0), latest[table], gen_dir)
+                finally:
+                    con.close()
+            meta["high_water"] = {**high_water, **{t: latest[t] for t in pending}}
+            meta["refreshed_at"] = datetime.datetime.utcnow().isoformat(timespec="seconds")
+            self._write_meta(meta)
+            self._generation = meta["generation"]
+            self._stats["refreshes"] += 1
+            self._stats["rows_added"] += sum(added.values())
+        return {"mode": "incremental", "high_water": meta["high_water"], "rows": added}
+
+    def absorbs_write(self, statement_type: str, tables) -> bool:
+        """向来源表追加行（INSERT）由增量刷新吸收；其他写入需要重新构建"""
+        return statement_type == "INSERT" and {t.lower() for t in tables} <= set(EXTRACT_TABLES)
+
+    def mark_stale(self):
+        with self._lock:
+            meta = self._read_meta()
+            if meta is not None and not meta.get("stale"):
+                meta["stale"] = True
+                self._write_meta(meta)
+
+    def verify(self) -> bool:
+        """重新计算构建时记录的来源表校验和；不一致（有绕过 run_write 的修改）时标记 stale"""
+        meta = self._read_meta()
+        if meta is None or meta.get("stale") or "checksum" not in meta:
+            return True
+        with get_db_manager().engine.connect() as conn:
+            ok = source_checksum(conn, meta["checksum_until"]) == meta["checksum"]
+        if not ok:
+            self.mark_stale()
+        return ok
+
+    def ensure_fresh(self) -> Optional[str]:
+        """
+        请求前调用：抽取可用时先追上来源表的追加写入，返回 None；
+        不可用时返回原因（disabled / duckdb_not_installed / not_built / stale / refresh_failed），调用方留在事务库
+        """
+        if not settings.EXTRACT_ENABLED:
+            return "disabled"
+        if duckdb is None:
+            return "duckdb_not_installed"
+        meta = self._read_meta()
+        if meta is None:
+            return "not_built"
+        if meta.get("stale") or expired(meta.get("built_at")):
+            self._rebuild_in_background()
+            return "stale"
+        try:
+            result = self.refresh()
+        except Exception:
+            logger.exception("parquet extract refresh failed")
+            return "refresh_failed"
+        if result["mode"] == "stale":
+            return "stale"
+        self._verify_in_background()
+        return None
+
+    # -----------------------
+    # 查询
+    # -----------------------
+    def _cursor(self):
+        """当前一代文件上的 DuckDB 游标（每个查询一个游标，线程安全）；切换一代后重建视图"""
+        with self._view_lock:
+            gen = self._generation or (self._read_meta() or {}).get("generation")
+            if gen is None:
+                raise RuntimeError("Parquet extract is not built (python -m poc.db.parquet_extract build)")
+            if self._con is None:
+                self._con = duckdb.connect()
+                if settings.EXTRACT_THREADS:
+                    self._con.execute(f"SET threads = {int(settings.EXTRACT_THREADS)}")
+            if self._view_gen != gen:
+                for table, (_, date_col) in EXTRACT_TABLES.items():
+                    files = os.path.join(self.root, gen, table, "*", "*.parquet") if date_col \
+                        else os.path.join(self.root, gen, table, "*.parquet")
+                    hive = ", hive_partitioning = true" if date_col else ""
+                    self._con.execute(f"CREATE OR REPLACE VIEW {table} AS "
+                                      f"SELECT * FROM read_parquet({_quote(files)}{hive}, union_by_name = true)")
+                self._view_gen = gen
+            self._stats["queries"] += 1
+            return self._con.cursor()
+
+    def stream(self, sql: str, params: Optional[Dict[str, Any]] = None,
+               batch_size: int = None) -> Iterator[List[Dict[str, Any]]]:
+        """执行 duckdb 方言的参数化 SQL（:name 占位符），按批产出 [{列名: 值}, ...]"""
+        batch_size = batch_size or settings.RESULT_BATCH_SIZE
+        query, args = bind_duckdb(sql, params)
+        cur = self._cursor()
+        try:
+            with _interrupt_at_deadline(cur):
+                cur.execute(query, args)
+                cols = [d[0] for d in cur.description]
+                while True:
+                    part = cur.fetchmany(batch_size)
+                    if not part:
+                        break
+                    yield [dict(zip(cols, r)) for r in part]
+        finally:
+            cur.close()
+
+    def run(self, sql: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return [row for batch in self.stream(sql, params) for row in batch]
+
+    def explain_estimate(self, sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        DuckDB 规划器估计的结果行数（EXPLAIN，不扫描 Parquet 数据），与 estimator.explain_estimate 同样的返回格式
+        Returns:
+            {"estimated_rows", "estimated_cost", "plan"}；计划中没有基数估计时返回 None
+        """
+        query, args = bind_duckdb(sql, params)
+        cur = self._cursor()
+        try:
+            with _interrupt_at_deadline(cur):
+                rows = cur.execute("EXPLAIN (FORMAT JSON) " + query, args).fetchall()
+            plan = json.loads(rows[0][1])
+        except (duckdb.Error, ValueError, IndexError):
+            return None
+        finally:
+            cur.close()
+        est = _estimated_rows(plan[0]) if plan else None
+        if est is None:
+            return None
+        return {"estimated_rows": est, "estimated_cost": None, "plan": plan[0].get("name")}
+
+    def stats(self) -> Dict[str, Any]:
+        meta = self._read_meta() or {}
+        return dict(self._stats, generation=meta.get("generation"), high_water=meta.get("high_water"),
+                    stale=meta.get("stale"), **self._maintenance_stats())
+
+
+_EXTRACT: Optional[ParquetExtract] = None
+_EXTRACT_LOCK = threading.Lock()
+
+
+def get_parquet_extract() -> ParquetExtract:
+    """获取进程内共享的 Parquet 抽取句柄"""
+    global _EXTRACT
+    if _EXTRACT is None:
+        with _EXTRACT_LOCK:
+            if _EXTRACT is None:
+                _EXTRACT = ParquetExtract()
+    return _EXTRACT
+
+
+# =====================================================
+# 命令行：构建 / 增量刷新
+# =====================================================
+
+if __name__ == "__main__":
+    import sys
+
+    extract = get_parquet_extract()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if cmd == "build":
+        extract.build()
+    elif cmd == "refresh":
+        print(extract.refresh())
+    elif cmd == "verify":
+        print({"consistent": extract.verify()})
+    else:
+        print("usage: python -m poc.db.parquet_extract [build|refresh|verify]")
+        sys.exit(1)
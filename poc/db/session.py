@@ -1,11 +1,11 @@
 import os
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
+from poc.db.database import get_engine
 
 load_dotenv()
 DB_URL = os.getenv("DB_URL", "sqlite:///./poc_demo.db")
 
-# SQLite: check_same_thread False for simple demo
-engine = create_engine(DB_URL, echo=False, future=True)
+# 复用进程级连接池（见 poc.db.database.get_engine）
+engine = get_engine(DB_URL)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
@@ -7,7 +7,7 @@ import json
 import datetime
 from typing import Optional, Dict, Any
 from sqlalchemy import text, inspect
-from poc.db.database import DatabaseManager
+from poc.db.database import get_db_manager
 from poc.db.config import settings
 from dotenv import load_dotenv
 
@@ -30,7 +30,7 @@ def create_snapshot(snapshot_id: Optional[str] = None) -> Dict[str, Any]:
         ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         snapshot_id = f"SNAPSHOT_{ts}"
     
-    db = DatabaseManager(settings.DB_URL, echo=False)
+    db = get_db_manager()
     snapshot_meta = {
         "snapshot_id": snapshot_id,
         "timestamp": datetime.datetime.utcnow().isoformat(),
@@ -101,7 +101,7 @@ def rollback_to_snapshot(snapshot_id: str, confirm: bool = False) -> Dict[str, A
         raise ValueError("Rollback requires explicit confirmation")
     
     snapshot = load_snapshot(snapshot_id)
-    db = DatabaseManager(settings.DB_URL, echo=False)
+    db = get_db_manager()
     
     try:
         with db.session() as s:
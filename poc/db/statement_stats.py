@@ -0,0 +1,90 @@
+"""
+语句复用统计（参数化 SQL 的计划缓存观测）
+
+SQL 参数化之后，同一查询形状（任务类型 × 出现的过滤条件）的语句文本完全相同，
+字面量只出现在绑定参数里。文本相同的语句可以复用：
+- SQLAlchemy 编译缓存（每次执行的 context.cache_hit）
+- 驱动 / 服务端的预编译语句：sqlite3 语句缓存、asyncpg 预编译语句缓存（按 SQL 文本）
+
+这里按语句文本统计形状数与复用次数，并汇总 SQLAlchemy 编译缓存的命中情况
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from sqlalchemy.engine.interfaces import CacheStats
+
+
+def statement_shape(sql: str) -> str:
+    """语句形状指纹（参数化后的 SQL 文本哈希）"""
+    return hashlib.sha256(" ".join(sql.split()).encode("utf-8")).hexdigest()[:16]
+
+
+class StatementStats:
+    def __init__(self, max_shapes: int = 4096):
+        """
+        :param max_shapes: 记录的语句形状上限（LRU 淘汰）
+        """
+        self.max_shapes = max_shapes
+        self._lock = threading.Lock()
+        self._shapes: "OrderedDict[str, int]" = OrderedDict()
+        self._stats = {"executions": 0, "shape_hits": 0, "compiled_hits": 0, "compiled_misses": 0}
+
+    def record(self, sql: str, result=None):
+        """
+        记录一次执行
+        :param result: 可选，SQLAlchemy CursorResult；用于读取编译缓存是否命中
+        """
+        shape = statement_shape(sql)
+        cache_hit = getattr(getattr(result, "context", None), "cache_hit", None)
+        with self._lock:
+            self._stats["executions"] += 1
+            if shape in self._shapes:
+                self._stats["shape_hits"] += 1
+                self._shapes[shape] += 1
+                self._shapes.move_to_end(shape)
+            else:
+                self._shapes[shape] = 1
+                while len(self._shapes) > self.max_shapes:
+                    self._shapes.popitem(last=False)
+            if cache_hit == CacheStats.CACHE_HIT:
+                self._stats["compiled_hits"] += 1
+            elif cache_hit == CacheStats.CACHE_MISS:
+                self._stats["compiled_misses"] += 1
+
+    def lookup(self, sql: str) -> Dict[str, Any]:
+        """某条语句的形状与累计执行次数（审计用）"""
+        shape = statement_shape(sql)
+        with self._lock:
+            uses = self._shapes.get(shape, 0)
+        return {"shape": shape, "uses": uses, "reused": uses > 1}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["shapes"] = len(self._shapes)
+        out["shape_hit_rate"] = round(out["shape_hits"] / out["executions"], 4) if out["executions"] else 0.0
+        compiled = out["compiled_hits"] + out["compiled_misses"]
+        out["compiled_hit_rate"] = round(out["compiled_hits"] / compiled, 4) if compiled else 0.0
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+            for k in self._stats:
+                self._stats[k] = 0
+
+
+_STATS: Optional[StatementStats] = None
+_STATS_LOCK = threading.Lock()
+
+
+def get_statement_stats() -> StatementStats:
+    """获取进程内共享的语句复用统计"""
+    global _STATS
+    if _STATS is None:
+        with _STATS_LOCK:
+            if _STATS is None:
+                _STATS = StatementStats()
+    return _STATS
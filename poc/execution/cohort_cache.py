@@ -0,0 +1,327 @@
+"""
+人群缓存（cohort / compare 任务的执行后端）
+
+- 每个人群部件（见 sql_generator.cohort_parts：诊断 + 时间窗口 / 性别 / 出生年）的 person_id 集合
+  物化为压缩位图；人群 = 部件交集，compare 的重叠 / 独有人数 = 位图 AND / OR / AND-NOT，全部在内存中完成
+- 位图：pyroaring 的 BitMap64（person_id 是 BIGINT，支持 64 位 id）；未安装时退化为有序 array('q')，
+  内存与人数成正比（与 id 的取值范围无关）
+- 键：数据库 URL + 规范化 SQL 指纹 + 绑定参数 + 所涉及表的数据版本水位，写操作后旧键自然失效；
+  启用磁盘层时表版本持久化在 COHORT_CACHE_DIR 中（与结果缓存的磁盘层是否启用无关），
+  进程重启或其他进程读取时，写操作之前的位图不会再被命中
+- 内存层：LRU + TTL，按位图的字节数限制总大小（COHORT_CACHE_MAX_MB）；
+  磁盘层（可选）：COHORT_CACHE_DIR 下每个条目一个文件（一行 JSON 头 + 位图的序列化字节，不使用 pickle：
+  目录可能共享，读取不能执行代码），总大小超过上限时按最近使用时间淘汰
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Iterable, List, Tuple, Callable
+
+from poc.db.config import settings
+from poc.utils.sqlglot_utils import get_tables
+from .result_cache import TableVersions, sql_fingerprint
+
+try:
+    from pyroaring import BitMap64
+except ImportError:
+    BitMap64 = None
+
+
+# =====================================================
+# 位图
+# =====================================================
+
+class IdArray:
+    """pyroaring 不可用时的位图：有序、去重的 person_id 数组；AND / OR / AND-NOT 为有序归并"""
+    __slots__ = ("ids",)
+
+    def __init__(self, ids: Optional[array] = None):
+        self.ids = ids if ids is not None else array("q")
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "IdArray":
+        return cls(array("q", sorted(set(ids))))
+
+    def __and__(self, other: "IdArray") -> "IdArray":
+        small, large = sorted((self.ids, other.ids), key=len)
+        keep = set(small)
+        return IdArray(array("q", (i for i in large if i in keep)))
+
+    def __or__(self, other: "IdArray") -> "IdArray":
+        return IdArray(array("q", sorted(set(self.ids).union(other.ids))))
+
+    def __sub__(self, other: "IdArray") -> "IdArray":
+        drop = set(other.ids)
+        return IdArray(array("q", (i for i in self.ids if i not in drop)))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.ids) * self.ids.itemsize
+
+    def serialize(self) -> bytes:
+        ids = self.ids
+        if sys.byteorder == "big":
+            ids = array("q", ids)
+            ids.byteswap()
+        return zlib.compress(ids.tobytes())
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "IdArray":
+        ids = array("q")
+        ids.frombytes(zlib.decompress(data))
+        if sys.byteorder == "big":
+            ids.byteswap()
+        return cls(ids)
+
+
+# 磁盘上的位图格式标记：切换实现（安装 / 卸载 pyroaring）后旧文件视为未命中
+BITMAP_KIND = "roaring64" if BitMap64 is not None else "ids"
+
+
+def new_bitmap(ids: Iterable[int]):
+    if BitMap64 is None:
+        return IdArray.from_ids(ids)
+    bitmap = BitMap64(ids)
+    bitmap.run_optimize()
+    return bitmap
+
+def _load_bitmap(data: bytes):
+    return BitMap64.deserialize(data) if BitMap64 is not None else IdArray.deserialize(data)
+
+def bitmap_bytes(bitmap) -> int:
+    """位图占用的字节数（内存层按它计算总大小；Roaring 位图取序列化大小，与内存占用相当）"""
+    return bitmap.nbytes if isinstance(bitmap, IdArray) else len(bitmap.serialize())
+
+
+# =====================================================
+# 缓存
+# =====================================================
+
+class CohortCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 3600, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 0):
+        """
+        :param max_bytes: 内存层位图总字节数上限（LRU 淘汰）
+        :param ttl_seconds: 条目存活时间（秒），0 表示不过期
+        :param disk_dir: 磁盘层目录（表版本一并持久化在其中），None 表示只使用内存层
+        :param disk_max_bytes: 磁盘层总大小上限，0 表示不限
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._versions = TableVersions(disk_dir)
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0,
+                       "puts": 0, "evictions": 0, "disk_evictions": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def make_key(self, sql: str, params: Optional[Dict[str, Any]] = None, tables: Optional[List[str]] = None) -> str:
+        """缓存键 = 数据库 URL + SQL 指纹 + 绑定参数 + 表版本水位"""
+        tables = tables if tables is not None else get_tables(sql)
+        payload = json.dumps(
+            [settings.DB_URL, sql_fingerprint(sql), params or {}, self._versions.watermark(tables)],
+            sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def invalidate_tables(self, tables: Iterable[str]):
+        """写操作后调用：提升表版本号，旧键（包括磁盘层与其他进程）自然失效，内存条目由 LRU 淘汰"""
+        self._versions.bump(tables)
+
+    # -----------------------
+    # 读写
+    # -----------------------
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return bool(self.ttl_seconds) and time.time() - entry["created_at"] > self.ttl_seconds
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.bitmap")
+
+    def get(self, key: str) -> Tuple[Optional[Any], Optional[str]]:
+        """返回 (位图, tier)；未命中时返回 (None, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._pop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return entry["bitmap"], "memory"
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            stored = self._read_file(path)
+            if stored is not None and (self._expired(stored) or stored.get("kind") != BITMAP_KIND):
+                self._remove_file(path)
+                stored = None
+            if stored is not None:
+                bitmap = _load_bitmap(stored["data"])
+                entry = {"created_at": stored["created_at"], "bitmap": bitmap, "bytes": bitmap_bytes(bitmap)}
+                os.utime(path)      # 磁盘层按最近使用时间淘汰
+                with self._lock:
+                    self._insert(key, entry)
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                return entry["bitmap"], "disk"
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None, None
+
+    def has(self, key: str) -> bool:
+        """条目是否在缓存中（内存层或磁盘层；不计入命中统计）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry):
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._disk_path(key))
+
+    def put(self, key: str, bitmap):
+        entry = {"created_at": time.time(), "bitmap": bitmap, "bytes": bitmap_bytes(bitmap)}
+        with self._lock:
+            self._insert(key, entry)
+            self._stats["puts"] += 1
+        if self.disk_dir:
+            header = json.dumps({"created_at": entry["created_at"], "kind": BITMAP_KIND})
+            tmp = self._disk_path(key) + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(header.encode("utf-8") + b"\n")
+                f.write(bitmap.serialize())
+            os.replace(tmp, self._disk_path(key))
+            self._evict_disk()
+
+    @staticmethod
+    def _read_file(path: str) -> Optional[Dict[str, Any]]:
+        """磁盘条目：一行 JSON 头（created_at / kind）+ 位图的序列化字节；格式不对时视为未命中"""
+        try:
+            with open(path, "rb") as f:
+                stored = json.loads(f.readline())
+                stored["data"] = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        return stored if isinstance(stored, dict) and "created_at" in stored else None
+
+    def _insert(self, key: str, entry: Dict[str, Any]):
+        self._pop(key)
+        self._entries[key] = entry
+        self._bytes += entry["bytes"]
+        # 单个位图超过上限时连同它自己一起淘汰（只留在磁盘层）
+        while self._bytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old["bytes"]
+            self._stats["evictions"] += 1
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["bytes"]
+
+    def _evict_disk(self):
+        """磁盘层超过上限时，按最近使用时间从旧到新删除"""
+        if not self.disk_max_bytes:
+            return
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".bitmap"):
+                try:
+                    st = os.stat(os.path.join(self.disk_dir, name))
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(os.path.join(self.disk_dir, name))
+            total -= size
+            with self._lock:
+                self._stats["disk_evictions"] += 1
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # -----------------------
+    # 物化
+    # -----------------------
+    def load(self, sql: str, params: Dict[str, Any], loader: Callable[[str, Dict[str, Any]], Iterable[int]]):
+        """
+        取一个 person_id 集合的位图；未命中时调用 loader(sql, params) 逐个产出 person_id 并写入缓存
+        Returns:
+            (位图, tier)；tier 为 None 表示本次从数据库加载
+        """
+        key = self.make_key(sql, params)
+        bitmap, tier = self.get(key)
+        if bitmap is None:
+            bitmap = new_bitmap(loader(sql, params))
+            self.put(key, bitmap)
+        return bitmap, tier
+
+    def materialize(self, parts: List[Tuple[str, str, Dict[str, Any]]],
+                    loader: Callable[[str, Dict[str, Any]], Iterable[int]]):
+        """
+        人群 = 各部件位图的交集
+        Returns:
+            (位图, 各部件的审计信息 [{"part", "hit", "tier", "size"}])
+        """
+        cohort, info = None, []
+        for name, sql, params in parts:
+            bitmap, tier = self.load(sql, params, loader)
+            info.append({"part": name, "hit": tier is not None, "tier": tier, "size": len(bitmap)})
+            cohort = bitmap if cohort is None else cohort & bitmap
+        return cohort, info
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["size"] = len(self._entries)
+            out["bytes"] = self._bytes
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+        out["bitmap"] = BITMAP_KIND
+        return out
+
+
+_CACHE: Optional[CohortCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cohort_cache() -> CohortCache:
+    """获取进程内共享的人群缓存（配置来自 poc.db.config.Settings）"""
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = CohortCache(
+                    max_bytes=int(settings.COHORT_CACHE_MAX_MB * 1024 * 1024),
+                    ttl_seconds=settings.COHORT_CACHE_TTL,
+                    disk_dir=settings.COHORT_CACHE_DIR or None,
+                    disk_max_bytes=int(settings.COHORT_CACHE_DISK_MAX_MB * 1024 * 1024),
+                )
+    return _CACHE
@@ -0,0 +1,211 @@
+"""
+基于查询规划器的行数估算（dry-run 的廉价替代）
+
+- PostgreSQL：EXPLAIN (FORMAT JSON)，读取顶层节点的 Plan Rows / Total Cost
+- SQLite：EXPLAIN QUERY PLAN + sqlite_stat1 统计信息，按嵌套循环估算
+- 其他数据库或估算不可用时返回 None，由调用方回退到 COUNT(*) 精确计数
+"""
+import json
+import re
+from typing import Dict, Any, Optional
+from sqlalchemy import text
+from sqlglot import exp
+from poc.db.database import get_db_manager, get_async_engine, statement_deadline, statement_deadline_async, bind_statement
+from poc.utils.deadline import DeadlineExceeded
+from poc.utils.sqlglot_utils import analyze_sql
+
+# SQLite EXPLAIN QUERY PLAN 明细，例如：
+#   SCAN c
+#   SEARCH c USING INDEX ix_cond (condition_concept_id=?)
+#   SEARCH p USING INTEGER PRIMARY KEY (rowid=?)
+_SQLITE_STEP_RE = re.compile(
+    r"^(SCAN|SEARCH)\s+(?:TABLE\s+)?(\w+)(?:\s+AS\s+(\w+))?"
+    r"(?:\s+USING\s+(COVERING\s+INDEX|INDEX|INTEGER PRIMARY KEY|PRIMARY KEY|AUTOMATIC(?:\s+(?:PARTIAL|COVERING))*\s+INDEX)\s*(\w+)?\s*(?:\((.*)\))?)?"
+)
+
+
+def _alias_map(sql: str) -> Dict[str, str]:
+    """别名 -> 表名（EXPLAIN QUERY PLAN 输出的是别名）"""
+    node = analyze_sql(sql).ast
+    if node is None:
+        return {}
+    mapping = {}
+    for t in node.find_all(exp.Table):
+        mapping[t.alias_or_name] = t.name
+        mapping[t.name] = t.name
+    return mapping
+
+
+def _is_scalar_aggregate(sql: str) -> bool:
+    """顶层为不带 GROUP BY 的聚合查询（如 SELECT COUNT(*) ...），结果恒为 1 行"""
+    node = analyze_sql(sql).ast
+    if not isinstance(node, exp.Select) or node.args.get("group"):
+        return False
+    return any(e.find(exp.AggFunc) for e in node.expressions)
+
+
+def _sqlite_stats(conn) -> Dict[tuple, list]:
+    """读取 sqlite_stat1：{(table, index|None): [行数, 每个等值前缀的平均行数...]}"""
+    try:
+        rows = conn.execute(text("SELECT tbl, idx, stat FROM sqlite_stat1")).fetchall()
+    except Exception:
+        return {}
+    stats = {}
+    for tbl, idx, stat in rows:
+        try:
+            stats[(tbl, idx)] = [int(x) for x in str(stat).split() if x.isdigit()]
+        except Exception:
+            continue
+    return stats
+
+
+def _sqlite_table_rows(conn, stats: Dict[tuple, list], table: str) -> Optional[int]:
+    for (tbl, _), nums in stats.items():
+        if tbl == table and nums:
+            return nums[0]
+    # 没有统计信息时，rowid 表的 MAX(rowid) 是 O(log n) 的近似行数
+    try:
+        n = conn.execute(text(f'SELECT MAX(rowid) FROM "{table}"')).scalar()
+        return int(n) if n is not None else 0
+    except Exception:
+        return None
+
+
+def _estimate_sqlite(conn, sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    plan = conn.execute(bind_statement(f"EXPLAIN QUERY PLAN {sql}", params), params or {}).fetchall()
+    aliases = _alias_map(sql)
+    stats = _sqlite_stats(conn)
+
+    # MULTI-INDEX OR 下的各分支（INDEX 1 / INDEX 2 ...）是同一层循环的并列扫描，行数相加而不是相乘
+    parents = {row[0]: row[1] for row in plan}
+    or_nodes = {row[0] for row in plan if str(row[-1]).startswith("MULTI-INDEX OR")}
+
+    def _or_root(node_id):
+        while node_id in parents:
+            node_id = parents[node_id]
+            if node_id in or_nodes:
+                return node_id
+        return None
+
+    rows_out = 1
+    rows_visited = 0
+    details = []
+    pending_or, or_rows = None, 0
+
+    def _close_or():
+        nonlocal rows_out, rows_visited, pending_or, or_rows
+        if pending_or is not None:
+            rows_visited += rows_out * or_rows
+            rows_out *= max(or_rows, 1)
+            pending_or, or_rows = None, 0
+
+    for row in plan:
+        detail = str(row[-1])
+        details.append(detail)
+        m = _SQLITE_STEP_RE.match(detail)
+        if not m:
+            continue
+        root = _or_root(row[0])
+        if root != pending_or:
+            _close_or()
+        op, name, alias, using, index, cond = m.groups()
+        table = aliases.get(alias or name, name)
+
+        if op == "SCAN":
+            loop_rows = _sqlite_table_rows(conn, stats, table)
+        elif using and "PRIMARY KEY" in using:
+            loop_rows = 1
+        else:
+            nums = stats.get((table, index))
+            if not nums:
+                return None
+            n_eq = (cond or "").count("=")
+            if n_eq and len(nums) > n_eq:
+                loop_rows = nums[n_eq]
+            else:
+                # 只有范围条件：沿用 SQLite 规划器的经验值，约取 1/4
+                loop_rows = max(1, nums[0] // 4)
+        if loop_rows is None:
+            return None
+        if root is not None:
+            pending_or, or_rows = root, or_rows + loop_rows
+            continue
+
+        rows_visited += rows_out * loop_rows
+        rows_out *= max(loop_rows, 1)
+    _close_or()
+
+    if not details:
+        return None
+
+    return {
+        # 对带 GROUP BY 的查询，嵌套循环行数是结果行数的上界
+        "estimated_rows": 1 if _is_scalar_aggregate(sql) else rows_out,
+        "estimated_cost": float(rows_visited),
+        "plan": details,
+    }
+
+
+def _estimate_postgres(conn, sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    raw = conn.execute(bind_statement(f"EXPLAIN (FORMAT JSON) {sql}", params), params or {}).scalar()
+    doc = json.loads(raw) if isinstance(raw, str) else raw
+    if not doc:
+        return None
+    plan = doc[0].get("Plan", {})
+    if "Plan Rows" not in plan:
+        return None
+    return {
+        "estimated_rows": int(plan["Plan Rows"]),
+        "estimated_cost": float(plan.get("Total Cost", 0.0)),
+        "plan": plan.get("Node Type"),
+    }
+
+
+_ESTIMATORS = {
+    "postgresql": _estimate_postgres,
+    "sqlite": _estimate_sqlite,
+}
+
+
+def explain_estimate_on(conn, sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    在调用方的连接上估算（事务与异常由调用方处理）：
+    索引顾问在同一个事务中比较建索引前后的代价
+    """
+    estimator = _ESTIMATORS.get(conn.dialect.name)
+    return estimator(conn, sql, params) if estimator is not None else None
+
+
+def explain_estimate(sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    通过查询规划器估算 SQL 的结果行数与代价，不实际执行查询
+    :param params: 绑定参数（参数化 SQL）
+    Returns:
+        {"estimated_rows", "estimated_cost", "plan"}；当前数据库不支持或缺少统计信息时返回 None
+    """
+    db = get_db_manager()
+    estimator = _ESTIMATORS.get(db.engine.dialect.name)
+    if estimator is None:
+        return None
+    try:
+        with db.engine.connect() as conn, statement_deadline(conn):
+            return estimator(conn, sql, params)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        return None
+
+
+async def explain_estimate_async(sql: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """explain_estimate 的异步版本（通过 AsyncConnection.run_sync 复用同一套解析逻辑）"""
+    engine = get_async_engine()
+    estimator = _ESTIMATORS.get(engine.dialect.name)
+    if estimator is None:
+        return None
+    try:
+        async with engine.connect() as conn, statement_deadline_async(conn):
+            return await conn.run_sync(estimator, sql, params)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        return None
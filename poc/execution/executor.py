@@ -1,45 +1,71 @@
+import asyncio
+import copy
 import datetime, json
-from typing import Dict, Any, List
-from sqlalchemy import text
-from poc.utils.sqlglot_utils import is_read_only, wrap_count_subquery, pretty
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Iterator, AsyncIterator, Union, Optional, Tuple
+from poc.utils.sqlglot_utils import AnalyzedSQL, analyze_sql, wrap_count_subquery, get_tables
 from poc.utils.risk_policy import assess_risk
-from .sql_generator import intent_to_sql
+from .sql_generator import intent_to_template, cube_template, sample_template, extract_template, cohort_parts, cohort_arm_scan, SQLTemplate
 from poc.intent.schema import FeasibilityIntent
-from poc.db.database import DatabaseManager
+from poc.db.database import get_db_manager, get_async_engine, statement_deadline, statement_deadline_async, bind_statement
+from poc.db.statement_stats import get_statement_stats
+from poc.db.feasibility_cube import get_feasibility_cube
+from poc.db.parquet_extract import get_parquet_extract
+from poc.db.feasibility_sample import get_feasibility_sample, estimate_rows
+from poc.audit.log_manager import write_result_batches, ResultBatchWriter
 from poc.db.config import settings
+from .estimator import explain_estimate, explain_estimate_async
+from .result_cache import get_result_cache
+from .cohort_cache import get_cohort_cache, new_bitmap
+from .scheduler import run_dag, run_dag_async
+from poc.utils.deadline import Deadline, current_deadline
+from poc.vocab.concept_index import GENDER_CONCEPT_MAP, resolve_concept
+from poc.vocab.concept_ancestor import get_concept_ancestry
 
 
-# OMOP 概念映射：条件名称 -> concept_id
-# 注意：实际项目中应该从 concept 表查询，这里使用硬编码映射
-CONDITION_CONCEPT_MAP = {
-    "type 2 diabetes": 319835,  # 根据用户数据
-    "t2dm": 319835,
-    "diabetes": 319835,
-    "hypertension": 201826,  # 根据用户数据
-}
+# 流式意图解析时，condition 字段一完成就在后台预取概念，与 LLM 剩余输出重叠
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="concept-prefetch")
 
-# 性别映射：字符串 -> concept_id
-GENDER_CONCEPT_MAP = {
-    "M": 8507,  # Male
-    "F": 8532,  # Female
-    "male": 8507,
-    "female": 8532,
-}
+
+def prefetch_concepts(condition: Any):
+    """后台预取条件概念（可作为 parse_intent 的 on_field 回调使用）；失败不影响后续的正式解析"""
+    if isinstance(condition, str) and condition.strip():
+        _PREFETCH_POOL.submit(resolve_concept, condition)
+
+
+def _resolve_condition(name: str) -> Optional[Dict[str, Any]]:
+    """条件名称 -> {"condition_concept_id", "condition_concept"}；找不到概念时返回 None"""
+    match = resolve_concept(name)
+    if not match:
+        return None
+    concept = {k: match[k] for k in ("concept_name", "match", "score")}
+    ancestry = get_concept_ancestry() if settings.CONCEPT_DESCENDANTS_ENABLED else None
+    if ancestry is not None:
+        # SQL 同时匹配全部后代概念（见 sql_generator.condition_clause）
+        concept["descendants"] = ancestry.descendant_count(match["concept_id"])
+    return {"condition_concept_id": match["concept_id"], "condition_concept": concept}
 
 def resolve_concepts(intent: Dict[str, Any]) -> Dict[str, Any]:
     """
-    将条件名称映射到 OMOP concept_id
+    将条件名称映射到 OMOP concept_id（compare 单次扫描时逐个对比组映射，见 compare_arms）
     将性别字符串映射到 gender_concept_id
     """
     # 映射条件
     cond = intent.get("condition")
-    if cond:
-        cond_lower = cond.lower()
-        concept_id = CONDITION_CONCEPT_MAP.get(cond_lower)
-        if concept_id:
-            intent["condition_concept_id"] = concept_id
+    if intent.get("compare_arms"):
+        # 对比组：组合后的 condition（如 "diabetes vs hypertension"）本身不是概念，不解析；
+        # 找不到概念的组保留 condition_concept_id=None，SQL 生成时报错
+        intent["compare_arms"] = [
+            {"arm": arm, **(_resolve_condition(arm) or {"condition_concept_id": None})}
+            if isinstance(arm, str) else arm
+            for arm in intent["compare_arms"]
+        ]
+    elif cond:
+        resolved = _resolve_condition(cond)
+        if resolved:
+            intent.update(resolved)
         else:
-            # 如果找不到映射，保留原值（可能需要查询 concept 表）
+            # 找不到概念：保留原始名称，SQL 生成时报错（不会去掉条件过滤变成全表计数）
             intent["condition_concept_id"] = None
             intent["condition_name"] = cond  # 保留原始名称用于调试
     
@@ -52,137 +78,710 @@ def resolve_concepts(intent: Dict[str, Any]) -> Dict[str, Any]:
     
     return intent
 
-def generate_sql(intent: Dict[str, Any]) -> str:
+def generate_template(intent: Dict[str, Any]) -> Tuple[SQLTemplate, Dict[str, Any]]:
     """
-    生成 SQL 时重新构造 FeasibilityIntent，这样 intent_to_sql
+    生成 SQL 时重新构造 FeasibilityIntent，这样 intent_to_template
     可以使用 .task_type 等属性访问
     注意：intent 字典可能包含额外的字段（如 condition_concept_id），
     这些字段需要传递给 SQL 生成器
+    Returns:
+        (编译后的模板（按查询形状缓存）, 绑定参数)
     """
     # 创建 FeasibilityIntent 对象（只包含 schema 定义的字段）
     intent_obj = FeasibilityIntent(**{k: v for k, v in intent.items() if k in FeasibilityIntent.model_fields})
     # 将完整的 intent 字典（包含额外字段）传递给 SQL 生成器
-    sql = intent_to_sql(intent_obj, extra_fields=intent)
-    return sql
+    return intent_to_template(intent_obj, extra_fields=intent)
+
+def route_template(tpl: SQLTemplate, params: Dict[str, Any], approximate: bool = False) -> Tuple[SQLTemplate, Dict[str, Any]]:
+    """
+    按数据来源改写模板，依次尝试：
+    1. feasibility_cube：覆盖全部过滤条件时（精确且最快）
+    2. feasibility_sample：近似模式
+    3. Parquet 抽取（DuckDB）：只读扫描移出事务库（向 params 补充分区裁剪参数）
+    都不可用时使用基础表
+    Returns:
+        (模板, 审计用的路径信息 {"path": "cube" | "sample" | "extract" | "base", "reason", ...})
+    """
+    cube_tpl, reason = cube_template(tpl, params)
+    if cube_tpl is not None:
+        reason = get_feasibility_cube().ensure_fresh()
+    if not reason:
+        return cube_tpl, {"path": "cube"}
+    source = {"path": "base", "reason": reason}
+    if approximate:
+        sample = get_feasibility_sample()
+        source["sample_reason"] = sample.ensure_fresh()
+        if not source["sample_reason"]:
+            return sample_template(tpl), {"path": "sample", "reason": reason, "sample_rate": sample.sample_rate,
+                                          "confidence": settings.APPROX_CONFIDENCE}
+    source["extract_reason"] = get_parquet_extract().ensure_fresh()
+    if not source["extract_reason"]:
+        extract_tpl, source["extract_reason"] = extract_template(tpl, params)
+        if extract_tpl is not None:
+            return extract_tpl, {"path": "extract", "engine": "duckdb", "reason": reason}
+    return tpl, source
+
+def _engine(source: Optional[Dict[str, Any]]) -> str:
+    """执行引擎：extract（进程内 DuckDB）或 db（事务库）"""
+    return "extract" if (source or {}).get("path") == "extract" else "db"
 
-def run_sql(sql: str) -> List[Dict[str, Any]]:
-    db = DatabaseManager(settings.DB_URL, echo=True)
+def generate_sql(intent: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Returns: (参数化 SQL, 绑定参数)"""
+    tpl, params = generate_template(intent)
+    return tpl.sql, params
+
+def audit_params(params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """绑定参数的审计形式（日期转为 ISO 字符串，可直接 JSON 序列化并用于重放）"""
+    return {k: v.isoformat() if isinstance(v, datetime.date) else v for k, v in (params or {}).items()}
+
+def run_sql(sql: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """执行 SQL 并物化全部结果（适合小结果集或写操作）；大结果集请使用 stream_sql"""
+    db = get_db_manager()
     with db.session() as s:
-        rs = s.execute(text(sql))
-        cols = rs.keys()
-        rows = rs.fetchall()
+        conn = s.connection()
+        with statement_deadline(conn):
+            rs = conn.execute(bind_statement(sql, params), params or {})
+            get_statement_stats().record(sql, rs)
+            if not rs.returns_rows:
+                return [{"rowcount": rs.rowcount}]
+            cols = rs.keys()
+            rows = rs.fetchall()
         return [dict(zip(cols, r)) for r in rows]
 
-def run_dry(sql: str) -> int:
-    dry = wrap_count_subquery(sql)
-    out = run_sql(dry)
-    if out and "estimated_rows" in out[0]:
-        return int(out[0]["estimated_rows"])
-    return -1
+async def run_sql_async(sql: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """run_sql 的异步版本（AsyncEngine，事务内执行并提交）"""
+    engine = get_async_engine()
+    async with engine.begin() as conn:
+        async with statement_deadline_async(conn):
+            rs = await conn.execute(bind_statement(sql, params), params or {})
+            get_statement_stats().record(sql, rs)
+            if not rs.returns_rows:
+                return [{"rowcount": rs.rowcount}]
+            cols = list(rs.keys())
+            return [dict(zip(cols, r)) for r in rs.fetchall()]
+
+def _format_batch(cols: List[str], part, columnar: bool):
+    if columnar:
+        return {c: [r[i] for r in part] for i, c in enumerate(cols)}
+    return [dict(zip(cols, r)) for r in part]
+
+def stream_sql(
+    sql: str,
+    batch_size: int = None,
+    columnar: bool = False,
+    params: Optional[Dict[str, Any]] = None,
+) -> Iterator[Union[List[Dict[str, Any]], Dict[str, List[Any]]]]:
+    """
+    以服务端游标流式执行只读 SQL，按固定大小分批产出结果
+    :param params: 绑定参数（:name 占位符）
+    :param batch_size: 每批行数，默认 settings.RESULT_BATCH_SIZE
+    :param columnar: True 时每批为 {列名: [值...]}，否则为 [{列名: 值}, ...]
+    """
+    batch_size = batch_size or settings.RESULT_BATCH_SIZE
+    db = get_db_manager()
+    with db.engine.connect() as conn, statement_deadline(conn):
+        rs = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+            bind_statement(sql, params), params or {}
+        )
+        get_statement_stats().record(sql, rs)
+        cols = list(rs.keys())
+        for part in rs.partitions(batch_size):
+            yield _format_batch(cols, part, columnar)
+
+async def stream_sql_async(
+    sql: str,
+    batch_size: int = None,
+    columnar: bool = False,
+    params: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[Union[List[Dict[str, Any]], Dict[str, List[Any]]]]:
+    """stream_sql 的异步版本（AsyncConnection.stream 服务端游标）"""
+    batch_size = batch_size or settings.RESULT_BATCH_SIZE
+    engine = get_async_engine()
+    async with engine.connect() as conn, statement_deadline_async(conn):
+        rs = await conn.stream(bind_statement(sql, params), params or {})
+        get_statement_stats().record(sql)
+        cols = list(rs.keys())
+        async for part in rs.partitions(batch_size):
+            yield _format_batch(cols, part, columnar)
+
+def _count_result(out: List[Dict[str, Any]]) -> Dict[str, Any]:
+    rows = int(out[0]["estimated_rows"]) if out and "estimated_rows" in out[0] else -1
+    return {"estimated_rows": rows, "estimated_cost": None, "method": "count"}
+
+def run_dry(sql: str, params: Optional[Dict[str, Any]] = None, engine: str = "db") -> Dict[str, Any]:
+    """
+    dry-run：优先使用查询规划器的估算（EXPLAIN），不实际扫描数据；
+    估算不可用或 DRY_RUN_MODE=count 时回退为 COUNT(*) 精确计数
+    Parquet 抽取上使用 DuckDB 的 EXPLAIN 估计；估计不可用时不做精确计数（只读聚合，精确计数等于把查询再扫一遍），
+    只有 DRY_RUN_MODE=count 时才在抽取上 COUNT(*)
+    """
+    if engine == "extract":
+        extract = get_parquet_extract()
+        if settings.DRY_RUN_MODE != "count":
+            est = extract.explain_estimate(sql, params)
+            if est is not None:
+                est["method"] = "explain"
+                return est
+            return {"estimated_rows": None, "estimated_cost": None, "method": "skipped"}
+        return _count_result(extract.run(wrap_count_subquery(sql), params))
+    if settings.DRY_RUN_MODE != "count":
+        est = explain_estimate(sql, params)
+        if est is not None:
+            est["method"] = "explain"
+            return est
+    return _count_result(run_sql(wrap_count_subquery(sql), params))
+
+async def run_dry_async(sql: str, params: Optional[Dict[str, Any]] = None, engine: str = "db") -> Dict[str, Any]:
+    """run_dry 的异步版本"""
+    if engine == "extract":
+        # DuckDB 是同步的，放到线程池中执行
+        return await asyncio.to_thread(run_dry, sql, params, engine)
+    if settings.DRY_RUN_MODE != "count":
+        est = await explain_estimate_async(sql, params)
+        if est is not None:
+            est["method"] = "explain"
+            return est
+    return _count_result(await run_sql_async(wrap_count_subquery(sql), params))
+
+def _cache_lookup(sql: str, params: Optional[Dict[str, Any]]):
+    cache = get_result_cache()
+    tables = get_tables(sql)
+    # 水位在执行前取定：执行期间有写入时，写入缓存的条目取出时即视为过期
+    watermark = cache.watermark(tables)
+    key = cache.make_key(sql, tables, audit_params(params), watermark)
+    cached, tier = cache.get(key)
+    return cache, (tables, watermark), key, cached, tier
+
+def _cache_store(cache, scope, key, cached, tier, collected) -> Dict[str, Any]:
+    if cached is None and not collected["truncated"]:
+        tables, watermark = scope
+        cache.put(key, collected, tables, watermark)
+    return {"hit": cached is not None, "tier": tier, "key": key[:16], "stats": cache.stats()}
+
+def run_read_only(sql: str, params: Optional[Dict[str, Any]] = None, engine: str = "db"):
+    """
+    执行只读查询：先查结果缓存，未命中时流式执行（engine="extract" 时在 Parquet 抽取上执行）
+    审计只内联前 AUDIT_INLINE_ROWS 行；只有完整内联（未截断）的结果才写入缓存
+    Returns:
+        (collected, cache_info)
+    """
+    def _execute():
+        batches = get_parquet_extract().stream(sql, params) if engine == "extract" else stream_sql(sql, params=params)
+        return write_result_batches(
+            batches,
+            inline_rows=settings.AUDIT_INLINE_ROWS,
+            spill=settings.AUDIT_SPILL_RESULTS,
+        )
+
+    if not settings.RESULT_CACHE_ENABLED:
+        return _execute(), None
+
+    cache, scope, key, cached, tier = _cache_lookup(sql, params)
+    collected = cached if cached is not None else _execute()
+    return collected, _cache_store(cache, scope, key, cached, tier, collected)
+
+async def run_read_only_async(sql: str, params: Optional[Dict[str, Any]] = None, engine: str = "db"):
+    """run_read_only 的异步版本"""
+    if engine == "extract":
+        return await asyncio.to_thread(run_read_only, sql, params, engine)
+
+    async def _execute():
+        writer = ResultBatchWriter(settings.AUDIT_INLINE_ROWS, settings.AUDIT_SPILL_RESULTS)
+        try:
+            async for batch in stream_sql_async(sql, params=params):
+                writer.add(batch)
+        finally:
+            collected = writer.close()
+        return collected
+
+    if not settings.RESULT_CACHE_ENABLED:
+        return await _execute(), None
+
+    cache, scope, key, cached, tier = _cache_lookup(sql, params)
+    collected = cached if cached is not None else await _execute()
+    return collected, _cache_store(cache, scope, key, cached, tier, collected)
+
+def _after_write(sql: str):
+    """写操作之后：使涉及表的缓存结果与人群位图失效；写到立方体 / 抽样表的来源表时一并失效其上的缓存结果"""
+    analyzed = analyze_sql(sql)
+    tables = list(analyzed.tables)
+    written = {t.lower() for t in tables}
+    derived = []
+    for agg in (get_feasibility_cube(), get_feasibility_sample(), get_parquet_extract()):
+        if written & set(agg.source_tables):
+            # 追加记录由下一次请求前的增量刷新吸收；其他写入需要重建
+            if not agg.absorbs_write(analyzed.statement_type, tables):
+                agg.mark_stale()
+            if agg.table:
+                derived.append(agg.table)
+    get_result_cache().invalidate_tables(tables + derived)
+    get_cohort_cache().invalidate_tables(tables)
+
+def run_write(sql: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """执行写操作，并使涉及表的缓存结果失效"""
+    res = run_sql(sql, params)
+    _after_write(sql)
+    return {"rows": res, "row_count": len(res), "truncated": False, "spill_path": None}
+
+async def run_write_async(sql: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """run_write 的异步版本"""
+    res = await run_sql_async(sql, params)
+    await asyncio.to_thread(_after_write, sql)
+    return {"rows": res, "row_count": len(res), "truncated": False, "spill_path": None}
+
+
+# =====================================================
+# 计划步骤（同步 / 异步执行路径共用）
+# 每个 handler 只接收直接依赖的 payload，返回 (payload, 审计 outputs)
+# =====================================================
+
+def _arm_of(step: Dict[str, Any]) -> Optional[str]:
+    return (step.get("inputs") or {}).get("arm")
+
+def _step_intent(step: Dict[str, Any], intent: Dict[str, Any]) -> Dict[str, Any]:
+    """步骤使用的 intent：compare 对比组替换为该组的 condition，按 count 执行"""
+    resolved = copy.deepcopy(intent)
+    arm = _arm_of(step)
+    if arm:
+        resolved["condition"] = step["inputs"].get("condition", arm)
+        resolved["task_type"] = "count"
+    elif (step.get("inputs") or {}).get("compare_arms"):
+        # 单次扫描的 compare：全部对比组由同一条 SQL 计数
+        resolved["compare_arms"] = list(step["inputs"]["compare_arms"])
+    return resolved
+
+def _dry_run_result(step, gen: Dict[str, Any], dry: Dict[str, Any]):
+    est = dry["estimated_rows"]
+    rp = assess_risk(gen["analysis"], estimated_rows=est, estimated_cost=dry.get("estimated_cost"))
+    payload = {"sql": gen["sql"], "analysis": gen["analysis"], "params": gen["params"], "risk": rp, "estimated_rows": est, "arm": _arm_of(step),
+               "tidy": gen.get("tidy"), "source": gen.get("source")}
+    outputs = {
+        "estimated_rows": est,
+        "estimated_cost": dry.get("estimated_cost"),
+        "estimate_method": dry["method"],
+        "risk": rp,
+    }
+    return payload, outputs
+
+def _check_run_gate(sql: AnalyzedSQL, risk: Dict[str, Any], user_confirmed: bool, snapshot_id: Optional[str]):
+    # 风险闸门：需要用户确认的高风险操作
+    if risk.get("needs_approval") and not user_confirmed:
+        raise RuntimeError(
+            f"High risk operation requires user confirmation. "
+            f"Risk level: {risk.get('risk', 'unknown')}. "
+            f"Snapshot ID: {snapshot_id or 'N/A'}"
+        )
+
+    # 检查是否为只读操作
+    if not sql.read_only:
+        # 非只读操作也需要确认
+        if not user_confirmed:
+            raise RuntimeError(
+                f"Non-read-only SQL requires user confirmation. "
+                f"Snapshot ID: {snapshot_id or 'N/A'}"
+            )
+
+def _tidy_spec(tpl: SQLTemplate, intent: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """单次扫描的 compare / 多维分组查询：记录结果整理方式（见 _tidy）"""
+    template, _, grouping = tpl.shape
+    if template == "compare":
+        return {"kind": "compare", "arms": [a["arm"] for a in intent["compare_arms"]]}
+    if template == "grouped":
+        return {"kind": "grouped", "dims": list(grouping)}
+    return None
+
+def _tidy_grouped(dims: List[str], rows: List[Dict[str, Any]], complete: bool) -> Dict[str, Any]:
+    """
+    最细粒度的分组行 -> 各维度小计 + 总计（计数可加，等价于 GROUPING SETS 的各个分组集合）
+    complete=False 表示结果被截断（只内联了前 AUDIT_INLINE_ROWS 行），小计只覆盖已内联的行
+    """
+    totals: Dict[str, Dict[Any, int]] = {d: {} for d in dims}
+    cells, total = [], 0
+    for r in rows:
+        n = int(r["count"] or 0)
+        total += n
+        cells.append({**{d: r[d] for d in dims}, "count": n})
+        for d in dims:
+            totals[d][r[d]] = totals[d].get(r[d], 0) + n
+    return {
+        "dimensions": dims,
+        "rows": cells,
+        "totals": {
+            d: [{d: k, "count": v} for k, v in sorted(t.items(), key=lambda kv: (kv[0] is None, kv[0]))]
+            for d, t in totals.items()
+        },
+        "total": total,
+        "complete": complete,
+    }
+
+def _tidy(spec: Optional[Dict[str, Any]], collected: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """把单次扫描的结果整理成汇总步骤直接使用的结构"""
+    if not spec:
+        return None
+    rows = collected["rows"]
+    if spec["kind"] == "compare":
+        row = rows[0] if rows else {}
+        arms = []
+        for i, arm in enumerate(spec["arms"]):
+            out = {"arm": arm, "count": int(row.get(f"arm_{i}") or 0)}
+            if f"arm_{i}_low" in row:
+                # 近似模式：置信区间
+                out.update(low=row[f"arm_{i}_low"], high=row[f"arm_{i}_high"])
+            arms.append(out)
+        return {"arms": arms}
+    return _tidy_grouped(spec["dims"], rows, not collected["truncated"])
+
+def _run_result(
+    step: Dict[str, Any],
+    dry: Dict[str, Any],
+    collected: Dict[str, Any],
+    cache_info: Optional[Dict[str, Any]],
+    snapshot_id: Optional[str],
+):
+    # 参数化后相同查询形状共用同一条语句文本（编译缓存 / 预编译语句复用）
+    statement = get_statement_stats().lookup(dry["sql"])
+    source = dry.get("source") or {}
+    approximate = None
+    if source.get("path") == "sample":
+        # 近似模式：样本计数放大为估计值并附置信区间（缓存中保存的是样本计数，这里不修改原结果）
+        approximate = {"method": "person_hash_sample", "sample_rate": source["sample_rate"],
+                       "confidence": source["confidence"]}
+        collected = dict(collected, rows=estimate_rows(collected["rows"], source["sample_rate"], source["confidence"]))
+    payload = {
+        "rows": collected["rows"],
+        "row_count": collected["row_count"],
+        "risk": dry["risk"],
+        "snapshot_id": snapshot_id,
+        "arm": _arm_of(step),
+    }
+    outputs = {
+        "result": collected["rows"],
+        "row_count": collected["row_count"],
+        "truncated": collected["truncated"],
+    }
+    tidy = _tidy(dry.get("tidy"), collected)
+    if tidy:
+        payload["tidy"] = outputs["tidy"] = tidy
+    if approximate:
+        payload["approximate"] = outputs["approximate"] = approximate
+    if collected["spill_path"]:
+        outputs["result_path"] = collected["spill_path"]
+    if cache_info:
+        outputs["cache"] = cache_info
+    outputs["statement"] = statement
+
+    # 记录快照ID（如果有）
+    if snapshot_id:
+        outputs["snapshot_id"] = snapshot_id
+    return payload, outputs
+
+def _person_ids(sql: str, params: Dict[str, Any]) -> Iterator[int]:
+    """人群缓存未命中时的加载器：流式读取 person_id"""
+    for batch in stream_sql(sql, columnar=True, params=params):
+        yield from batch["person_id"]
+
+def _prefetch_arms(resolved: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    compare：缓存中缺少诊断部件的组不少于两个时，一次扫描加载这些组的 person_id 并写入人群缓存
+    （键与逐组加载相同，之后各组的 build_cohort 直接命中，不再各扫一遍 condition_occurrence）
+    """
+    cache = get_cohort_cache()
+    missing = []
+    for r in resolved:
+        tpl, params = generate_template(r)
+        name, sql, part_params = cohort_parts(tpl, params)[0]
+        key = cache.make_key(sql, part_params)
+        if name == "occurrence" and not cache.has(key):
+            missing.append((tpl, params, key))
+    scan = cohort_arm_scan([(tpl, params) for tpl, params, _ in missing]) if len(missing) > 1 else None
+    if scan is None:
+        return {"arms": len(resolved), "scanned": 0}
+    sql, params = scan
+    ids: List[List[int]] = [[] for _ in missing]
+    for batch in stream_sql(sql, columnar=True, params=params):
+        for i, arm_ids in enumerate(ids):
+            arm_ids.extend(pid for pid, flag in zip(batch["person_id"], batch[f"arm_{i}"]) if flag)
+    for (_, _, key), arm_ids in zip(missing, ids):
+        cache.put(key, new_bitmap(arm_ids))
+    return {"arms": len(resolved), "scanned": len(missing), "sql": sql, "params": audit_params(params)}
+
+def _cohort_result(step, parts, cohort, info):
+    n = len(cohort)
+    payload = {
+        "rows": [{"count": n}],
+        "row_count": 1,
+        "risk": {"statement_type": "SELECT"},
+        "arm": _arm_of(step),
+        "cohort": cohort,
+    }
+    outputs = {
+        "result": [{"count": n}],
+        "row_count": 1,
+        "parts": [
+            dict(part, sql=sql, params=audit_params(params))
+            for part, (_, sql, params) in zip(info, parts)
+        ],
+        "cache": get_cohort_cache().stats(),
+    }
+    return payload, outputs
+
+def _combine_cohorts(cohorts: List[Dict[str, Any]]):
+    """对比组人群的交集 / 并集 / 各组独有人数（位图 AND / OR / AND-NOT，不访问数据库）"""
+    bitmaps = [c["cohort"] for c in cohorts]
+    both, union = bitmaps[0], bitmaps[0]
+    for bm in bitmaps[1:]:
+        both = both & bm
+        union = union | bm
+    exclusive = {}
+    for i, c in enumerate(cohorts):
+        others = None
+        for j, bm in enumerate(bitmaps):
+            if j != i:
+                others = bm if others is None else others | bm
+        exclusive[c["arm"]] = len(c["cohort"] - others)
+    outputs = {
+        "arms": {c["arm"]: len(c["cohort"]) for c in cohorts},
+        "intersection": len(both),
+        "union": len(union),
+        "exclusive": exclusive,
+    }
+    return {"runs": cohorts, **outputs}, outputs
+
+# 汇总文字中每个维度最多列出的小计数
+_SUMMARY_GROUPS = 12
+
+def _with_interval(n: Any, low: Any = None, high: Any = None) -> str:
+    return f"{n}" if low is None else f"约 {n}（{low}–{high}）"
+
+def _approximate_note(approx: Optional[Dict[str, Any]]) -> str:
+    if not approx:
+        return ""
+    return f"（近似值：按人抽样 {approx['sample_rate']:.1%}，{approx['confidence']:.0%} 置信区间）"
+
+def _summarize(runs: List[Dict[str, Any]]) -> str:
+    # 生成友好的操作总结
+    timestamp = datetime.datetime.utcnow().strftime("%Y年%m月%d日")
+    runs = [r for r in runs if r.get("rows")]
+    if not runs:
+        return f"{timestamp}，操作完成"
+
+    operation_type = runs[0].get("risk", {}).get("statement_type", "SELECT")
+    operation_desc = {
+        "SELECT": "查询",
+        "INSERT": "添加",
+        "UPDATE": "更新",
+        "DELETE": "删除"
+    }.get(operation_type, "操作")
+
+    approx = runs[0].get("approximate")
+    note = _approximate_note(approx)
+    tidy = runs[0].get("tidy") or {}
+    if "arms" in tidy:
+        # 单次扫描的 compare：一条 SQL 返回全部对比组
+        parts = [f"{a['arm']}：{_with_interval(a['count'], a.get('low'), a.get('high'))}" for a in tidy["arms"]]
+        return f"{timestamp}，用户执行了对比{operation_desc}，" + "；".join(parts) + note
+    if "dimensions" in tidy:
+        summary = (f"{timestamp}，用户执行了{operation_desc}操作，按 {' × '.join(tidy['dimensions'])} 分组，"
+                   f"共 {len(tidy['rows'])} 组，合计：{tidy['total']}")
+        for d, subtotals in tidy["totals"].items():
+            shown = "，".join(f"{t[d]}={t['count']}" for t in subtotals[:_SUMMARY_GROUPS])
+            summary += f"；{d}：{shown}" + ("…" if len(subtotals) > _SUMMARY_GROUPS else "")
+        if not tidy["complete"]:
+            summary += "（结果已截断，小计只包含前若干行）"
+        return summary + note
+
+    if len(runs) > 1:
+        # compare：每个对比组一个结果
+        parts = [f"{r.get('arm') or '结果'}：{list(r['rows'][0].values())[0]}" for r in runs]
+        return f"{timestamp}，用户执行了对比{operation_desc}，" + "；".join(parts)
+
+    run = runs[0]
+    row = run["rows"][0]
+    n = list(row.values())[0]
+    if approx and "count_low" in row:
+        n = _with_interval(row["count"], row["count_low"], row["count_high"]) + f"，约 {row['count_persons']} 人"
+    summary = f"{timestamp}，用户执行了{operation_desc}操作，返回结果：{n}"
+    if run.get("row_count", 0) > 1:
+        summary += f"（共 {run['row_count']} 行）"
+    if run.get("snapshot_id"):
+        summary += f"（快照ID: {run['snapshot_id']}）"
+    return summary + note
+
+def _make_handlers(intent: Dict[str, Any], user_confirmed: bool, snapshot_id: Optional[str], approximate: bool = False):
+    """构造本次运行的同步 / 异步 step handler（运行级参数通过闭包传入，而不是共享 ctx）"""
+
+    def h_resolve_concepts(step, deps):
+        resolved = resolve_concepts(_step_intent(step, intent))
+        return {"intent": resolved, "arm": _arm_of(step)}, {"intent": resolved}
+
+    def h_generate_sql(step, deps):
+        resolved = deps["resolve_concepts"][0]["intent"]
+        tpl, params = generate_template(resolved)
+        tpl, source = route_template(tpl, params, approximate)
+        # 同一条 SQL 只解析一次：风险评估、执行闸门、缓存键共享分析对象
+        payload = {"sql": tpl.sql, "analysis": analyze_sql(tpl.sql), "params": params, "intent": resolved, "arm": _arm_of(step), "source": source,
+                   "tidy": _tidy_spec(tpl, resolved)}
+        return payload, {"sql": tpl.sql, "params": audit_params(params), "source": source}
+
+    def h_run_dry_run(step, deps):
+        gen = deps["generate_sql"][0]
+        return _dry_run_result(step, gen, run_dry(gen["sql"], gen["params"], _engine(gen["source"])))
+
+    def _snapshot_needed(gen):
+        # 风险等级只取决于语句类型，不必等待 dry-run，可与之并发
+        rp = assess_risk(gen["analysis"])
+        return rp if rp.get("needs_approval") and not snapshot_id else None
+
+    def _snapshot_result(rp, created):
+        sid = created or snapshot_id
+        return {"snapshot_id": sid}, {"needed": rp is not None, "snapshot_id": sid}
+
+    def h_create_snapshot(step, deps):
+        gen = deps["generate_sql"][0]
+        rp = _snapshot_needed(gen)
+        created = None
+        if rp:
+            from poc.utils.snapshot_manager import create_snapshot_for_operation
+            created = create_snapshot_for_operation(
+                operation_type=rp.get("statement_type", "UNKNOWN"),
+                sql=gen["sql"],
+                user_input=intent.get("research_question", "")
+            )
+        return _snapshot_result(rp, created)
+
+    def _snapshot_of(deps):
+        snaps = deps.get("create_snapshot") or [{}]
+        return snaps[0].get("snapshot_id") or snapshot_id
+
+    def h_run_sql(step, deps):
+        dry = deps["run_dry_run"][0]
+        sid = _snapshot_of(deps)
+        _check_run_gate(dry["analysis"], dry["risk"], user_confirmed, sid)
+        cache_info = None
+        if dry["analysis"].read_only:
+            collected, cache_info = run_read_only(dry["sql"], dry["params"], _engine(dry["source"]))
+        else:
+            collected = run_write(dry["sql"], dry["params"])
+        return _run_result(step, dry, collected, cache_info, sid)
+
+    def h_build_cohort(step, deps):
+        resolved = deps["resolve_concepts"][0]["intent"]
+        tpl, params = generate_template(resolved)
+        parts = cohort_parts(tpl, params)
+        cohort, info = get_cohort_cache().materialize(parts, _person_ids)
+        return _cohort_result(step, parts, cohort, info)
+
+    def h_prefetch_cohorts(step, deps):
+        outputs = _prefetch_arms([d["intent"] for d in deps["resolve_concepts"]])
+        return outputs, outputs
+
+    def h_combine_cohorts(step, deps):
+        return _combine_cohorts(deps["build_cohort"])
+
+    def h_summarize_result(step, deps):
+        combined = deps.get("combine_cohorts")
+        runs = combined[0]["runs"] if combined else (deps.get("run_sql") or deps.get("build_cohort", []))
+        summary = _summarize(runs)
+        if combined:
+            summary += f"；同时属于各组：{combined[0]['intersection']} 人"
+        return {"summary": summary}, {"summary": summary}
+
+    async def ah_generate_sql(step, deps):
+        # 概念集合写入与立方体增量刷新都是同步数据库 IO，放到线程池中执行
+        return await asyncio.to_thread(h_generate_sql, step, deps)
+
+    async def ah_build_cohort(step, deps):
+        # 未命中时同步流式读取 person_id，放到线程池中执行
+        return await asyncio.to_thread(h_build_cohort, step, deps)
+
+    async def ah_prefetch_cohorts(step, deps):
+        return await asyncio.to_thread(h_prefetch_cohorts, step, deps)
+
+    async def ah_run_dry_run(step, deps):
+        gen = deps["generate_sql"][0]
+        return _dry_run_result(step, gen, await run_dry_async(gen["sql"], gen["params"], _engine(gen["source"])))
+
+    async def ah_create_snapshot(step, deps):
+        # 快照是同步重 IO 操作，放到线程池中执行
+        return await asyncio.to_thread(h_create_snapshot, step, deps)
+
+    async def ah_run_sql(step, deps):
+        dry = deps["run_dry_run"][0]
+        sid = _snapshot_of(deps)
+        _check_run_gate(dry["analysis"], dry["risk"], user_confirmed, sid)
+        cache_info = None
+        if dry["analysis"].read_only:
+            collected, cache_info = await run_read_only_async(dry["sql"], dry["params"], _engine(dry["source"]))
+        else:
+            collected = await run_write_async(dry["sql"], dry["params"])
+        return _run_result(step, dry, collected, cache_info, sid)
+
+    handlers = {
+        "resolve_concepts": h_resolve_concepts,
+        "generate_sql": h_generate_sql,
+        "run_dry_run": h_run_dry_run,
+        "create_snapshot": h_create_snapshot,
+        "run_sql": h_run_sql,
+        "build_cohort": h_build_cohort,
+        "prefetch_cohorts": h_prefetch_cohorts,
+        "combine_cohorts": h_combine_cohorts,
+        "summarize_result": h_summarize_result,
+    }
+    async_handlers = {
+        "generate_sql": ah_generate_sql,
+        "build_cohort": ah_build_cohort,
+        "prefetch_cohorts": ah_prefetch_cohorts,
+        "run_dry_run": ah_run_dry_run,
+        "create_snapshot": ah_create_snapshot,
+        "run_sql": ah_run_sql,
+    }
+    return handlers, async_handlers
+
 
 def execute_plan_steps(
     plan: List[Dict[str, Any]], 
     intent: Dict[str, Any], 
     audit_steps: List[Dict[str, Any]],
     user_confirmed: bool = False,
-    snapshot_id: str = None
+    snapshot_id: str = None,
+    deadline: Optional[Deadline] = None,
+    approximate: bool = False,
 ):
-    ctx = {"intent": intent.copy()}
-    created_snapshot_id = None
-    
-    for step in plan:
-        record = {
-            "step_id": step["id"],
-            "action": step["action"],
-            "start_at": datetime.datetime.utcnow().isoformat(),
-            "inputs": step.get("inputs", {}),
-            "outputs": {},
-            "status": "pending"
-        }
-        try:
-            if step["action"] == "resolve_concepts":
-                ctx["intent"] = resolve_concepts(ctx["intent"])
-                record["outputs"] = {"intent": ctx["intent"]}
-
-            elif step["action"] == "generate_sql":
-                sql = generate_sql(ctx["intent"])
-                record["outputs"] = {"sql": pretty(sql)}
-                ctx["sql"] = sql
-
-            elif step["action"] == "run_dry_run":
-                est = run_dry(ctx["sql"])
-                rp = assess_risk(ctx["sql"], estimated_rows=est)
-                record["outputs"] = {"estimated_rows": est, "risk": rp}
-                ctx["estimated_rows"] = est
-                ctx["risk"] = rp
-                
-                # 如果是高风险操作，创建快照
-                if rp.get("needs_approval") and not created_snapshot_id:
-                    from poc.utils.snapshot_manager import create_snapshot_for_operation
-                    created_snapshot_id = create_snapshot_for_operation(
-                        operation_type=rp.get("statement_type", "UNKNOWN"),
-                        sql=ctx["sql"],
-                        user_input=intent.get("research_question", "")
-                    )
-                    record["outputs"]["snapshot_id"] = created_snapshot_id
-                    ctx["snapshot_id"] = created_snapshot_id
-
-            elif step["action"] == "run_sql":
-                # 风险闸门：需要用户确认的高风险操作
-                if ctx.get("risk", {}).get("needs_approval") and not user_confirmed:
-                    raise RuntimeError(
-                        f"High risk operation requires user confirmation. "
-                        f"Risk level: {ctx.get('risk', {}).get('risk', 'unknown')}. "
-                        f"Snapshot ID: {created_snapshot_id or snapshot_id or 'N/A'}"
-                    )
-                
-                # 检查是否为只读操作
-                if not is_read_only(ctx["sql"]):
-                    # 非只读操作也需要确认
-                    if not user_confirmed:
-                        raise RuntimeError(
-                            f"Non-read-only SQL requires user confirmation. "
-                            f"Snapshot ID: {created_snapshot_id or snapshot_id or 'N/A'}"
-                        )
-                
-                res = run_sql(ctx["sql"])
-                ctx["result"] = res
-                record["outputs"] = {"result": res}
-                
-                # 记录快照ID（如果有）
-                if created_snapshot_id or snapshot_id:
-                    record["outputs"]["snapshot_id"] = created_snapshot_id or snapshot_id
-
-            elif step["action"] == "summarize_result":
-                # 生成友好的操作总结
-                timestamp = datetime.datetime.utcnow().strftime("%Y年%m月%d日")
-                
-                if ctx.get("result"):
-                    first = ctx["result"][0]
-                    n = list(first.values())[0]
-                    
-                    operation_type = ctx.get("risk", {}).get("statement_type", "SELECT")
-                    operation_desc = {
-                        "SELECT": "查询",
-                        "INSERT": "添加",
-                        "UPDATE": "更新",
-                        "DELETE": "删除"
-                    }.get(operation_type, "操作")
-                    
-                    summary = f"{timestamp}，用户执行了{operation_desc}操作，返回结果：{n}"
-                    if created_snapshot_id or snapshot_id:
-                        summary += f"（快照ID: {created_snapshot_id or snapshot_id}）"
-                else:
-                    summary = f"{timestamp}，操作完成"
-                
-                record["outputs"] = {"summary": summary}
-
-            record["status"] = "success"
-        except Exception as e:
-            record["status"] = "error"
-            record["error"] = str(e)
-        finally:
-            record["end_at"] = datetime.datetime.utcnow().isoformat()
-            audit_steps.append(record)
+    """
+    按依赖关系执行计划：就绪的步骤在线程池（DAG_MAX_WORKERS）中并发执行
+    审计记录写入 audit_steps（计划顺序，含真实起止时间与重叠步骤）
+    deadline 默认取当前上下文（poc.utils.deadline.deadline_scope），到期后运行中的 SQL 被取消（timeout），
+    其余步骤直接 skipped
+    approximate=True 时查询读抽样表（feasibility_sample），返回估计值与置信区间；默认精确
+    Returns:
+        {step_id: payload}
+    """
+    handlers, _ = _make_handlers(intent, user_confirmed, snapshot_id, approximate)
+    payloads, records = run_dag(
+        plan, handlers,
+        max_workers=settings.DAG_MAX_WORKERS,
+        deadline=deadline or current_deadline(),
+    )
+    audit_steps.extend(records)
+    return payloads
 
-    return ctx
+async def execute_plan_steps_async(
+    plan: List[Dict[str, Any]],
+    intent: Dict[str, Any],
+    audit_steps: List[Dict[str, Any]],
+    user_confirmed: bool = False,
+    snapshot_id: str = None,
+    deadline: Optional[Deadline] = None,
+    approximate: bool = False,
+):
+    """
+    execute_plan_steps 的异步版本：数据库往返使用 AsyncEngine，就绪步骤以 asyncio 任务并发，
+    快照（同步、重 IO）放到线程池中执行，不阻塞事件循环
+    """
+    handlers, async_handlers = _make_handlers(intent, user_confirmed, snapshot_id, approximate)
+    payloads, records = await run_dag_async(
+        plan, handlers, async_handlers,
+        deadline=deadline or current_deadline(),
+    )
+    audit_steps.extend(records)
+    return payloads
@@ -0,0 +1,255 @@
+"""
+查询结果缓存（执行层）
+
+- 键：规范化 SQL 指纹（sqlglot AST 重新生成后取 sha256）+ 所涉及表的数据版本水位 + 数据库 URL
+- 内存层：LRU + TTL
+- 磁盘层（可选）：RESULT_CACHE_DIR 下每个条目一个 JSON 文件（不使用 pickle：目录可能共享，读取不能执行代码），
+  表版本水位同样持久化，进程重启后仍然有效
+- 失效：非只读语句执行后，对其 get_tables() 中的每张表提升版本号，并清除引用这些表的内存条目；
+  版本文件变化（其他进程的写操作）时重新读取，条目保存写入时的水位，取出时水位不一致即视为未命中
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Iterable, List, Tuple
+
+from poc.db.config import settings
+from poc.utils.sqlglot_utils import get_tables, analyze_sql
+
+
+def sql_fingerprint(sql: str) -> str:
+    """规范化 SQL 指纹：解析为 AST 后重新生成（统一大小写、空白、引号），再取 sha256（见 AnalyzedSQL.fingerprint）"""
+    return analyze_sql(sql).fingerprint
+
+
+class TableVersions:
+    """
+    表数据版本号：写操作后提升，缓存键 / 条目携带所涉及表的版本水位 [[表名, 版本号]]
+    directory 不为空时持久化为其中的 _table_versions.json，进程重启后仍然有效；
+    文件变化（其他进程的写操作）时重新读取，版本号只增不减，与内存中的版本逐表取最大值
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+        # 最近读取的版本文件标识 (inode, mtime_ns, size)，变化时重新读取
+        self._stamp: Optional[Tuple[int, int, int]] = None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, "_table_versions.json")
+
+    def _load(self):
+        """读取版本文件（调用方持有锁或在初始化中）；文件未变化时跳过"""
+        if not self.directory:
+            return
+        try:
+            st = os.stat(self._path())
+        except FileNotFoundError:
+            return
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self._path(), "r", encoding="utf-8") as f:
+                loaded = {k: int(v) for k, v in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            return
+        for t, v in loaded.items():
+            if v > self._versions.get(t, 0):
+                self._versions[t] = v
+        self._stamp = stamp
+
+    def _save(self):
+        tmp = self._path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._versions, f)
+        os.replace(tmp, self._path())
+        st = os.stat(self._path())
+        self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def watermark(self, tables: Iterable[str]) -> List[List[Any]]:
+        """表版本水位 [[表名, 版本号]]（先读取其他进程写入的版本）"""
+        with self._lock:
+            self._load()
+            return sorted([t.lower(), self._versions.get(t.lower(), 0)] for t in set(tables))
+
+    def bump(self, tables: Iterable[str]):
+        """提升表版本号；先合并其他进程写入的版本再提升，避免覆盖其他进程的版本号"""
+        touched = {t.lower() for t in tables}
+        if not touched:
+            return
+        with self._lock:
+            self._load()
+            for t in touched:
+                self._versions[t] = self._versions.get(t, 0) + 1
+            if self.directory:
+                self._save()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 600, disk_dir: Optional[str] = None):
+        """
+        :param max_entries: 内存层最大条目数（LRU 淘汰）
+        :param ttl_seconds: 条目存活时间（秒），0 表示不过期
+        :param disk_dir: 磁盘层目录（表版本一并持久化在其中），None 表示只使用内存层
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._versions = TableVersions(disk_dir)
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0,
+                       "puts": 0, "evictions": 0, "invalidations": 0}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def watermark(self, tables: Iterable[str]) -> List[List[Any]]:
+        """表版本水位 [[表名, 版本号]]（先读取其他进程写入的版本）"""
+        return self._versions.watermark(tables)
+
+    def make_key(self, sql: str, tables: Optional[List[str]] = None, params: Optional[Dict[str, Any]] = None,
+                 watermark: Optional[List[List[Any]]] = None) -> str:
+        """缓存键 = 数据库 URL + SQL 指纹 + 绑定参数 + 表版本水位（默认取当前水位）"""
+        tables = tables if tables is not None else get_tables(sql)
+        watermark = watermark if watermark is not None else self.watermark(tables)
+        payload = json.dumps(
+            [settings.DB_URL, sql_fingerprint(sql), params or {}, watermark],
+            sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # -----------------------
+    # 读写
+    # -----------------------
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return bool(self.ttl_seconds) and time.time() - entry["created_at"] > self.ttl_seconds
+
+    def _stale(self, entry: Dict[str, Any]) -> bool:
+        """条目写入后，所涉及的表又被写过（调用方持有锁）"""
+        return entry.get("watermark") != self._versions.watermark(entry["tables"])
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key: str) -> Tuple[Optional[Any], Optional[str]]:
+        """返回 (value, tier)；未命中时返回 (None, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self._expired(entry) or self._stale(entry)):
+                self._entries.pop(key, None)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return entry["value"], "memory"
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    stale = self._expired(entry) or self._stale(entry)
+                if stale:
+                    self._remove_file(path)
+                    entry = None
+            if entry is not None:
+                with self._lock:
+                    self._insert(key, entry)
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                return entry["value"], "disk"
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None, None
+
+    def put(self, key: str, value: Any, tables: List[str], watermark: Optional[List[List[Any]]] = None):
+        """
+        :param value: 可 JSON 序列化的结果（与审计记录相同；日期等值在磁盘层中保存为字符串）
+        :param watermark: 计算结果之前（生成键时）的表版本水位；期间有写入时条目在取出时即视为过期
+        """
+        with self._lock:
+            entry = {"created_at": time.time(), "tables": [t.lower() for t in tables],
+                     "watermark": watermark if watermark is not None else self._versions.watermark(tables), "value": value}
+            self._insert(key, entry)
+            self._stats["puts"] += 1
+        if self.disk_dir:
+            tmp = self._disk_path(key) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False, default=str)
+            os.replace(tmp, self._disk_path(key))
+
+    def _insert(self, key: str, entry: Dict[str, Any]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # -----------------------
+    # 失效
+    # -----------------------
+    def invalidate_tables(self, tables: Iterable[str]):
+        """
+        写操作后调用：提升表版本号（旧键自然失效，包括磁盘层），并清除内存中引用这些表的条目
+        """
+        touched = {t.lower() for t in tables}
+        if not touched:
+            return
+        self._versions.bump(touched)
+        with self._lock:
+            stale = [k for k, e in self._entries.items() if touched & set(e["tables"])]
+            for k in stale:
+                self._entries.pop(k, None)
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["size"] = len(self._entries)
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+        return out
+
+
+_CACHE: Optional[ResultCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """获取进程内共享的结果缓存（配置来自 poc.db.config.Settings）"""
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = ResultCache(
+                    max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+                    ttl_seconds=settings.RESULT_CACHE_TTL,
+                    disk_dir=settings.RESULT_CACHE_DIR or None,
+                )
+    return _CACHE
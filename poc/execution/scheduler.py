@@ -0,0 +1,306 @@
+"""
+执行 DAG 调度器
+
+按 PlanStep.depends_on 拓扑调度：所有依赖成功完成的步骤立即并发执行
+（同步路径使用线程池，异步路径使用 asyncio 任务）。
+步骤之间不共享上下文，每个步骤只接收其直接依赖的输出（payload）。
+依赖失败的步骤不再执行，状态记为 skipped。
+传入 deadline 时：步骤在 deadline 作用域内执行，超时的步骤状态记为 timeout，
+其余尚未开始的步骤立即记为 skipped，不再逐个执行失败。
+"""
+import time
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, List, Callable, Tuple, Optional, Awaitable
+
+from poc.utils.deadline import Deadline, DeadlineExceeded, deadline_scope
+
+# handler(step, deps) -> (payload, outputs)
+#   deps:    {依赖步骤的 action: [payload, ...]}，按 depends_on 顺序
+#   payload: 传给下游步骤的数据
+#   outputs: 写入审计记录的数据
+StepHandler = Callable[[Dict[str, Any], Dict[str, List[Dict[str, Any]]]], Tuple[Dict[str, Any], Dict[str, Any]]]
+
+
+def normalize_dependencies(plan: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    返回 {step_id: [依赖 step_id]}
+    兼容旧计划：所有步骤都没有 depends_on 时，按列表顺序串行
+    """
+    if not any("depends_on" in step for step in plan):
+        deps = {}
+        prev = None
+        for step in plan:
+            deps[step["id"]] = [prev] if prev else []
+            prev = step["id"]
+        return deps
+
+    ids = {step["id"] for step in plan}
+    deps = {}
+    for step in plan:
+        missing = [d for d in step.get("depends_on", []) if d not in ids]
+        if missing:
+            raise ValueError(f"Step {step['id']} depends on unknown steps: {missing}")
+        deps[step["id"]] = list(step.get("depends_on", []))
+    return deps
+
+
+def _now() -> Tuple[str, float]:
+    return datetime.datetime.utcnow().isoformat(), time.perf_counter()
+
+
+class _DagRun:
+    """一次 DAG 运行的状态：依赖关系、payload、审计记录"""
+
+    def __init__(self, plan: List[Dict[str, Any]]):
+        self.plan = plan
+        self.steps = {step["id"]: step for step in plan}
+        self.deps = normalize_dependencies(plan)
+        self.payloads: Dict[str, Dict[str, Any]] = {}
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.pending = [step["id"] for step in plan]
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def new_record(self, step_id: str) -> Dict[str, Any]:
+        step = self.steps[step_id]
+        start_at, t = _now()
+        record = {
+            "step_id": step_id,
+            "action": step["action"],
+            "depends_on": self.deps[step_id],
+            "start_at": start_at,
+            "inputs": step.get("inputs", {}),
+            "outputs": {},
+            "status": "pending",
+            "_t_start": t,
+        }
+        with self._lock:
+            self.records[step_id] = record
+        return record
+
+    def start(self, record: Dict[str, Any]) -> bool:
+        """
+        步骤真正开始执行（工作线程 / 任务内调用）：start_at 重置为真实开始时间（不含排队）
+        Returns:
+            False 表示步骤在开始前已被 abandon（记录保持 timeout，不再执行）
+        """
+        start_at, t = _now()
+        with self._lock:
+            if record["status"] == "timeout":
+                return False
+            record["start_at"] = start_at
+            record["_t_start"] = t
+            record["status"] = "running"
+        return True
+
+    def dep_payloads(self, step_id: str) -> Dict[str, List[Dict[str, Any]]]:
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for dep in self.deps[step_id]:
+            grouped.setdefault(self.steps[dep]["action"], []).append(self.payloads[dep])
+        return grouped
+
+    def ready_steps(self) -> List[str]:
+        """依赖全部成功的待执行步骤；依赖失败/跳过的步骤直接标记为 skipped"""
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for step_id in list(self.pending):
+                dep_records = [self.records.get(d) for d in self.deps[step_id]]
+                if any(r is None or r["status"] in ("pending", "running") for r in dep_records):
+                    continue
+                self.pending.remove(step_id)
+                failed = [r["step_id"] for r in dep_records if r["status"] != "success"]
+                if failed:
+                    self.skip(step_id, f"upstream step failed: {', '.join(failed)}")
+                    changed = True
+                else:
+                    ready.append(step_id)
+        return ready
+
+    def skip_pending(self, reason: str):
+        """把所有尚未开始的步骤标记为 skipped（deadline 已到、依赖成环等）"""
+        for step_id in list(self.pending):
+            self.pending.remove(step_id)
+            self.skip(step_id, reason)
+
+    def abandon(self, step_id: str, reason: str):
+        """
+        deadline 到期时仍在运行（或已提交尚未开始）的步骤：不再等待其结果，记为 timeout
+        记录在提交时已创建；在锁内改状态，与工作线程的 start() 互斥，之后开始的工作线程不会再覆盖它
+        """
+        record = self.records[step_id]
+        with self._lock:
+            record["status"] = "timeout"
+            record["error"] = reason
+        self.finish(record)
+
+    def skip(self, step_id: str, reason: str):
+        record = self.new_record(step_id)
+        record["status"] = "skipped"
+        record["error"] = reason
+        self.finish(record)
+
+    def finish(self, record: Dict[str, Any]):
+        end_at, t = _now()
+        record["end_at"] = end_at
+        record["_t_end"] = t
+
+    def succeed(self, step_id: str, record: Dict[str, Any], payload: Dict[str, Any], outputs: Dict[str, Any]):
+        self.payloads[step_id] = payload
+        record["outputs"] = outputs
+        record["status"] = "success"
+        self.finish(record)
+
+    def fail(self, record: Dict[str, Any], error: Exception):
+        # 超时（含数据库语句因 deadline 被取消）与普通错误区分
+        timed_out = isinstance(error, (DeadlineExceeded, asyncio.TimeoutError))
+        record["status"] = "timeout" if timed_out else "error"
+        record["error"] = str(error) or ("request deadline exceeded" if timed_out else type(error).__name__)
+        self.finish(record)
+
+    def audit_records(self) -> List[Dict[str, Any]]:
+        """按计划顺序输出审计记录，附相对耗时与实际并发重叠的步骤"""
+        ordered = [self.records[step["id"]] for step in self.plan if step["id"] in self.records]
+        for rec in ordered:
+            start, end = rec["_t_start"], rec["_t_end"]
+            rec["elapsed_ms"] = round((end - start) * 1000, 3)
+            rec["offset_ms"] = round((start - self._t0) * 1000, 3)
+            rec["overlaps_with"] = [
+                other["step_id"] for other in ordered
+                if other is not rec and "skipped" not in (other["status"], rec["status"])
+                and other["_t_start"] < end and start < other["_t_end"]
+            ]
+        for rec in ordered:
+            rec.pop("_t_start", None)
+            rec.pop("_t_end", None)
+        return ordered
+
+
+_DEADLINE_REASON = "skipped: request deadline exceeded"
+
+
+def run_dag(
+    plan: List[Dict[str, Any]],
+    handlers: Dict[str, StepHandler],
+    max_workers: int = 4,
+    deadline: Optional[Deadline] = None,
+) -> Tuple[Dict[str, Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    在线程池中并发执行计划
+    Returns:
+        (payloads: {step_id: payload}, audit_records)
+    """
+    dag = _DagRun(plan)
+    deadline = deadline or Deadline(None)
+
+    def _execute(step_id: str, record: Dict[str, Any]):
+        # 审计记录在提交前创建（deadline 到期时 abandon 总能找到它），工作线程开始时重置 start_at
+        # contextvars 不会自动传入线程池，需在工作线程内重新进入 deadline 作用域
+        if not dag.start(record):
+            return record, None, None, None
+        try:
+            with deadline_scope(deadline):
+                deadline.check(f"step {step_id}")
+                handler = handlers.get(record["action"])
+                if handler is None:
+                    raise ValueError(f"Unknown plan action: {record['action']}")
+                payload, outputs = handler(dag.steps[step_id], dag.dep_payloads(step_id))
+            return record, payload, outputs, None
+        except Exception as e:
+            return record, None, None, e
+
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plan-step")
+    timed_out = False
+    try:
+        running = {}
+        while True:
+            if deadline.expired():
+                dag.skip_pending(_DEADLINE_REASON)
+            for step_id in dag.ready_steps():
+                running[pool.submit(_execute, step_id, dag.new_record(step_id))] = step_id
+            if not running:
+                break
+            done, _ = wait(list(running), timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                # deadline 已到但仍有步骤在运行（例如数据库不支持语句超时）：不再等待
+                timed_out = True
+                for fut, step_id in running.items():
+                    fut.cancel()
+                    dag.abandon(step_id, "request deadline exceeded")
+                running.clear()
+                dag.skip_pending(_DEADLINE_REASON)
+                break
+            for fut in done:
+                step_id = running.pop(fut)
+                _settle(dag, step_id, *fut.result())
+    finally:
+        pool.shutdown(wait=not timed_out, cancel_futures=True)
+
+    dag.skip_pending("unreachable: dependency cycle")
+    return dag.payloads, dag.audit_records()
+
+
+async def run_dag_async(
+    plan: List[Dict[str, Any]],
+    handlers: Dict[str, StepHandler],
+    async_handlers: Optional[Dict[str, Callable[..., Awaitable]]] = None,
+    deadline: Optional[Deadline] = None,
+) -> Tuple[Dict[str, Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    run_dag 的异步版本：IO 步骤使用 async_handlers（协程），其余步骤直接同步调用；
+    每个步骤以剩余时间为上限（asyncio.wait_for），到期即取消
+    """
+    async_handlers = async_handlers or {}
+    dag = _DagRun(plan)
+    deadline = deadline or Deadline(None)
+
+    async def _run_handler(step, deps):
+        if step["action"] in async_handlers:
+            return await async_handlers[step["action"]](step, deps)
+        if step["action"] in handlers:
+            return handlers[step["action"]](step, deps)
+        raise ValueError(f"Unknown plan action: {step['action']}")
+
+    async def _execute(step_id: str, record: Dict[str, Any]):
+        if not dag.start(record):
+            return record, None, None, None
+        try:
+            with deadline_scope(deadline):
+                deadline.check(f"step {step_id}")
+                payload, outputs = await asyncio.wait_for(
+                    _run_handler(dag.steps[step_id], dag.dep_payloads(step_id)),
+                    timeout=deadline.remaining(),
+                )
+            return record, payload, outputs, None
+        except Exception as e:
+            return record, None, None, e
+
+    running = {}
+    while True:
+        if deadline.expired():
+            dag.skip_pending(_DEADLINE_REASON)
+        for step_id in dag.ready_steps():
+            running[asyncio.ensure_future(_execute(step_id, dag.new_record(step_id)))] = step_id
+        if not running:
+            break
+        done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            step_id = running.pop(task)
+            _settle(dag, step_id, *task.result())
+
+    dag.skip_pending("unreachable: dependency cycle")
+    return dag.payloads, dag.audit_records()
+
+
+def _settle(dag: _DagRun, step_id: str, record, payload, outputs, error):
+    if record["status"] == "timeout":
+        # 已被 abandon 的步骤，忽略迟到的结果
+        return
+    if error is None:
+        dag.succeed(step_id, record, payload, outputs)
+    else:
+        dag.fail(record, error)
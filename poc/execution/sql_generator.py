@@ -1,40 +1,83 @@
+import re
+import functools
 from sqlglot import parse_one
-from datetime import date
-from typing import List, Dict, Any
+from datetime import date, timedelta
+from typing import List, Dict, Any, Tuple, NamedTuple, Optional
 
 from poc.intent.schema import FeasibilityIntent
-
-# OMOP 概念映射（与 executor.py 中的映射保持一致）
-CONDITION_CONCEPT_MAP = {
-    "type 2 diabetes": 319835,
-    "t2dm": 319835,
-    "diabetes": 319835,
-    "hypertension": 201826,
-}
-
-GENDER_CONCEPT_MAP = {
-    "M": 8507,  # Male
-    "F": 8532,  # Female
-    "male": 8507,
-    "female": 8532,
-}
+from poc.db.config import settings
+from poc.db.concept_set import CONCEPT_SET_TABLE, ensure_concept_set
+from poc.db.feasibility_cube import CUBE_TABLE
+from poc.db.feasibility_sample import SAMPLE_TABLE
+from poc.db.parquet_extract import PARTITION_COLUMN
+from poc.vocab.concept_index import GENDER_CONCEPT_MAP, resolve_concept
+from poc.vocab.concept_ancestor import get_concept_ancestry
+from poc.db.database import sql_dialect
+from poc.utils.sqlglot_utils import transpile_sql, analyze_sql
 
 
 # =====================================================
-# Helper: 拼接 WHERE 条件
+# 过滤条件片段
 # =====================================================
+# 查询形状 = 任务模板 × 出现的过滤条件 × 分组；取值全部是绑定参数，
+# 同一形状的 SQL 文本完全相同，每个 (形状, 方言) 只需构建 / 转译一次（见 compile_template）
+# 过滤列上不套函数（日期窗口写成半开区间、边界在参数里算好），各库的日期索引都能使用
+
+_CLAUSES = {
+    "condition": "c.condition_concept_id = :condition_concept_id",
+    "condition_in": "c.condition_concept_id IN :condition_concept_ids",
+    "condition_set": f"c.condition_concept_id IN (SELECT concept_id FROM {CONCEPT_SET_TABLE} WHERE set_id = :concept_set_id)",
+    "time_window": "c.condition_start_date >= :time_window_start AND c.condition_start_date < :time_window_end_excl",
+    "gender": "p.gender_concept_id = :gender_concept_id",
+    "birth_year_max": "p.year_of_birth <= :birth_year_max",
+    "birth_year_min": "p.year_of_birth >= :birth_year_min",
+}
+
+_PARAM_RE = re.compile(r":(\w+)")
 
-def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> List[str]:
+def condition_filter(concept_id: int, params: Dict[str, Any]) -> str:
     """
-    根据 intent 构造 WHERE + JOIN 的过滤条件
-    使用 OMOP CDM 标准列名
+    条件概念及其全部后代（concept_ancestor 闭包）：
+    后代不超过 CONCEPT_IN_LIST_MAX 个时写成 IN 列表（expanding 参数），否则半连接 concept_set_member
+    Returns:
+        过滤条件键（_CLAUSES）
+    """
+    ancestry = get_concept_ancestry() if settings.CONCEPT_DESCENDANTS_ENABLED else None
+    ids = ancestry.descendants(concept_id).tolist() if ancestry is not None else [concept_id]
+    if len(ids) <= 1:
+        params["condition_concept_id"] = int(concept_id)
+        return "condition"
+    if len(ids) <= settings.CONCEPT_IN_LIST_MAX:
+        params["condition_concept_ids"] = ids
+        return "condition_in"
+    params["concept_set_id"] = ensure_concept_set(ids)
+    return "condition_set"
+
+def condition_clause(concept_id: int, params: Dict[str, Any]) -> str:
+    """condition_filter 的 SQL 片段形式"""
+    return _CLAUSES[condition_filter(concept_id, params)]
+
+def _date_param(value: Any, field: str) -> date:
+    # LLM 输出的日期只作为绑定参数传入，并且必须是合法的 YYYY-MM-DD
+    try:
+        return date.fromisoformat(str(value).strip())
+    except ValueError:
+        raise ValueError(f"Invalid {field}: {value!r} (expected YYYY-MM-DD)")
+
+def build_filters(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> Tuple[Tuple[str, ...], Dict[str, Any]]:
+    """
+    根据 intent 确定出现的过滤条件与绑定参数
+    使用 OMOP CDM 标准列名；所有取值都以 :name 绑定参数出现，SQL 文本只取决于查询形状
     
     Args:
         intent: FeasibilityIntent 对象
         extra_fields: 包含额外字段的字典（如 condition_concept_id）
+    Returns:
+        (过滤条件键元组（按固定顺序，_CLAUSES）, 绑定参数)
     """
 
-    conditions = []
+    filters = []
+    params: Dict[str, Any] = {}
     extra = extra_fields or {}
 
     # -----------------------
@@ -42,25 +85,23 @@ def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any]
     # -----------------------
     # 注意：condition_concept_id 在 extra_fields 中（从 resolve_concepts 设置）
     if extra.get("condition_concept_id"):
-        conditions.append(f"c.condition_concept_id = {extra['condition_concept_id']}")
+        filters.append(condition_filter(extra["condition_concept_id"], params))
     elif intent.condition:
-        # 如果没有 concept_id，尝试使用条件名称映射
-        # 这里简化处理，实际应该查询 concept 表
-        cond_lower = intent.condition.lower()
-        concept_id = CONDITION_CONCEPT_MAP.get(cond_lower)
-        if concept_id:
-            conditions.append(f"c.condition_concept_id = {concept_id}")
-        else:
-            # 如果找不到映射，跳过条件过滤（或抛出错误）
-            pass
+        # 没有经过 resolve_concepts 时直接查概念索引
+        match = resolve_concept(intent.condition)
+        if match is None:
+            # 去掉条件过滤会变成全表计数，给出错误结果；直接报错
+            raise ValueError(f"Unknown condition '{intent.condition}': no OMOP concept found")
+        filters.append(condition_filter(match["concept_id"], params))
 
     # -----------------------
     # 2）时间窗口 - 使用 condition_start_date
     # -----------------------
     if intent.time_window_start and intent.time_window_end:
-        conditions.append(
-            f"c.condition_start_date BETWEEN '{intent.time_window_start}' AND '{intent.time_window_end}'"
-        )
+        # [start, end + 1 天)：等价于 BETWEEN start AND end，但 condition_start_date 为时间戳时也不漏掉最后一天
+        params["time_window_start"] = _date_param(intent.time_window_start, "time_window_start")
+        params["time_window_end_excl"] = _date_param(intent.time_window_end, "time_window_end") + timedelta(days=1)
+        filters.append("time_window")
 
     # -----------------------
     # 3）性别 - 使用 gender_concept_id
@@ -71,13 +112,15 @@ def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any]
     if demo_filters:
         gender_concept_id = demo_filters.get("gender_concept_id")
         if gender_concept_id:
-            conditions.append(f"p.gender_concept_id = {gender_concept_id}")
+            params["gender_concept_id"] = int(gender_concept_id)
+            filters.append("gender")
         elif demo_filters.get("gender"):
             # 如果没有 concept_id，使用默认映射
             gender = demo_filters["gender"]
             gender_id = GENDER_CONCEPT_MAP.get(gender.upper() if isinstance(gender, str) else str(gender).upper())
             if gender_id:
-                conditions.append(f"p.gender_concept_id = {gender_id}")
+                params["gender_concept_id"] = gender_id
+                filters.append("gender")
 
     # -----------------------
     # 4）年龄段
@@ -87,12 +130,12 @@ def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any]
         current_year = date.today().year
 
         if low is not None:
-            birth_year_high = current_year - low
-            conditions.append(f"p.year_of_birth <= {birth_year_high}")
+            params["birth_year_max"] = current_year - int(low)
+            filters.append("birth_year_max")
 
         if high is not None:
-            birth_year_low = current_year - high
-            conditions.append(f"p.year_of_birth >= {birth_year_low}")
+            params["birth_year_min"] = current_year - int(high)
+            filters.append("birth_year_min")
 
     # -----------------------
     # 5）住院/门诊 - 需要 JOIN visit_occurrence 表
@@ -102,104 +145,506 @@ def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any]
         # conditions.append(f"v.visit_type_concept_id = ...")
         pass
 
-    return conditions
+    return tuple(filters), params
+
+def build_where_clauses(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    根据 intent 构造 WHERE + JOIN 的过滤条件
+    Returns:
+        (条件列表, 绑定参数)
+    """
+    filters, params = build_filters(intent, extra_fields)
+    return [_CLAUSES[f] for f in filters], params
 
 
 # =====================================================
-# SQL 模板：Count
+# SQL 模板
 # =====================================================
 
-def generate_count_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> str:
-    where_clauses = build_where_clauses(intent, extra_fields)
-    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
-
-    sql = f"""
+_TEMPLATES = {
+    # Count
+    "count": """
     SELECT COUNT(*) AS count
     FROM condition_occurrence c
     JOIN person p ON p.person_id = c.person_id
-    WHERE {where_sql}
-    """
-    return sql.strip()
+    WHERE {where}
+    """,
+    # Trend（按年 / 月）
+    "trend": """
+    SELECT {group_expr} AS period,
+           COUNT(*) AS count
+    FROM condition_occurrence c
+    JOIN person p ON p.person_id = c.person_id
+    WHERE {where}
+    GROUP BY period
+    ORDER BY period
+    """,
+    # Distribution (年龄/性别)
+    "distribution": """
+    SELECT p.gender_concept_id,
+           COUNT(*) AS count
+    FROM condition_occurrence c
+    JOIN person p ON p.person_id = c.person_id
+    WHERE {where}
+    GROUP BY p.gender_concept_id
+    """,
+}
+
+# 模板按 PostgreSQL 语法书写（EXTRACT / TO_CHAR），由 transpile_sql 转译到实际方言
+# （SQLite: STRFTIME，DuckDB: STRFTIME / EXTRACT）
+_GROUP_EXPR = {
+    "year": "EXTRACT(YEAR FROM {date})",
+    "month": "TO_CHAR({date}, 'YYYY-MM')",
+}
 
 
 # =====================================================
-# SQL 模板：Trend（按年）
+# 多维分组 / 对比组：一次扫描 condition_occurrence
 # =====================================================
+# group_by 有多个维度时按全部维度（最细粒度）GROUP BY 一次，各维度小计与总计在整理结果时
+# 由细格相加得到（见 executor._tidy_grouped）：计数可加，结果与 GROUPING SETS 相同，
+# 而 SQLite 等不支持 GROUPING SETS 的库也能执行。
+# compare 的 N 个对比组用条件聚合（COUNT(CASE WHEN 组条件 THEN 1 END)）在同一次扫描中计数，
+# 组条件的绑定参数加 _<组序号> 后缀
+
+# 维度名 -> 分组表达式（{date} 为日期列）；维度名同时是结果列名
+_DIMENSIONS = {
+    "gender": "p.gender_concept_id",
+    "year": _GROUP_EXPR["year"],
+    "month": _GROUP_EXPR["month"],
+    # 10 岁一档，按参考年份（绑定参数，当前年份）计算年龄，与 age_range 过滤口径一致
+    "age_group": "(:age_reference_year - p.year_of_birth) - ((:age_reference_year - p.year_of_birth) % 10)",
+}
+_DIMENSION_ALIASES = {"sex": "gender", "age": "age_group"}
 
-def generate_trend_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> str:
-    where_clauses = build_where_clauses(intent, extra_fields)
-    where_sql = " AND ".join(where_clauses)
-
-    group_unit = intent.group_by[0] if intent.group_by else "year"
-
-    # PostgreSQL 使用 EXTRACT 或 TO_CHAR，SQLite 使用 strftime
-    # 这里使用 PostgreSQL 兼容的语法
-    if group_unit == "year":
-        group_expr = "EXTRACT(YEAR FROM c.condition_start_date)"
-    elif group_unit == "month":
-        group_expr = "TO_CHAR(c.condition_start_date, 'YYYY-MM')"
-    else:
-        group_expr = "EXTRACT(YEAR FROM c.condition_start_date)"
-
-    sql = f"""
-    SELECT {group_expr} AS period,
+_SCAN_TEMPLATES = {
+    # 多维分组（任意维度组合）
+    "grouped": """
+    SELECT {dims},
            COUNT(*) AS count
     FROM condition_occurrence c
     JOIN person p ON p.person_id = c.person_id
-    WHERE {where_sql}
+    WHERE {where}
+    GROUP BY {keys}
+    ORDER BY {keys}
+    """,
+    # 对比组（条件聚合）
+    "compare": """
+    SELECT {arms}
+    FROM condition_occurrence c
+    JOIN person p ON p.person_id = c.person_id
+    WHERE ({any_arm}) AND {where}
+    """,
+}
+
+def dimensions(group_by: Optional[list]) -> Tuple[str, ...]:
+    """规范化 group_by：去掉未知维度与重复维度，时间维度（year / month）只保留第一个"""
+    dims: List[str] = []
+    for g in group_by or []:
+        d = str(g).strip().lower()
+        d = _DIMENSION_ALIASES.get(d, d)
+        if d not in _DIMENSIONS or d in dims or (d in _GROUP_EXPR and any(x in _GROUP_EXPR for x in dims)):
+            continue
+        dims.append(d)
+    return tuple(dims)
+
+def _arm_clause(key: str, i: int) -> str:
+    """第 i 个对比组的条件片段（绑定参数名加 _i 后缀）"""
+    return _PARAM_RE.sub(lambda m: f":{m.group(1)}_{i}", _CLAUSES[key])
+
+
+# =====================================================
+# 立方体模板（feasibility_cube，见 poc/db/feasibility_cube.py）
+# =====================================================
+# 同样的过滤条件键与绑定参数，改为对预聚合的记录数求和；
+# 立方体按月聚合，时间窗口必须按月对齐（start 为月初、end 为月末）才能改写
+
+_CUBE_CLAUSES = {
+    "condition": _CLAUSES["condition"],
+    "condition_in": _CLAUSES["condition_in"],
+    "condition_set": _CLAUSES["condition_set"],
+    "time_window": "c.month_start >= :time_window_start AND c.month_start < :time_window_end_excl",
+    "gender": "c.gender_concept_id = :gender_concept_id",
+    "birth_year_max": "c.year_of_birth <= :birth_year_max",
+    "birth_year_min": "c.year_of_birth >= :birth_year_min",
+}
+
+_CUBE_TEMPLATES = {
+    "count": f"""
+    SELECT CAST(COALESCE(SUM(c.n), 0) AS BIGINT) AS count
+    FROM {CUBE_TABLE} c
+    WHERE {{where}}
+    """,
+    "trend": f"""
+    SELECT {{group_expr}} AS period,
+           CAST(SUM(c.n) AS BIGINT) AS count
+    FROM {CUBE_TABLE} c
+    WHERE {{where}}
     GROUP BY period
     ORDER BY period
-    """
-    return sql.strip()
+    """,
+    "distribution": f"""
+    SELECT c.gender_concept_id,
+           CAST(SUM(c.n) AS BIGINT) AS count
+    FROM {CUBE_TABLE} c
+    WHERE {{where}}
+    GROUP BY c.gender_concept_id
+    """,
+}
 
+# =====================================================
+# 抽样模板（近似模式，feasibility_sample，见 poc/db/feasibility_sample.py）
+# =====================================================
+# 过滤条件与基础表相同（抽样表保留 condition_occurrence 的同名列，人员属性 JOIN person）；
+# 先按 person_id 汇总每人的记录数 n，再对每个分组返回 Σn、Σn²、人数，由 estimate_rows 放大并给出置信区间
+
+_SAMPLE_TEMPLATES = {
+    "count": f"""
+    SELECT SUM(s.n) AS count, SUM(s.n * s.n) AS count_sq, COUNT(*) AS count_persons
+    FROM (
+        SELECT c.person_id, COUNT(*) AS n
+        FROM {SAMPLE_TABLE} c
+        JOIN person p ON p.person_id = c.person_id
+        WHERE {{where}}
+        GROUP BY c.person_id
+    ) s
+    """,
+    "trend": f"""
+    SELECT s.period, SUM(s.n) AS count, SUM(s.n * s.n) AS count_sq, COUNT(*) AS count_persons
+    FROM (
+        SELECT {{group_expr}} AS period, c.person_id, COUNT(*) AS n
+        FROM {SAMPLE_TABLE} c
+        JOIN person p ON p.person_id = c.person_id
+        WHERE {{where}}
+        GROUP BY period, c.person_id
+    ) s
+    GROUP BY s.period
+    ORDER BY s.period
+    """,
+    "distribution": f"""
+    SELECT s.gender_concept_id, SUM(s.n) AS count, SUM(s.n * s.n) AS count_sq, COUNT(*) AS count_persons
+    FROM (
+        SELECT p.gender_concept_id, c.person_id, COUNT(*) AS n
+        FROM {SAMPLE_TABLE} c
+        JOIN person p ON p.person_id = c.person_id
+        WHERE {{where}}
+        GROUP BY p.gender_concept_id, c.person_id
+    ) s
+    GROUP BY s.gender_concept_id
+    """,
+    "grouped": f"""
+    SELECT {{outer_keys}}, SUM(s.n) AS count, SUM(s.n * s.n) AS count_sq, COUNT(*) AS count_persons
+    FROM (
+        SELECT {{dims}}, c.person_id, COUNT(*) AS n
+        FROM {SAMPLE_TABLE} c
+        JOIN person p ON p.person_id = c.person_id
+        WHERE {{where}}
+        GROUP BY {{keys}}, c.person_id
+    ) s
+    GROUP BY {{outer_keys}}
+    ORDER BY {{outer_keys}}
+    """,
+    "compare": f"""
+    SELECT {{arm_sums}}
+    FROM (
+        SELECT c.person_id, {{arms}}
+        FROM {SAMPLE_TABLE} c
+        JOIN person p ON p.person_id = c.person_id
+        WHERE ({{any_arm}}) AND {{where}}
+        GROUP BY c.person_id
+    ) s
+    """,
+}
 
 # =====================================================
-# SQL 模板：Distribution (年龄/性别)
+# Parquet 抽取（DuckDB，见 poc/db/parquet_extract.py）
 # =====================================================
+# 模板与基础表相同（DuckDB 中 condition_occurrence / person 是 Parquet 上的视图），转译到 duckdb 方言；
+# 时间窗口另加分区列 start_year 上的条件，DuckDB 据此只读取相关年份的分区。
+# concept_set_member 不在抽取中，半连接的条件留在事务库
+
+_EXTRACT_CLAUSES = {k: v for k, v in _CLAUSES.items() if k != "condition_set"}
+_EXTRACT_CLAUSES["time_window"] = (
+    _CLAUSES["time_window"]
+    + f" AND c.{PARTITION_COLUMN} >= :time_window_start_year AND c.{PARTITION_COLUMN} <= :time_window_end_year"
+)
+
+# 数据来源 -> (模板, 过滤条件片段, 日期列)
+_SOURCES = {
+    "base": ({**_TEMPLATES, **_SCAN_TEMPLATES}, _CLAUSES, "c.condition_start_date"),
+    "cube": (_CUBE_TEMPLATES, _CUBE_CLAUSES, "c.month_start"),
+    "sample": (_SAMPLE_TEMPLATES, _CLAUSES, "c.condition_start_date"),
+    "extract": ({**_TEMPLATES, **_SCAN_TEMPLATES}, _EXTRACT_CLAUSES, "c.condition_start_date"),
+}
 
-def generate_distribution_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> str:
-    where_clauses = build_where_clauses(intent, extra_fields)
-    where_sql = " AND ".join(where_clauses)
 
-    sql = f"""
-    SELECT p.gender_concept_id,
-           COUNT(*) AS count
+class SQLTemplate(NamedTuple):
+    """某个查询形状编译后的参数化 SQL"""
+    shape: Tuple[str, Tuple[str, ...], Any]   # (模板, 过滤条件键, 分组)
+    dialect: str    # sqlglot 方言名
+    source: str     # 数据来源：base（基础表）/ cube（feasibility_cube）/ sample（feasibility_sample，近似）/ extract（Parquet）
+    sql: str        # 转译到该方言的参数化 SQL（执行、审计、重放共用同一文本）
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(template: str, filters: Tuple[str, ...], grouping: Any = None,
+                     dialect: str = "postgres", source: str = "base") -> SQLTemplate:
+    """
+    构建并转译一个查询形状（按 (形状, 方言, 来源) 进程内缓存）：形状数量很少（模板 × 过滤条件组合 × 分组），
+    每个形状只拼接 / 转译一次，之后每个请求只是一次字典查找 + 参数绑定
+    :param grouping: trend 的时间单位；grouped 的维度元组；compare 的各组条件键元组（condition_filter）
+    """
+    templates, clauses, date_col = _SOURCES[source]
+    where_sql = " AND ".join(clauses[f] for f in filters) if filters else "1=1"
+    fmt = {"where": where_sql}
+    if template == "trend":
+        fmt["group_expr"] = _GROUP_EXPR[grouping].format(date=date_col)
+    elif template == "grouped":
+        fmt["dims"] = ", ".join(f"{_DIMENSIONS[d].format(date=date_col)} AS {d}" for d in grouping)
+        fmt["keys"] = ", ".join(grouping)
+        fmt["outer_keys"] = ", ".join(f"s.{d}" for d in grouping)
+    elif template == "compare":
+        arms = [_arm_clause(key, i) for i, key in enumerate(grouping)]
+        fmt["arms"] = ",\n           ".join(f"COUNT(CASE WHEN {a} THEN 1 END) AS arm_{i}" for i, a in enumerate(arms))
+        fmt["any_arm"] = " OR ".join(arms)
+        fmt["arm_sums"] = ",\n           ".join(
+            f"SUM(s.arm_{i}) AS arm_{i}, SUM(s.arm_{i} * s.arm_{i}) AS arm_{i}_sq, "
+            f"COUNT(CASE WHEN s.arm_{i} > 0 THEN 1 END) AS arm_{i}_persons"
+            for i in range(len(arms))
+        )
+    sql = templates[template].format(**fmt)
+    return SQLTemplate((template, filters, grouping), dialect, source, transpile_sql(sql, write=dialect))
+
+def cube_template(tpl: SQLTemplate, params: Dict[str, Any]) -> Tuple[Optional[SQLTemplate], Optional[str]]:
+    """
+    把基础表模板改写为立方体模板（绑定参数不变）
+    Returns:
+        (立方体模板, None)；不能改写时返回 (None, 原因)
+    """
+    template, filters, grouping = tpl.shape
+    if template not in _CUBE_TEMPLATES:
+        return None, "template_not_covered"
+    if any(f not in _CUBE_CLAUSES for f in filters):
+        return None, "filter_not_covered"
+    if "time_window" in filters and (params["time_window_start"].day != 1 or params["time_window_end_excl"].day != 1):
+        return None, "time_window_not_month_aligned"
+    return compile_template(template, filters, grouping, tpl.dialect, "cube"), None
+
+def sample_template(tpl: SQLTemplate) -> SQLTemplate:
+    """把基础表模板改写为抽样模板（近似模式；绑定参数不变，全部模板与过滤条件都可改写）"""
+    template, filters, grouping = tpl.shape
+    return compile_template(template, filters, grouping, tpl.dialect, "sample")
+
+def extract_template(tpl: SQLTemplate, params: Dict[str, Any]) -> Tuple[Optional[SQLTemplate], Optional[str]]:
+    """
+    把基础表模板改写为 Parquet 抽取上的 duckdb 方言模板；有时间窗口时向 params 补充分区裁剪用的年份参数
+    Returns:
+        (抽取模板, None)；不能改写时返回 (None, 原因)
+    """
+    template, filters, grouping = tpl.shape
+    if any(f not in _EXTRACT_CLAUSES for f in filters):
+        return None, "filter_not_covered"
+    if "time_window" in filters:
+        params["time_window_start_year"] = params["time_window_start"].year
+        params["time_window_end_year"] = (params["time_window_end_excl"] - timedelta(days=1)).year
+    return compile_template(template, filters, grouping, "duckdb", "extract"), None
+
+def template_stats() -> Dict[str, Any]:
+    """模板缓存命中情况"""
+    info = compile_template.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "shapes": info.currsize}
+
+
+
+# =====================================================
+# 人群（person_id 集合）模板：cohort / compare 任务，见 cohort_cache.py
+# =====================================================
+# 过滤条件拆成相互独立的部件，每个部件是一个可单独缓存的 person_id 集合，
+# 人群 = 各部件集合的交集。诊断与时间窗口作用于同一条诊断记录，必须放在同一部件里；
+# 性别 / 出生年是人的属性，单独成部件，钻取（如再限定女性）时可以复用已缓存的集合
+
+_COHORT_PARTS = (
+    # (部件名, 包含的过滤条件键, SQL)
+    ("occurrence", ("condition", "condition_in", "condition_set", "time_window"),
+     "SELECT DISTINCT c.person_id FROM condition_occurrence c WHERE {where}"),
+    ("gender", ("gender",), "SELECT p.person_id FROM person p WHERE {where}"),
+    ("birth_year", ("birth_year_max", "birth_year_min"), "SELECT p.person_id FROM person p WHERE {where}"),
+)
+# 没有任何过滤条件时的人群：全部人员
+_COHORT_ALL = "SELECT p.person_id FROM person p"
+# compare：各组的诊断部件一次扫描，每人一行、每组一列标记（是否有该组的诊断记录）
+_COHORT_ARMS = """
+    SELECT c.person_id,
+           {flags}
     FROM condition_occurrence c
-    JOIN person p ON p.person_id = c.person_id
-    WHERE {where_sql}
-    GROUP BY p.gender_concept_id
+    WHERE ({any_arm}) AND {where}
+    GROUP BY c.person_id
+"""
+_CONDITION_KEYS = ("condition", "condition_in", "condition_set")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_cohort_part(part: str, filters: Tuple[str, ...], dialect: str = "postgres") -> Tuple[str, Tuple[str, ...]]:
+    """
+    构建并转译一个人群部件（进程内缓存）
+    Returns:
+        (person_id 查询 SQL, 用到的绑定参数名)
+    """
+    if part == "all":
+        return transpile_sql(_COHORT_ALL, write=dialect), ()
+    sql = next(tpl for name, _, tpl in _COHORT_PARTS if name == part)
+    where_sql = " AND ".join(_CLAUSES[f] for f in filters)
+    return transpile_sql(sql.format(where=where_sql), write=dialect), tuple(_PARAM_RE.findall(where_sql))
+
+def cohort_parts(tpl: SQLTemplate, params: Dict[str, Any]) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    把一个查询形状拆成人群部件
+    Returns:
+        [(部件名, person_id 查询 SQL, 该部件的绑定参数)]；人群 = 全部部件的交集
     """
-    return sql.strip()
+    _, filters, _ = tpl.shape
+    covered = {k for _, keys, _ in _COHORT_PARTS for k in keys}
+    if any(f not in covered for f in filters):
+        raise ValueError(f"Filters not supported for cohorts: {[f for f in filters if f not in covered]}")
+    parts = []
+    for name, keys, _ in _COHORT_PARTS:
+        own = tuple(f for f in filters if f in keys)
+        if own:
+            sql, names = compile_cohort_part(name, own, tpl.dialect)
+            parts.append((name, sql, {k: params[k] for k in names}))
+    if not parts:
+        sql, _ = compile_cohort_part("all", (), tpl.dialect)
+        parts.append(("all", sql, {}))
+    return parts
+
+@functools.lru_cache(maxsize=256)
+def compile_cohort_arms(keys: Tuple[str, ...], shared: Tuple[str, ...], dialect: str = "postgres") -> str:
+    """
+    构建并转译 compare 各组诊断部件的单次扫描（进程内缓存）
+    :param keys: 各组的条件键（绑定参数名加 _i 后缀，见 _arm_clause）
+    :param shared: 各组共用的诊断记录过滤条件键（时间窗口）
+    """
+    arms = [_arm_clause(key, i) for i, key in enumerate(keys)]
+    sql = _COHORT_ARMS.format(
+        flags=",\n           ".join(f"MAX(CASE WHEN {a} THEN 1 ELSE 0 END) AS arm_{i}" for i, a in enumerate(arms)),
+        any_arm=" OR ".join(arms),
+        where=" AND ".join(_CLAUSES[f] for f in shared) if shared else "1=1",
+    )
+    return transpile_sql(sql, write=dialect)
+
+def cohort_arm_scan(arms: List[Tuple[SQLTemplate, Dict[str, Any]]]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    compare 各组的诊断部件（cohort_parts 的 occurrence）合并成一条 SQL：一次扫描 condition_occurrence
+    得到全部组的 person_id，结果列 person_id, arm_0, arm_1, ...
+    Returns:
+        (SQL, 绑定参数)；各组除条件外的诊断记录过滤不一致时返回 None（逐组加载）
+    """
+    keys, shared, shared_params, params = [], None, None, {}
+    for i, (tpl, arm_params) in enumerate(arms):
+        _, filters, _ = tpl.shape
+        own = [f for f in filters if f in _CONDITION_KEYS]
+        rest = tuple(f for f in filters if f in _COHORT_PARTS[0][1] and f not in _CONDITION_KEYS)
+        rest_params = {k: arm_params[k] for f in rest for k in _PARAM_RE.findall(_CLAUSES[f])}
+        if len(own) != 1 or (shared is not None and (rest, rest_params) != (shared, shared_params)):
+            return None
+        shared, shared_params = rest, rest_params
+        keys.append(own[0])
+        params.update({f"{k}_{i}": arm_params[k] for k in _PARAM_RE.findall(_CLAUSES[own[0]])})
+    if len(keys) < 2:
+        return None
+    return compile_cohort_arms(tuple(keys), shared, arms[0][0].dialect), {**shared_params, **params}
+
+def _grouping(template: str, dims: Tuple[str, ...]) -> Tuple[str, Any]:
+    """
+    按 group_by 维度选择模板：
+    - trend：只有一个时间维度时用 trend 模板；还有其他维度时用 grouped（缺少时间维度则补 year）
+    - distribution：不分组或只按性别时用 distribution 模板
+    - 其余任务：有维度时用 grouped
+    Returns:
+        (模板, 分组)
+    """
+    if template == "trend":
+        if not any(d in _GROUP_EXPR for d in dims):
+            dims = ("year",) + dims
+        return ("trend", dims[0]) if len(dims) == 1 else ("grouped", dims)
+    if template == "distribution" and dims in ((), ("gender",)):
+        return "distribution", None
+    if dims:
+        return "grouped", dims
+    return template, None
+
+def _generate(template: str, intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None,
+              dialect: str = None) -> Tuple[SQLTemplate, Dict[str, Any]]:
+    filters, params = build_filters(intent, extra_fields)
+    template, grouping = _grouping(template, dimensions(intent.group_by))
+    if template == "grouped" and "age_group" in grouping:
+        params["age_reference_year"] = date.today().year
+    return compile_template(template, filters, grouping, dialect or sql_dialect()), params
+
+def _generate_compare(intent: FeasibilityIntent, extra_fields: Dict[str, Any],
+                      dialect: str = None) -> Tuple[SQLTemplate, Dict[str, Any]]:
+    """
+    compare：全部对比组一次扫描（条件聚合）
+    extra_fields["compare_arms"] 为对比组列表：条件名称，或 resolve_concepts 解析后的
+    {"arm", "condition_concept_id"}；其余过滤条件（时间窗口 / 性别 / 年龄）各组共用
+    """
+    shared = intent.model_copy(update={"condition": None})
+    filters, params = build_filters(shared, {k: v for k, v in extra_fields.items() if k != "condition_concept_id"})
+    keys = []
+    for i, arm in enumerate(extra_fields["compare_arms"]):
+        name, concept_id = (arm, None) if isinstance(arm, str) else (arm.get("arm"), arm.get("condition_concept_id"))
+        if not concept_id:
+            match = resolve_concept(name) if name else None
+            if match is None:
+                raise ValueError(f"Unknown condition '{name}': no OMOP concept found")
+            concept_id = match["concept_id"]
+        own: Dict[str, Any] = {}
+        keys.append(condition_filter(concept_id, own))
+        params.update({f"{k}_{i}": v for k, v in own.items()})
+    return compile_template("compare", filters, tuple(keys), dialect or sql_dialect()), params
+
+def generate_count_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> Tuple[str, Dict[str, Any]]:
+    tpl, params = _generate("count", intent, extra_fields)
+    return tpl.sql, params
+
+def generate_trend_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> Tuple[str, Dict[str, Any]]:
+    tpl, params = _generate("trend", intent, extra_fields)
+    return tpl.sql, params
+
+def generate_distribution_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> Tuple[str, Dict[str, Any]]:
+    tpl, params = _generate("distribution", intent, extra_fields)
+    return tpl.sql, params
 
 
 # =====================================================
 # 主函数：Intent → SQL
 # =====================================================
 
-def intent_to_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None) -> str:
+def intent_to_template(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None,
+                       dialect: str = None) -> Tuple[SQLTemplate, Dict[str, Any]]:
     """
-    根据 intent.task_type 或 operation_type 调用对应 SQL 模板
+    根据 intent.task_type 或 operation_type 选择 SQL 模板
     
     Args:
         intent: FeasibilityIntent 对象
         extra_fields: 包含额外字段的字典（如 condition_concept_id）
+        dialect: 目标 sqlglot 方言，默认为当前配置的数据库（sql_dialect()）
+    Returns:
+        (编译后的模板, 绑定参数)
     """
     
     # 优先使用 operation_type，如果没有则使用 task_type
     op_type = intent.operation_type or intent.task_type
     
-    if op_type == "count":
-        return generate_count_sql(intent, extra_fields)
-    
-    if op_type == "trend":
-        return generate_trend_sql(intent, extra_fields)
-    
-    if op_type == "distribution":
-        return generate_distribution_sql(intent, extra_fields)
+    if op_type == "compare" and len((extra_fields or {}).get("compare_arms") or []) > 1:
+        return _generate_compare(intent, extra_fields, dialect)
+
+    if op_type in _TEMPLATES:
+        return _generate(op_type, intent, extra_fields, dialect)
     
     if op_type == "select":
         # 通用查询，使用 count SQL 作为基础
-        return generate_count_sql(intent, extra_fields)
+        return _generate("count", intent, extra_fields, dialect)
     
     if op_type in ["insert", "update", "delete"]:
         # 这些操作类型需要在 intent 中提供更多信息
@@ -211,10 +656,18 @@ def intent_to_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None
     
     # 默认使用 count
     if op_type:
-        return generate_count_sql(intent, extra_fields)
+        return _generate("count", intent, extra_fields, dialect)
     
     raise ValueError(f"Unsupported task_type/operation_type: {op_type}")
 
+def intent_to_sql(intent: FeasibilityIntent, extra_fields: Dict[str, Any] = None,
+                  dialect: str = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Intent → (参数化 SQL, 绑定参数)，见 intent_to_template
+    """
+    tpl, params = intent_to_template(intent, extra_fields, dialect)
+    return tpl.sql, params
+
 
 # =====================================================
 # SQLGlot Risk Check & Dry-run
@@ -236,6 +689,52 @@ def analyze_risk(sql: str) -> str:
     return "low"
 
 
+# =====================================================
+# 微基准：每请求 SQL 生成开销
+# =====================================================
+
+def benchmark(n: int = 2000) -> Dict[str, float]:
+    """
+    对比每请求重新拼接 + 转译（无模板缓存）与模板缓存命中（字典查找 + 参数绑定）的耗时
+    Returns:
+        各路径的单次耗时（微秒）与加速比
+    """
+    import time
+
+    intents = [
+        FeasibilityIntent(task_type=task, condition="diabetes", time_window_start="2020-01-01",
+                          time_window_end="2023-01-01", demographic_filters={"gender": g})
+        for task in ("count", "trend", "distribution") for g in ("F", "M")
+    ]
+    extra = {"condition_concept_id": 201826}
+
+    def _run(fn) -> float:
+        t0 = time.perf_counter()
+        for i in range(n):
+            fn(intents[i % len(intents)], {**extra, "demographic_filters": intents[i % len(intents)].demographic_filters})
+        return (time.perf_counter() - t0) / n * 1e6
+
+    def _uncached(intent, extra_fields):
+        compile_template.cache_clear()
+        analyze_sql.cache_clear()
+        tpl, params = intent_to_template(intent, extra_fields)
+        return tpl.sql, params
+
+    def _cached(intent, extra_fields):
+        tpl, params = intent_to_template(intent, extra_fields)
+        return tpl.sql, params
+
+    uncached_us = _run(_uncached)
+    compile_template.cache_clear()
+    cached_us = _run(_cached)
+    return {
+        "uncached_us": round(uncached_us, 2),
+        "cached_us": round(cached_us, 2),
+        "speedup": round(uncached_us / cached_us, 1) if cached_us else 0.0,
+        **template_stats(),
+    }
+
+
 # =====================================================
 # 测试
 # =====================================================
@@ -251,9 +750,24 @@ if __name__ == "__main__":
         time_window_end="2023-01-01"
     )
 
-    sql = intent_to_sql(intent)
+    sql, params = intent_to_sql(intent)
     print("Generated SQL:")
     print(sql)
+    print(params)
 
     print("\nDry-run:")
     print(dry_run_sql(sql))
+
+    print("\nTrend SQL per dialect:")
+    trend = intent.model_copy(update={"task_type": "trend"})
+    for d in ("postgres", "sqlite", "duckdb"):
+        print(f"[{d}]", intent_to_sql(trend, dialect=d)[0])
+
+    print("\nGrouped (gender x year) / compare, one scan each:")
+    grouped = intent.model_copy(update={"group_by": ["gender", "year"]})
+    print(intent_to_sql(grouped)[0])
+    compare = intent.model_copy(update={"task_type": "compare", "condition": "diabetes vs hypertension"})
+    print(intent_to_sql(compare, {"compare_arms": ["diabetes", "hypertension"]}))
+
+    print("\nBenchmark (per request):")
+    print(benchmark())
@@ -1,9 +1,10 @@
 from langgraph.graph import StateGraph, END
 from typing import TypedDict, List, Dict, Any, Literal
-from poc.intent.parser import parse_intent, ParseContext
+from poc.intent.parser import parse_intent, parse_intent_async, ParseContext
 from poc.intent.schema import FeasibilityIntent
 from poc.plan.builder import build_plan
-from poc.execution.executor import execute_plan_steps
+from poc.execution.executor import execute_plan_steps, execute_plan_steps_async, prefetch_concepts
+from poc.utils.deadline import Deadline, DeadlineExceeded, deadline_scope
 import os
 
 class PipelineState(TypedDict, total=False):
@@ -15,15 +16,54 @@ class PipelineState(TypedDict, total=False):
     is_database_query: bool
     rejection_message: str
     sql: str
+    sql_params: Dict[str, Any]  # SQL 绑定参数（参数化查询，:name 占位符）
     risk_assessment: Dict[str, Any]
     needs_user_confirmation: bool
     snapshot_id: str
     execution_confirmed: bool
+    deadline_at: float          # 请求级 deadline（time.monotonic 时间点），None 表示不限时
+    intent_meta: Dict[str, Any]  # 意图来源（cache / llm）、缓存命中、模型与采样参数
+    timed_out: bool
+    approximate: bool           # 近似模式（读抽样表，返回估计值与置信区间）；默认精确
+
+def _deadline(state: PipelineState) -> Deadline:
+    return Deadline(state.get("deadline_at"))
+
+def _on_intent_field(key: str, value: Any):
+    # 流式解析：condition 字段一完成就预取概念，不等整个 JSON 结束
+    if key == "condition":
+        prefetch_concepts(value)
 
 def node_intent(state: PipelineState) -> PipelineState:
     """解析用户意图，检测是否为数据库查询"""
     ctx = ParseContext(omop_version=os.getenv("OMOP_VERSION", "OMOP1"))
-    intent = parse_intent(state["user_input"], ctx)
+    state["intent_meta"] = {}
+    try:
+        with deadline_scope(_deadline(state)):
+            intent = parse_intent(state["user_input"], ctx, audit=state["intent_meta"], on_field=_on_intent_field)
+    except DeadlineExceeded as e:
+        return _apply_intent_timeout(state, e)
+    return _apply_intent(state, intent)
+
+async def anode_intent(state: PipelineState) -> PipelineState:
+    """node_intent 的异步版本"""
+    ctx = ParseContext(omop_version=os.getenv("OMOP_VERSION", "OMOP1"))
+    state["intent_meta"] = {}
+    try:
+        with deadline_scope(_deadline(state)):
+            intent = await parse_intent_async(state["user_input"], ctx, audit=state["intent_meta"], on_field=_on_intent_field)
+    except DeadlineExceeded as e:
+        return _apply_intent_timeout(state, e)
+    return _apply_intent(state, intent)
+
+def _apply_intent_timeout(state: PipelineState, error: Exception) -> PipelineState:
+    # 意图解析超时：不再进入计划 / 执行
+    state["timed_out"] = True
+    state["is_database_query"] = False
+    state["summary"] = f"请求超时：{error}"
+    return state
+
+def _apply_intent(state: PipelineState, intent: FeasibilityIntent) -> PipelineState:
     intent_dict = intent.model_dump()
     state["intent"] = intent_dict
     state["is_database_query"] = intent_dict.get("is_database_query", True)
@@ -52,22 +92,47 @@ def node_plan(state: PipelineState) -> PipelineState:
 def node_execute(state: PipelineState) -> PipelineState:
     """执行计划步骤，包括风险评估和用户确认"""
     audit_steps: List[Dict[str, Any]] = []
-    ctx = execute_plan_steps(
+    execute_plan_steps(
         plan=state["plan"], 
         intent=state["intent"], 
         audit_steps=audit_steps,
         user_confirmed=state.get("execution_confirmed", False),
-        snapshot_id=state.get("snapshot_id")
+        snapshot_id=state.get("snapshot_id"),
+        deadline=_deadline(state),
+        approximate=state.get("approximate", False),
     )
+    return _apply_execution(state, audit_steps)
+
+async def anode_execute(state: PipelineState) -> PipelineState:
+    """node_execute 的异步版本"""
+    audit_steps: List[Dict[str, Any]] = []
+    await execute_plan_steps_async(
+        plan=state["plan"],
+        intent=state["intent"],
+        audit_steps=audit_steps,
+        user_confirmed=state.get("execution_confirmed", False),
+        snapshot_id=state.get("snapshot_id"),
+        deadline=_deadline(state),
+        approximate=state.get("approximate", False),
+    )
+    return _apply_execution(state, audit_steps)
+
+def _apply_execution(state: PipelineState, audit_steps: List[Dict[str, Any]]) -> PipelineState:
     state["execution_dag"] = audit_steps
+    state["timed_out"] = any(step.get("status") == "timeout" for step in audit_steps)
     
     # 提取 SQL 和风险信息
     for step in audit_steps:
         if step.get("action") == "generate_sql" and step.get("status") == "success":
             state["sql"] = step.get("outputs", {}).get("sql", "")
+            state["sql_params"] = step.get("outputs", {}).get("params", {})
+        if step.get("action") == "build_cohort" and step.get("status") == "success" and not state.get("sql"):
+            # 人群后端：每个部件一条 person_id 查询
+            state["sql"] = ";\n".join(part["sql"] for part in step.get("outputs", {}).get("parts", []))
         if step.get("action") == "run_dry_run" and step.get("status") == "success":
             state["risk_assessment"] = step.get("outputs", {}).get("risk", {})
             state["needs_user_confirmation"] = step.get("outputs", {}).get("risk", {}).get("needs_approval", False)
+        if step.get("action") == "create_snapshot" and step.get("status") == "success":
             if step.get("outputs", {}).get("snapshot_id"):
                 state["snapshot_id"] = step.get("outputs", {}).get("snapshot_id")
     
@@ -78,6 +143,8 @@ def node_execute(state: PipelineState) -> PipelineState:
             outputs = s.get("outputs", {})
             state["summary"] = outputs.get("summary", "No summary available")
             break
+    if state["timed_out"] and state["summary"] == "No summary available":
+        state["summary"] = "请求超时：部分步骤未在 deadline 内完成"
     
     return state
 
@@ -88,11 +155,15 @@ def should_continue(state: PipelineState) -> Literal["end", "execute"]:
         return "end"
     return "execute"
 
-def build_graph():
+def build_graph(async_mode: bool = False):
+    """
+    构建 LangGraph 流水线
+    :param async_mode: True 时 intent / execute 使用异步节点，需通过 graph.ainvoke 调用
+    """
     graph = StateGraph(PipelineState)
-    graph.add_node("intent", node_intent)
+    graph.add_node("intent", anode_intent if async_mode else node_intent)
     graph.add_node("plan", node_plan)
-    graph.add_node("execute", node_execute)
+    graph.add_node("execute", anode_execute if async_mode else node_execute)
 
     graph.set_entry_point("intent")
     
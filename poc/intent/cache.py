@@ -0,0 +1,156 @@
+"""
+意图缓存（parse_intent 之前）
+
+- 键：规范化问题文本 + omop_version + 模型名 + prompt 中嵌入的日期（TODAY）+ 采样参数
+  （日期变化时相对时间表达式"去年/过去半年"的解析结果会变，必须进入键）
+- 内存层：LRU + TTL
+- 磁盘层：INTENT_CACHE_DIR 下每个条目一个 JSON 文件，进程重启后仍然有效
+- 只缓存解析成功的 FeasibilityIntent（model_dump 后的 dict）
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from poc.db.config import settings
+
+_WS_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = " \t\r\n.。?？!！"
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题文本：NFKC（全角转半角）、小写、合并空白、去掉结尾标点"""
+    q = unicodedata.normalize("NFKC", question or "")
+    q = _WS_RE.sub(" ", q.lower()).strip()
+    return q.rstrip(_TRAILING_PUNCT)
+
+
+class IntentCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 86400, disk_dir: Optional[str] = None):
+        """
+        :param max_entries: 内存层最大条目数（LRU 淘汰）
+        :param ttl_seconds: 条目存活时间（秒），0 表示不过期
+        :param disk_dir: 磁盘层目录，None 表示只使用内存层
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(
+        question: str,
+        omop_version: str,
+        model: str,
+        prompt_date: str,
+        sampling: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        payload = json.dumps(
+            [normalize_question(question), omop_version, model, prompt_date, sampling or {}],
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return bool(self.ttl_seconds) and time.time() - entry["created_at"] > self.ttl_seconds
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """返回 (intent dict, tier)；未命中时返回 (None, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._entries.pop(key, None)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["memory_hits"] += 1
+                return dict(entry["intent"]), "memory"
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                entry = None
+            if entry is not None and self._expired(entry):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self._insert(key, entry)
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                return dict(entry["intent"]), "disk"
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None, None
+
+    def put(self, key: str, intent: Dict[str, Any], meta: Optional[Dict[str, Any]] = None):
+        """
+        :param meta: 随条目保存的附加信息（原始问题、模型等），便于排查
+        """
+        entry = {"created_at": time.time(), "intent": intent, "meta": meta or {}}
+        with self._lock:
+            self._insert(key, entry)
+            self._stats["puts"] += 1
+        if self.disk_dir:
+            tmp = self._disk_path(key) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False, default=str)
+            os.replace(tmp, self._disk_path(key))
+
+    def _insert(self, key: str, entry: Dict[str, Any]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["size"] = len(self._entries)
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+        return out
+
+
+_CACHE: Optional[IntentCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_intent_cache() -> IntentCache:
+    """获取进程内共享的意图缓存（配置来自 poc.db.config.Settings）"""
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = IntentCache(
+                    max_entries=settings.INTENT_CACHE_MAX_ENTRIES,
+                    ttl_seconds=settings.INTENT_CACHE_TTL,
+                    disk_dir=settings.INTENT_CACHE_DIR or None,
+                )
+    return _CACHE
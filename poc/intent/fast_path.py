@@ -0,0 +1,307 @@
+"""
+规则快速路径：不调用 LLM，直接把简单问题解析为 FeasibilityIntent
+
+覆盖范围（中英文）：
+- 任务：count / trend / distribution（按性别）；趋势同时按性别时 group_by 为 [year|month, gender]
+- 已知疾病（能映射到 concept_id 的条件及其同义词）
+- 年份范围（2020-2024 / between 2020 and 2024 / 2020年到2024年 / in 2021）
+- 性别、年龄段
+
+识别出的片段从问题中剔除后，只要还剩未解释的词（填充词除外）就放弃快速路径，交给 LLM：
+规则只认识有限的词，剩下的词很可能是改变语义的限定（"gestational diabetes"、"died"、"in Beijing"）；
+疾病同义词前紧挨着未知的词（"type 1 diabetes"、"妊娠糖尿病"）同样放弃，不把它当作已知疾病；
+出现对比、相对时间、药物、就诊类型、否定等规则无法表达的信号时也直接交给 LLM
+"""
+import re
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple
+
+from .schema import FeasibilityIntent
+from poc.vocab.concept_index import CONDITION_CONCEPT_MAP
+
+# 已知疾病：规范名（CONDITION_CONCEPT_MAP 中的键）-> 同义词
+CONDITION_SYNONYMS = {
+    "type 2 diabetes": [
+        "type 2 diabetes mellitus", "type ii diabetes", "type 2 diabetes", "t2dm", "t2d",
+        "diabetes mellitus", "diabetes", "diabetic",
+        "2型糖尿病", "二型糖尿病", "糖尿病",
+    ],
+    "hypertension": [
+        "high blood pressure", "hypertensive", "hypertension", "htn",
+        "高血压病", "高血压",
+    ],
+}
+
+# 规则无法表达的信号：命中即放弃快速路径
+_BAIL_PATTERNS = [
+    ("compare", [r"\bcompare[sd]?\b", r"\bvs\.?(?=\s|$)", r"\bversus\b", "比较", "对比"]),
+    ("relative time", [
+        r"\blast\b", r"\bpast\b", r"\brecent(?:ly)?\b", r"\bthis (?:year|month)\b", r"\bsince\b",
+        r"\bago\b", "去年", "今年", "过去", "最近", r"近\s*\d+\s*[年月]", "半年",
+    ]),
+    ("aggregate", [r"\baverage\b", r"\bmean\b", r"\bmedian\b", r"\bsum\b", r"\brate\b", "平均", "比例", "发病率"]),
+    ("write", [r"\b(?:insert|update|delete|remove|drop|add|modify)\b", "删除", "添加", "更新", "修改", "插入"]),
+    ("drug / procedure", [
+        r"\b(?:drugs?|medications?|taking|prescribed|treated|surgery|procedures?)\b",
+        "用药", "服用", "药物", "手术",
+    ]),
+    ("visit", [
+        r"\b(?:inpatients?|outpatients?|hospitali[sz](?:ed|ation)|admitted|admissions?|visits?|emergency)\b",
+        "住院", "门诊", "急诊", "就诊",
+    ]),
+    ("negation", [r"\bwithout\b", r"\bnot\b", r"\bno\b", r"\bexcept\b", "没有", "未", "不", "除了"]),
+    ("cohort", [r"\bcohort\b", "队列"]),
+]
+
+_TREND_PATTERNS = [
+    r"\btrends?\b", r"\bover time\b", r"\b(?:per|each|every|by) (?:year|month)\b",
+    r"\byearly\b", r"\bmonthly\b", r"\bannual(?:ly)?\b",
+    "趋势", "逐年", "每年", "按年", "每月", "按月", "变化",
+]
+_MONTH_PATTERNS = [r"\b(?:per|each|every|by) month\b", r"\bmonthly\b", "每月", "按月"]
+_DISTRIBUTION_PATTERNS = [r"\bdistribution\b", r"\bbreak\s*down\b", r"\bbroken down\b", "分布", "构成"]
+_COUNT_PATTERNS = [r"\bhow many\b", r"\bnumber of\b", r"\bcount\b", r"\btotal\b", "多少", "几", "人数", "数量", "统计"]
+
+# 性别 + 时间两个维度（"by gender and year"），先于单个维度识别
+_GENDER_TIME_DIMENSION = [
+    r"\b(?:by|across) (?:gender|sex) and (?:year|month)s?\b", r"\bby (?:year|month)s? and (?:gender|sex)\b",
+]
+_GENDER_DIMENSION = [r"\b(?:by|across) (?:gender|sex)\b", r"\b(?:gender|sex)\b", "按性别", "分性别", "性别"]
+_UNSUPPORTED_DIMENSION = [r"\bby age\b", r"\bage (?:group|distribution|band)s?\b", "年龄分布", "按年龄", "年龄段"]
+
+_YEAR_RANGE_PATTERNS = [
+    r"\b(?:between|from)\s+(\d{4})\s+(?:and|to|through|until)\s+(\d{4})\b",
+    r"(\d{4})\s*年?\s*(?:到|至|-|–|—|~)\s*(\d{4})\s*年?",
+]
+_SINGLE_YEAR_PATTERNS = [r"\b(?:in|during)\s+(\d{4})\b", r"(\d{4})\s*年"]
+
+_AGE_RANGE_PATTERNS = [
+    r"\baged?\s+(\d{1,3})\s*(?:-|–|to|and)\s*(\d{1,3})(?:\s+years?(?:\s+old)?)?",
+    r"\bbetween\s+(\d{1,3})\s+and\s+(\d{1,3})\s+years?(?:\s+old)?",
+    r"(\d{1,3})\s*[-~到至]\s*(\d{1,3})\s*岁",
+]
+_AGE_MIN_PATTERNS = [
+    r"\b(?:aged\s+)?(?:over|above|older than)\s+(\d{1,3})(?:\s+years?(?:\s+old)?)?",
+    r"\b(?:aged\s+)?(\d{1,3})\s*(?:\+|years?(?:\s+old)?\s+and\s+(?:older|over|above))",
+    r"(?:大于|超过)\s*(\d{1,3})\s*岁", r"(\d{1,3})\s*岁以上",
+]
+_AGE_MAX_PATTERNS = [
+    r"\b(?:aged\s+)?(?:under|below|younger than)\s+(\d{1,3})(?:\s+years?(?:\s+old)?)?",
+    r"(?:小于|低于)\s*(\d{1,3})\s*岁", r"(\d{1,3})\s*岁以下",
+]
+_AGE_KEYWORDS = [
+    ([r"\bchildren\b", r"\bkids?\b", r"\bpediatric\b", "儿童", "小孩"], [0, 14]),
+    ([r"\badults?\b", "成年人"], [18, 65]),
+    ([r"\belderly\b", r"\bolder adults\b", r"\bseniors?\b", "老年", "高龄"], [65, None]),
+]
+
+_MALE_PATTERNS = [r"\b(?:male|males|men|man|boys?)\b", "男性", "男"]
+_FEMALE_PATTERNS = [r"\b(?:female|females|women|woman|girls?)\b", "女性", "女"]
+
+# 不影响语义的填充词
+_EN_FILLER = {
+    "patients", "patient", "people", "persons", "person", "individuals", "subjects", "cases", "case",
+    "records", "occurrences", "diagnosed", "diagnosis", "diagnoses", "with", "had", "have", "has",
+    "were", "was", "is", "are", "there", "did", "do", "does", "of", "the", "a", "an", "in", "on", "for",
+    "and", "to", "from", "between", "during", "among", "who", "which", "what", "show", "me", "give",
+    "get", "find", "please", "us", "old", "all", "our", "database", "data", "across", "over", "s",
+}
+_ZH_FILLER = sorted([
+    "患者", "病人", "病例", "人群", "人", "名", "例", "个", "位", "有", "的", "了", "是", "在", "中", "之间",
+    "期间", "年", "请", "查询", "诊断", "确诊", "为", "被", "吗", "呢", "数", "一下", "情况", "患有", "患",
+    "得", "按", "和", "及", "与", "间", "内", "从", "里", "其中", "分别",
+], key=len, reverse=True)
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RE = re.compile(r"[一-鿿]")
+
+# 疾病同义词被替换成的占位符（私用区字符，不会被其他规则或 residual 识别为词）
+_CONDITION_MARK = "\ue000"
+# 占位符前紧挨着的词 / 汉字串
+_MODIFIER_RE = re.compile(r"([a-z0-9]+|[一-鿿]+)\s*" + _CONDITION_MARK)
+
+
+def _synonym_pattern(term: str) -> str:
+    # ASCII 词按单词边界匹配，中文按子串匹配
+    return rf"\b{re.escape(term)}\b" if term.isascii() else re.escape(term)
+
+
+# (规范名, 正则, 同义词长度)，最长同义词优先匹配
+_CONDITION_RULES: List[Tuple[str, "re.Pattern", int]] = sorted(
+    [
+        (canonical, re.compile(_synonym_pattern(term)), len(term))
+        for canonical, terms in CONDITION_SYNONYMS.items()
+        if canonical in CONDITION_CONCEPT_MAP
+        for term in terms
+    ],
+    key=lambda r: -r[2],
+)
+
+
+class _Text:
+    """待解析文本：每识别一个片段就将其抹去，剩余部分用于计算置信度"""
+
+    def __init__(self, question: str):
+        self.text = unicodedata.normalize("NFKC", question or "").lower()
+
+    def search(self, patterns: List[str]) -> Optional["re.Match"]:
+        for p in patterns:
+            m = re.search(p, self.text)
+            if m:
+                return m
+        return None
+
+    def consume(self, patterns: List[str]) -> Optional["re.Match"]:
+        m = self.search(patterns)
+        if m:
+            self.text = self.text[:m.start()] + " " + self.text[m.end():]
+        return m
+
+    def consume_all(self, patterns: List[str]) -> bool:
+        found = False
+        while self.consume(patterns):
+            found = True
+        return found
+
+    def residual(self) -> List[str]:
+        """未解释的词：英文单词 + 去掉填充词后的中文片段（每 2 个汉字计一个词）"""
+        return _unexplained(self.text)
+
+    def condition_modifiers(self) -> List[str]:
+        """疾病同义词前紧挨着的未解释的词（在其他片段都剔除之后调用）"""
+        return [w for m in _MODIFIER_RE.finditer(self.text) for w in _unexplained(m.group(1))]
+
+
+def _unexplained(text: str) -> List[str]:
+    words = [w for w in _WORD_RE.findall(text) if w not in _EN_FILLER]
+    zh = "".join(_CJK_RE.findall(text))
+    for filler in _ZH_FILLER:
+        zh = zh.replace(filler, "")
+    words += [zh[i:i + 2] for i in range(0, len(zh), 2)]
+    return words
+
+
+def _valid_year(y: str) -> bool:
+    return 1900 <= int(y) <= 2100
+
+
+def parse_fast_path(question: str) -> Tuple[Optional[FeasibilityIntent], Dict[str, Any]]:
+    """
+    Returns:
+        (intent, info)；规则无法覆盖时 intent 为 None
+        info: {"confidence", "reason", "matched", "residual"}
+    """
+    text = _Text(question)
+    matched: Dict[str, Any] = {}
+
+    def _fail(reason: str):
+        return None, {"confidence": 0.0, "reason": reason, "matched": matched}
+
+    for reason, patterns in _BAIL_PATTERNS:
+        if text.search(patterns):
+            return _fail(f"unsupported: {reason}")
+
+    # 疾病（最长同义词优先；出现两种疾病交给 LLM）
+    conditions = set()
+    for canonical, rx, _ in _CONDITION_RULES:
+        while True:
+            m = rx.search(text.text)
+            if not m:
+                break
+            conditions.add(canonical)
+            text.text = text.text[:m.start()] + f" {_CONDITION_MARK} " + text.text[m.end():]
+    if len(conditions) != 1:
+        return _fail("no known condition" if not conditions else "multiple conditions")
+    condition = conditions.pop()
+    matched["condition"] = condition
+
+    # 年份范围 / 单个年份
+    start = end = None
+    m = text.consume(_YEAR_RANGE_PATTERNS)
+    if m:
+        lo, hi = m.group(1), m.group(2)
+        if not (_valid_year(lo) and _valid_year(hi)) or int(lo) > int(hi):
+            return _fail("invalid year range")
+        start, end = f"{lo}-01-01", f"{hi}-12-31"
+    else:
+        m = text.consume(_SINGLE_YEAR_PATTERNS)
+        if m:
+            if not _valid_year(m.group(1)):
+                return _fail("invalid year")
+            start, end = f"{m.group(1)}-01-01", f"{m.group(1)}-12-31"
+    if start:
+        matched["years"] = [start, end]
+
+    # 年龄
+    age_range = None
+    m = text.consume(_AGE_RANGE_PATTERNS)
+    if m:
+        age_range = [int(m.group(1)), int(m.group(2))]
+    elif text.search(_AGE_MIN_PATTERNS):
+        age_range = [int(text.consume(_AGE_MIN_PATTERNS).group(1)), None]
+    elif text.search(_AGE_MAX_PATTERNS):
+        age_range = [None, int(text.consume(_AGE_MAX_PATTERNS).group(1))]
+    else:
+        for patterns, rng in _AGE_KEYWORDS:
+            if text.consume(patterns):
+                age_range = list(rng)
+                break
+
+    # 维度（先于性别识别，避免 "性别" 中的 "性" 干扰）
+    if text.search(_UNSUPPORTED_DIMENSION):
+        return _fail("unsupported: distribution dimension")
+    m = text.consume(_GENDER_TIME_DIMENSION)
+    time_dimension = ("month" if "month" in m.group(0) else "year") if m else None
+    by_gender = text.consume_all(_GENDER_DIMENSION) or m is not None
+
+    # 性别
+    is_female = text.consume_all(_FEMALE_PATTERNS)
+    is_male = text.consume_all(_MALE_PATTERNS)
+    if is_female and is_male:
+        return _fail("both genders mentioned")
+    gender = "F" if is_female else "M" if is_male else None
+
+    # 任务类型
+    monthly = bool(text.search(_MONTH_PATTERNS)) or time_dimension == "month"
+    is_trend = text.consume_all(_TREND_PATTERNS) or time_dimension is not None
+    is_distribution = text.consume_all(_DISTRIBUTION_PATTERNS)
+    is_count = text.consume_all(_COUNT_PATTERNS)
+    if is_trend:
+        # 趋势同时按性别：grouped 模板按时间 + 性别分组，不丢弃性别维度
+        task_type, group_by = "trend", ["month" if monthly else "year"] + (["gender"] if by_gender else [])
+    elif is_distribution or (is_count and by_gender):
+        task_type, group_by = "distribution", ["gender"]
+    elif is_count:
+        task_type, group_by = "count", None
+    else:
+        return _fail("no task keyword")
+    matched["task_type"] = task_type
+
+    demographic_filters = {}
+    if gender:
+        demographic_filters["gender"] = gender
+    if age_range:
+        demographic_filters["age_range"] = age_range
+    if demographic_filters:
+        matched["demographic_filters"] = demographic_filters
+
+    residual = text.residual()
+    if residual:
+        modifiers = text.condition_modifiers()
+        reason = ("unknown condition modifier" if modifiers
+                  else "unparsed number" if any(w.isdigit() for w in residual)
+                  else "unexplained words")
+        return None, {"confidence": 0.0, "reason": reason, "matched": matched, "residual": residual}
+
+    intent = FeasibilityIntent(
+        is_database_query=True,
+        task_type=task_type,
+        condition=condition,
+        demographic_filters=demographic_filters or None,
+        time_window_start=start,
+        time_window_end=end,
+        group_by=group_by,
+        metric="count",
+        research_question=question,
+    )
+    return intent, {"confidence": 1.0, "reason": None, "matched": matched, "residual": residual}
@@ -1,7 +1,15 @@
 import os, json 
 import re
+import time
+import asyncio
+from typing import Optional, Dict, Any, List, Callable
 from .schema import FeasibilityIntent, ParseContext
-from poc.utils.llm_client import get_llm
+from .cache import get_intent_cache
+from .fast_path import parse_fast_path
+from poc.db.config import settings
+from poc.utils.llm_client import get_llm_manager, get_llm_model
+from poc.utils.deadline import DeadlineExceeded
+from poc.utils.json_stream import JSONObjectStream
 from dotenv import load_dotenv
 from datetime import date
 today_str = date.today().strftime("%Y-%m-%d")
@@ -98,30 +106,368 @@ Return JSON only.
 """
 
 
-def parse_intent(user_query: str, ctx: ParseContext) -> FeasibilityIntent:
-    client, model = get_llm()
+BATCH_USER_TMPL = """
+Convert EACH of the following {n} user research questions into the JSON intent object:
+
+{numbered}
+
+Return a JSON array with exactly {n} objects, in the same order as the questions.
+Each object must follow the schema above and add an "index" field with the question number.
+Return JSON only.
+"""
+
+
+def _build_messages(user_query: str, ctx: ParseContext):
     sys = SYSTEM_TMPL.format(omop_version=ctx.omop_version,today_str=today_str)
     usr = USER_TMPL.format(user_query=user_query)
+    return [
+        {"role": "system", "content": sys},
+        {"role": "user", "content": usr}
+    ]
 
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": sys},
-            {"role": "user", "content": usr}
-        ],
-        temperature=0.9,
-    )
-    raw = resp.choices[0].message.content.strip()
+
+def _build_batch_messages(questions: List[str], ctx: ParseContext):
+    """多个问题共用一次 SYSTEM_TMPL，要求返回 JSON 数组"""
+    sys = SYSTEM_TMPL.format(omop_version=ctx.omop_version, today_str=today_str)
+    numbered = "\n".join(f'{i + 1}. "{q}"' for i, q in enumerate(questions))
+    usr = BATCH_USER_TMPL.format(n=len(questions), numbered=numbered)
+    return [
+        {"role": "system", "content": sys},
+        {"role": "user", "content": usr}
+    ]
+
+
+def _load_json(raw: str) -> dict:
     try:
-        data = json.loads(raw)
+        return json.loads(raw)
     except Exception:
         # fallback: try to find the first JSON block
 
         m = re.search(r"\{.*\}", raw, re.S)
         if not m:
             raise ValueError(f"LLM did not return JSON: {raw}")
-        data = json.loads(m.group(0))
+        return json.loads(m.group(0))
+
+
+def _load_json_array(raw: str, n: int) -> List[Optional[dict]]:
+    """
+    解析批量响应，返回长度为 n 的列表（按 index 字段对齐，缺失时按位置）；
+    无法对应到问题或不是对象的元素为 None
+    """
+    try:
+        data = json.loads(raw)
+    except Exception:
+        m = re.search(r"\[.*\]", raw, re.S)
+        try:
+            data = json.loads(m.group(0)) if m else None
+        except Exception:
+            data = None
+    if isinstance(data, dict):
+        # 部分模型会包一层 {"intents": [...]}
+        data = next((v for v in data.values() if isinstance(v, list)), [data] if n == 1 else None)
+
+    out: List[Optional[dict]] = [None] * n
+    if not isinstance(data, list):
+        return out
+    for pos, item in enumerate(data):
+        if not isinstance(item, dict):
+            continue
+        idx = item.pop("index", None)
+        i = idx - 1 if isinstance(idx, int) and 1 <= idx <= n else pos
+        if i < n and out[i] is None:
+            out[i] = item
+    return out
+
+
+def _usage(resp) -> Optional[Dict[str, int]]:
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+
+def _sampling() -> Dict[str, Any]:
+    """采样参数：确定性模式固定 temperature=0 与 seed，解析结果可复现"""
+    if settings.LLM_DETERMINISTIC:
+        return {"temperature": 0, "seed": settings.LLM_SEED}
+    return {"temperature": 0.9}
+
+
+def _lookup(user_query: str, ctx: ParseContext, audit: Dict[str, Any]):
+    """
+    LLM 之前的两级：规则快速路径 → 意图缓存；来源（fast_path / cache / llm）与命中信息写入 audit
+    Returns:
+        (cache key, FeasibilityIntent | None)；缓存未启用或快速路径命中时 key 为 None
+    """
+    audit.update({"source": "llm", "model": get_llm_model(), "sampling": _sampling(), "prompt_date": today_str})
+    if settings.FAST_PATH_ENABLED:
+        intent, info = parse_fast_path(user_query)
+        audit["fast_path"] = info
+        if intent is not None and info["confidence"] >= settings.FAST_PATH_MIN_CONFIDENCE:
+            audit["source"] = "fast_path"
+            return None, intent
+
+    if not settings.INTENT_CACHE_ENABLED:
+        return None, None
+    cache = get_intent_cache()
+    key = cache.make_key(user_query, ctx.omop_version, audit["model"], today_str, audit["sampling"])
+    data, tier = cache.get(key)
+    audit["cache"] = {"hit": data is not None, "tier": tier, "key": key[:16]}
+    if data is None:
+        return key, None
+    audit["source"] = "cache"
+    return key, FeasibilityIntent(**data)
+
+
+def _cache_store(key: Optional[str], user_query: str, ctx: ParseContext, intent: FeasibilityIntent):
+    if key is not None:
+        get_intent_cache().put(
+            key, intent.model_dump(),
+            meta={"question": user_query, "omop_version": ctx.omop_version, "prompt_date": today_str},
+        )
+
+
+def parse_intent(
+    user_query: str,
+    ctx: ParseContext,
+    audit: Optional[Dict[str, Any]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+) -> FeasibilityIntent:
+    """
+    :param audit: 可选，写入解析来源（cache / llm）、缓存命中、模型与采样参数、耗时
+    :param on_field: 可选，流式模式（LLM_STREAMING）下顶层字段一完成即回调 on_field(key, value)，
+                     下游可提前开始廉价的准备工作（如 condition 的概念解析）
+    """
+    audit = {} if audit is None else audit
+    t0 = time.perf_counter()
+    key, cached = _lookup(user_query, ctx, audit)
+    if cached is not None:
+        audit["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        return cached
+
+    intent = _llm_parse(user_query, ctx, key, audit, on_field)
+    audit["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return intent
+
+
+def _finish_single(resp, user_query: str, ctx: ParseContext, key: Optional[str], audit: Dict[str, Any]):
+    audit["tokens"] = _usage(resp)
+    raw = resp.choices[0].message.content.strip()
+    intent = _postprocess(_load_json(raw), user_query)
+    _cache_store(key, user_query, ctx, intent)
+    return intent
+
+
+def _finish_stream(stream: JSONObjectStream, user_query: str, ctx: ParseContext, key: Optional[str], audit: Dict[str, Any]):
+    # 流式响应不带 usage；对象未闭合（模型输出被截断等）时回退到整段文本解析
+    audit["tokens"] = None
+    audit["stream"].update(stream.timings())
+    data = stream.result() if stream.done else _load_json(stream.text.strip())
+    intent = _postprocess(data, user_query)
+    _cache_store(key, user_query, ctx, intent)
+    return intent
+
+
+def _llm_parse(
+    user_query: str,
+    ctx: ParseContext,
+    key: Optional[str],
+    audit: Dict[str, Any],
+    on_field: Optional[Callable[[str, Any], None]] = None,
+) -> FeasibilityIntent:
+    # 共享客户端（连接复用）+ 后端路由 + 退避重试；deadline 剩余时间作为请求超时
+    messages = _build_messages(user_query, ctx)
+    if settings.LLM_STREAMING:
+        stream = JSONObjectStream(on_field)
+        audit["stream"], audit["llm"] = get_llm_manager().stream_completion(messages, stream.feed, **_sampling())
+        return _finish_stream(stream, user_query, ctx, key, audit)
+    resp, audit["llm"] = get_llm_manager().chat_completion(messages, **_sampling())
+    return _finish_single(resp, user_query, ctx, key, audit)
+
+
+async def _llm_parse_async(
+    user_query: str,
+    ctx: ParseContext,
+    key: Optional[str],
+    audit: Dict[str, Any],
+    on_field: Optional[Callable[[str, Any], None]] = None,
+) -> FeasibilityIntent:
+    messages = _build_messages(user_query, ctx)
+    if settings.LLM_STREAMING:
+        stream = JSONObjectStream(on_field)
+        audit["stream"], audit["llm"] = await get_llm_manager().astream_completion(messages, stream.feed, **_sampling())
+        return _finish_stream(stream, user_query, ctx, key, audit)
+    resp, audit["llm"] = await get_llm_manager().achat_completion(messages, **_sampling())
+    return _finish_single(resp, user_query, ctx, key, audit)
+
+
+async def parse_intent_async(
+    user_query: str,
+    ctx: ParseContext,
+    audit: Optional[Dict[str, Any]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+) -> FeasibilityIntent:
+    """parse_intent 的异步版本（AsyncOpenAI），LLM 往返期间不阻塞事件循环"""
+    audit = {} if audit is None else audit
+    t0 = time.perf_counter()
+    key, cached = _lookup(user_query, ctx, audit)
+    if cached is not None:
+        audit["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        return cached
+
+    intent = await _llm_parse_async(user_query, ctx, key, audit, on_field)
+    audit["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return intent
+
 
+# =====================================================
+# 批量解析：多个问题打包成一次 LLM 请求（共用一次系统 prompt）
+# =====================================================
+
+def _prepare_batch(questions: List[str], ctx: ParseContext, audits: List[Dict[str, Any]]):
+    """快速路径 / 意图缓存先行，返回 (results, cache keys, 需要调用 LLM 的下标)"""
+    results: List[Optional[FeasibilityIntent]] = [None] * len(questions)
+    keys: List[Optional[str]] = [None] * len(questions)
+    pending = []
+    for i, q in enumerate(questions):
+        keys[i], results[i] = _lookup(q, ctx, audits[i])
+        if results[i] is None:
+            pending.append(i)
+    return results, keys, pending
+
+
+def _apply_batch(chunk, elements, resp, call, questions, ctx, keys, results, audits) -> List[int]:
+    """
+    校验批量响应中的每个元素；返回需要单独重试的下标
+    token 按问题数平摊，便于与单条请求对比
+    """
+    usage = _usage(resp) if resp is not None else None
+    per_question = {k: round(v / len(chunk), 1) for k, v in usage.items()} if usage else None
+    bad = []
+    for pos, (i, element) in enumerate(zip(chunk, elements)):
+        audits[i]["llm"] = call
+        audits[i]["batch"] = {"size": len(chunk), "position": pos + 1, "retried": False}
+        audits[i]["tokens"] = per_question
+        if element is None:
+            bad.append(i)
+            continue
+        try:
+            results[i] = _postprocess(element, questions[i])
+        except Exception:
+            bad.append(i)
+            continue
+        _cache_store(keys[i], questions[i], ctx, results[i])
+    return bad
+
+
+def _chunks(indices: List[int], size: int):
+    for start in range(0, len(indices), max(1, size)):
+        yield indices[start:start + max(1, size)]
+
+
+def parse_intents(
+    questions: List[str],
+    ctx: ParseContext,
+    audits: Optional[List[Dict[str, Any]]] = None,
+    batch_size: Optional[int] = None,
+) -> List[Optional[FeasibilityIntent]]:
+    """
+    批量解析：每 batch_size（默认 INTENT_BATCH_SIZE）个问题一次 LLM 请求，响应为 JSON 数组
+    批量响应中缺失 / 格式错误 / 校验失败的元素单独重试（只重试这些元素）
+    :param audits: 可选，与 questions 等长的 dict 列表，写入来源、批次位置、平摊 token、是否重试
+    Returns:
+        与 questions 等长的列表；单独重试仍失败的位置为 None，错误写入 audits[i]["error"]
+    """
+    audits = audits if audits is not None else [{} for _ in questions]
+    results, keys, pending = _prepare_batch(questions, ctx, audits)
+    for chunk in _chunks(pending, batch_size or settings.INTENT_BATCH_SIZE):
+        t0 = time.perf_counter()
+        if len(chunk) == 1:
+            bad = chunk
+        else:
+            try:
+                resp, call = get_llm_manager().chat_completion(
+                    _build_batch_messages([questions[i] for i in chunk], ctx), **_sampling()
+                )
+                elements = _load_json_array(resp.choices[0].message.content.strip(), len(chunk))
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                resp, call, elements = None, {"error": str(e)}, [None] * len(chunk)
+            bad = _apply_batch(chunk, elements, resp, call, questions, ctx, keys, results, audits)
+
+        for i in bad:
+            retry: Dict[str, Any] = {}
+            try:
+                results[i] = _llm_parse(questions[i], ctx, keys[i], retry)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                audits[i]["error"] = str(e)
+            _record_retry(audits[i], retry, single=len(chunk) == 1)
+        for i in chunk:
+            audits[i]["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return results
+
+
+async def parse_intents_async(
+    questions: List[str],
+    ctx: ParseContext,
+    audits: Optional[List[Dict[str, Any]]] = None,
+    batch_size: Optional[int] = None,
+) -> List[Optional[FeasibilityIntent]]:
+    """parse_intents 的异步版本：各批次并发请求，单独重试也并发进行"""
+    audits = audits if audits is not None else [{} for _ in questions]
+    results, keys, pending = _prepare_batch(questions, ctx, audits)
+
+    async def _retry(i: int, single: bool):
+        retry: Dict[str, Any] = {}
+        try:
+            results[i] = await _llm_parse_async(questions[i], ctx, keys[i], retry)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            audits[i]["error"] = str(e)
+        _record_retry(audits[i], retry, single=single)
+
+    async def _run_chunk(chunk: List[int]):
+        t0 = time.perf_counter()
+        if len(chunk) == 1:
+            bad = chunk
+        else:
+            try:
+                resp, call = await get_llm_manager().achat_completion(
+                    _build_batch_messages([questions[i] for i in chunk], ctx), **_sampling()
+                )
+                elements = _load_json_array(resp.choices[0].message.content.strip(), len(chunk))
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                resp, call, elements = None, {"error": str(e)}, [None] * len(chunk)
+            bad = _apply_batch(chunk, elements, resp, call, questions, ctx, keys, results, audits)
+        await asyncio.gather(*[_retry(i, single=len(chunk) == 1) for i in bad])
+        for i in chunk:
+            audits[i]["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+    await asyncio.gather(*[_run_chunk(c) for c in _chunks(pending, batch_size or settings.INTENT_BATCH_SIZE)])
+    return results
+
+
+def _record_retry(audit: Dict[str, Any], retry: Dict[str, Any], single: bool):
+    if single:
+        # 批次中只有一个问题：直接按单条请求解析，不算重试
+        audit.update({k: v for k, v in retry.items() if k in ("llm", "tokens")})
+        audit["batch"] = {"size": 1, "position": 1, "retried": False}
+        return
+    audit["batch"]["retried"] = True
+    audit["retry"] = {k: v for k, v in retry.items() if k in ("llm", "tokens")}
+
+
+def _postprocess(data: dict, user_query: str) -> FeasibilityIntent:
     intent = FeasibilityIntent(**data)
 
     # ===========================
@@ -1,18 +1,76 @@
+import re
 from typing import List, Dict, Any
 from pydantic import BaseModel
 
+from poc.db.config import settings
+
 class PlanStep(BaseModel):
     id: str
     action: str
     inputs: Dict[str, Any] = {}
     outputs: Dict[str, Any] = {}
+    depends_on: List[str] = []  # 依赖的 step id；依赖全部成功后才执行，无依赖关系的步骤可并发
+
+# compare 任务中多个对比组的分隔方式，如 "diabetes vs hypertension"、"糖尿病和高血压"
+_ARM_SPLIT_RE = re.compile(r"\s+(?:vs\.?|versus)\s+|\s*[,，、/]\s*|\s*(?:和|与|对比)\s*", re.I)
+
+def split_compare_arms(condition: str | None) -> List[str]:
+    """把 compare 任务的 condition 拆成多个对比组；无法拆分时返回空列表"""
+    if not condition:
+        return []
+    arms = [a.strip() for a in _ARM_SPLIT_RE.split(condition) if a and a.strip()]
+    return arms if len(arms) > 1 else []
 
 def build_plan(intent) -> List[PlanStep]:
-    # PoC：硬编码 4 步
+    """
+    构建执行 DAG：
+    resolve_concepts → generate_sql → (run_dry_run ∥ create_snapshot) → run_sql → summarize_result
+    compare 任务有多个对比组时，对比组写入 resolve_concepts 的 compare_arms，
+    一条条件聚合 SQL 一次扫描计数全部对比组（见 sql_generator._generate_compare）
+    cohort / compare 任务在 COHORT_BACKEND_ENABLED 时改用人群缓存后端（person_id 位图，见 cohort_cache.py）；
+    compare 的各组同样只扫描一次 condition_occurrence（prefetch_cohorts），并额外给出组间交集 / 并集 / 独有人数
+    """
+    arms = split_compare_arms(intent.condition) if intent.task_type == "compare" else []
+    if settings.COHORT_BACKEND_ENABLED and (intent.task_type == "cohort" or arms):
+        return _build_cohort_plan(intent, arms)
+
+    resolve_inputs = intent.model_dump()
+    if arms:
+        resolve_inputs["compare_arms"] = arms
     return [
-        PlanStep(id="step1", action="resolve_concepts", inputs=intent.model_dump()),
-        PlanStep(id="step2", action="generate_sql", inputs={}),
-        PlanStep(id="step3", action="run_dry_run", inputs={}),
-        PlanStep(id="step4", action="run_sql", inputs={}),
-        PlanStep(id="step5", action="summarize_result", inputs={}),
+        PlanStep(id="step1", action="resolve_concepts", inputs=resolve_inputs),
+        PlanStep(id="step2", action="generate_sql", inputs={}, depends_on=["step1"]),
+        PlanStep(id="step3", action="run_dry_run", inputs={}, depends_on=["step2"]),
+        PlanStep(id="step4", action="create_snapshot", inputs={}, depends_on=["step2"]),
+        PlanStep(id="step5", action="run_sql", inputs={}, depends_on=["step3", "step4"]),
+        PlanStep(id="step6", action="summarize_result", inputs={}, depends_on=["step5"]),
     ]
+
+def _build_cohort_plan(intent, arms: List[str]) -> List[PlanStep]:
+    """
+    人群后端：resolve_concepts → build_cohort（每个对比组一条链路）→ [combine_cohorts] → summarize_result
+    build_cohort 从人群缓存取 person_id 位图（未命中才查库），combine_cohorts 在内存中计算组间交集 / 并集 / 独有人数
+    多个对比组时 prefetch_cohorts 先一次扫描加载缓存中缺少的各组诊断部件，各组 build_cohort 随后命中缓存
+    """
+    if not arms:
+        return [
+            PlanStep(id="step1", action="resolve_concepts", inputs=intent.model_dump()),
+            PlanStep(id="step2", action="build_cohort", inputs={}, depends_on=["step1"]),
+            PlanStep(id="step3", action="summarize_result", inputs={}, depends_on=["step2"]),
+        ]
+
+    steps: List[PlanStep] = []
+    resolve_ids = [f"step{i + 1}" for i in range(len(arms))]
+    prefetch_id = f"step{len(arms) + 1}"
+    cohort_ids = [f"step{len(arms) + 2 + i}" for i in range(len(arms))]
+    for arm, rid in zip(arms, resolve_ids):
+        arm_inputs = intent.model_dump()
+        arm_inputs.update({"condition": arm, "task_type": "cohort", "arm": arm})
+        steps.append(PlanStep(id=rid, action="resolve_concepts", inputs=arm_inputs))
+    steps.append(PlanStep(id=prefetch_id, action="prefetch_cohorts", inputs={}, depends_on=resolve_ids))
+    for arm, rid, cid in zip(arms, resolve_ids, cohort_ids):
+        steps.append(PlanStep(id=cid, action="build_cohort", inputs={"arm": arm}, depends_on=[rid, prefetch_id]))
+    n = 2 * len(arms) + 1
+    steps.append(PlanStep(id=f"step{n + 1}", action="combine_cohorts", inputs={}, depends_on=cohort_ids))
+    steps.append(PlanStep(id=f"step{n + 2}", action="summarize_result", inputs={}, depends_on=[f"step{n + 1}"]))
+    return steps
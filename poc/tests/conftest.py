@@ -0,0 +1,86 @@
+"""
+测试夹具：内存 SQLite 上的最小 OMOP 库（person / condition_occurrence）
+
+每个测试使用独立的共享缓存内存库（同一进程内的多个连接看到同一份数据），
+数据库 URL 与各缓存目录指向测试自己的位置，进程级单例在测试前重置、测试后恢复
+"""
+import uuid
+import random
+import sqlite3
+from datetime import date
+
+import pytest
+
+from poc.db.config import settings
+
+PERSONS = 200
+OCCURRENCES = 2000
+CONCEPTS = (201826, 319835, 443238)
+GENDERS = (8507, 8532)
+
+# 进程级单例：(模块, 变量名)
+_SINGLETONS = (
+    ("poc.execution.result_cache", "_CACHE"),
+    ("poc.execution.cohort_cache", "_CACHE"),
+    ("poc.db.feasibility_cube", "_CUBE"),
+    ("poc.db.feasibility_sample", "_SAMPLE"),
+    ("poc.db.parquet_extract", "_EXTRACT"),
+)
+
+
+def _seed(conn: sqlite3.Connection):
+    rng = random.Random(7)
+    conn.executescript("""
+        CREATE TABLE person (person_id INTEGER PRIMARY KEY, gender_concept_id INTEGER, year_of_birth INTEGER);
+        CREATE TABLE condition_occurrence (condition_occurrence_id INTEGER PRIMARY KEY, person_id INTEGER,
+                                           condition_concept_id INTEGER, condition_start_date DATE);
+    """)
+    conn.executemany("INSERT INTO person VALUES (?, ?, ?)",
+                     [(i, rng.choice(GENDERS), rng.randint(1940, 2010)) for i in range(1, PERSONS + 1)])
+    conn.executemany(
+        "INSERT INTO condition_occurrence VALUES (?, ?, ?, ?)",
+        [(i, rng.randint(1, PERSONS), rng.choice(CONCEPTS),
+          date(rng.randint(2018, 2024), rng.randint(1, 12), rng.randint(1, 28)).isoformat())
+         for i in range(1, OCCURRENCES + 1)],
+    )
+    conn.commit()
+
+
+@pytest.fixture
+def omop_db(monkeypatch, tmp_path):
+    """返回数据库 URL；测试结束时释放连接池，内存库随最后一个连接关闭而销毁"""
+    import importlib
+    from poc.db.database import dispose_engines
+
+    name = f"omop_{uuid.uuid4().hex}"
+    keeper = sqlite3.connect(f"file:{name}?mode=memory&cache=shared", uri=True)
+    _seed(keeper)
+
+    url = f"sqlite:///file:{name}?mode=memory&cache=shared&uri=true"
+    monkeypatch.setattr(settings, "DB_URL", url)
+    monkeypatch.setattr(settings, "DRY_RUN_MODE", "count")
+    monkeypatch.setattr(settings, "RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "RESULT_CACHE_DIR", "")
+    monkeypatch.setattr(settings, "COHORT_CACHE_DIR", "")
+    monkeypatch.setattr(settings, "EXTRACT_DIR", str(tmp_path / "extract"))
+    for module, attr in _SINGLETONS:
+        monkeypatch.setattr(importlib.import_module(module), attr, None)
+
+    yield url
+
+    dispose_engines()
+    keeper.close()
+
+
+@pytest.fixture
+def base_count(omop_db):
+    """直接在基础表上计数（不经过任何缓存 / 预聚合），作为对照"""
+    from sqlalchemy import text
+    from poc.db.database import get_db_manager
+
+    def _count(where: str = "1=1", params=None) -> int:
+        with get_db_manager().engine.connect() as conn:
+            return conn.execute(text(
+                "SELECT COUNT(*) FROM condition_occurrence c JOIN person p ON p.person_id = c.person_id "
+                f"WHERE {where}"), params or {}).scalar()
+    return _count
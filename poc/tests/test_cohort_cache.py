@@ -0,0 +1,112 @@
+import pytest
+
+from poc.db.config import settings
+from poc.execution import cohort_cache, result_cache
+from poc.execution.cohort_cache import CohortCache, IdArray, new_bitmap, get_cohort_cache
+from poc.execution.executor import run_sql, run_write, _person_ids, _combine_cohorts
+
+DIAGNOSED = "SELECT DISTINCT person_id FROM condition_occurrence WHERE condition_concept_id = :cid"
+FEMALE = "SELECT person_id FROM person WHERE gender_concept_id = 8532"
+
+
+@pytest.fixture(params=["roaring", "ids"])
+def bitmap_kind(request, monkeypatch):
+    """两种位图实现都要覆盖：pyroaring（已安装时）与有序 id 数组"""
+    if request.param == "roaring":
+        pytest.importorskip("pyroaring")
+    else:
+        monkeypatch.setattr(cohort_cache, "BitMap64", None)
+        monkeypatch.setattr(cohort_cache, "BITMAP_KIND", "ids")
+    return request.param
+
+
+def _ids(sql, params=None):
+    return {r["person_id"] for r in run_sql(sql, params)}
+
+
+def _arm(cache, cid):
+    bitmap, _ = cache.load(DIAGNOSED, {"cid": cid}, _person_ids)
+    return {"arm": str(cid), "cohort": bitmap}
+
+
+def test_intersection_of_parts(omop_db, bitmap_kind):
+    cache = CohortCache()
+    cohort, info = cache.materialize([("diagnosis", DIAGNOSED, {"cid": 201826}), ("gender", FEMALE, {})], _person_ids)
+    expected = _ids(DIAGNOSED, {"cid": 201826}) & _ids(FEMALE)
+    assert len(cohort) == len(expected) and set(cohort) == expected
+    assert [p["hit"] for p in info] == [False, False]
+
+    _, info = cache.materialize([("diagnosis", DIAGNOSED, {"cid": 201826}), ("gender", FEMALE, {})], _person_ids)
+    assert [p["tier"] for p in info] == ["memory", "memory"]
+
+
+def test_compare_and_or_and_not(omop_db, bitmap_kind):
+    cache = CohortCache()
+    arms = [_arm(cache, cid) for cid in (201826, 319835, 443238)]
+    sets = [_ids(DIAGNOSED, {"cid": cid}) for cid in (201826, 319835, 443238)]
+    _, out = _combine_cohorts(arms)
+    assert out["arms"] == {a["arm"]: len(s) for a, s in zip(arms, sets)}
+    assert out["intersection"] == len(sets[0] & sets[1] & sets[2])
+    assert out["union"] == len(sets[0] | sets[1] | sets[2])
+    for i, arm in enumerate(arms):
+        others = set().union(*(s for j, s in enumerate(sets) if j != i))
+        assert out["exclusive"][arm["arm"]] == len(sets[i] - others)
+
+
+def test_bigint_ids_and_set_operations(bitmap_kind):
+    big = 2 ** 40
+    a, b = new_bitmap([3, big, big + 7, 3]), new_bitmap([big, 5, 2 ** 62])
+    assert sorted(a & b) == [big]
+    assert sorted(a | b) == [3, 5, big, big + 7, 2 ** 62]
+    assert sorted(a - b) == [3, big + 7]
+    assert len(a) == 3
+
+
+def test_disk_tier_round_trip_without_pickle(tmp_path, bitmap_kind):
+    writer, reader = CohortCache(disk_dir=str(tmp_path)), CohortCache(disk_dir=str(tmp_path))
+    writer.put("k", new_bitmap([1, 2 ** 40]))
+    raw = (tmp_path / "k.bitmap").read_bytes()
+    assert raw.startswith(b'{"created_at"')
+    bitmap, tier = reader.get("k")
+    assert tier == "disk" and sorted(bitmap) == [1, 2 ** 40]
+
+    (tmp_path / "j.bitmap").write_bytes(b"\x80\x04K\x01.")
+    assert reader.get("j") == (None, None)
+
+
+def test_memory_tier_is_limited_by_bytes():
+    cache = CohortCache(max_bytes=3 * 8 * 100)
+    for k in range(5):
+        cache.put(f"k{k}", IdArray.from_ids(range(k * 100, k * 100 + 100)))
+    stats = cache.stats()
+    assert stats["size"] == 3 and stats["bytes"] <= cache.max_bytes
+    assert cache.get("k0") == (None, None) and cache.get("k4")[1] == "memory"
+
+    # 单个超过上限的位图不留在内存层
+    cache.put("huge", IdArray.from_ids(range(1000)))
+    assert cache.get("huge") == (None, None) and cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_disk_entry_of_other_kind_is_a_miss(tmp_path, monkeypatch):
+    cache = CohortCache(disk_dir=str(tmp_path))
+    cache.put("k", new_bitmap([1, 2]))
+    cache.clear()
+    monkeypatch.setattr(cohort_cache, "BITMAP_KIND", "other")
+    assert cache.get("k") == (None, None)
+
+
+def test_disk_tier_survives_restart_without_result_cache_dir(omop_db, tmp_path, monkeypatch):
+    """结果缓存没有磁盘层（默认）时，写操作之前的位图在重启后也不能再被命中"""
+    monkeypatch.setattr(settings, "COHORT_CACHE_DIR", str(tmp_path / "cohorts"))
+    params = {"cid": 201826}
+    before, _ = get_cohort_cache().load(DIAGNOSED, params, _person_ids)
+
+    run_write("INSERT INTO condition_occurrence VALUES (100001, 999, 201826, '2024-06-01')")
+    after, tier = get_cohort_cache().load(DIAGNOSED, params, _person_ids)
+    assert tier is None and set(after) == set(before) | {999}
+
+    # 重启：进程内单例全部重建，只剩磁盘上的文件
+    monkeypatch.setattr(cohort_cache, "_CACHE", None)
+    monkeypatch.setattr(result_cache, "_CACHE", None)
+    restarted, tier = get_cohort_cache().load(DIAGNOSED, params, _person_ids)
+    assert tier == "disk" and set(restarted) == _ids(DIAGNOSED, params) == set(after)
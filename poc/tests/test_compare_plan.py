@@ -0,0 +1,49 @@
+from datetime import date
+
+from poc.db.config import settings
+from poc.execution.cohort_cache import get_cohort_cache
+from poc.execution.executor import generate_template, run_sql, _person_ids, _prefetch_arms
+from poc.execution.sql_generator import cohort_parts, cohort_arm_scan
+from poc.intent.schema import FeasibilityIntent
+from poc.plan.builder import build_plan
+
+CONCEPTS = (201826, 319835, 443238)
+
+
+def _resolved(concept_id, start="2020-01-01"):
+    return {"task_type": "cohort", "condition": str(concept_id), "arm": str(concept_id),
+            "condition_concept_id": concept_id, "time_window_start": start, "time_window_end": "2024-12-31"}
+
+
+def test_compare_plan_prefetches_all_arms(monkeypatch):
+    monkeypatch.setattr(settings, "COHORT_BACKEND_ENABLED", True)
+    intent = FeasibilityIntent(task_type="compare", condition="diabetes vs hypertension", research_question="q")
+    steps = build_plan(intent)
+    prefetch = [s for s in steps if s.action == "prefetch_cohorts"]
+    builds = [s for s in steps if s.action == "build_cohort"]
+    assert len(prefetch) == 1 and len(builds) == 2
+    assert all(prefetch[0].id in s.depends_on for s in builds)
+    assert [s.action for s in steps[-2:]] == ["combine_cohorts", "summarize_result"]
+
+
+def test_prefetch_loads_all_arms_in_one_scan(omop_db):
+    out = _prefetch_arms([_resolved(cid) for cid in CONCEPTS])
+    assert out["scanned"] == 3 and out["sql"].count("condition_occurrence") == 1
+
+    cache = get_cohort_cache()
+    for cid in CONCEPTS:
+        tpl, params = generate_template(_resolved(cid))
+        bitmap, tier = cache.load(*cohort_parts(tpl, params)[0][1:], _person_ids)
+        expected = {r["person_id"] for r in run_sql(
+            "SELECT DISTINCT person_id FROM condition_occurrence WHERE condition_concept_id = :cid "
+            "AND condition_start_date >= '2020-01-01' AND condition_start_date < '2025-01-01'", {"cid": cid})}
+        assert tier == "memory" and set(bitmap) == expected
+
+    # 全部命中时不再扫描
+    assert _prefetch_arms([_resolved(cid) for cid in CONCEPTS])["scanned"] == 0
+
+
+def test_arms_with_different_windows_are_loaded_separately(omop_db):
+    arms = [generate_template(_resolved(201826)), generate_template(_resolved(319835, start="2021-01-01"))]
+    assert arms[1][1]["time_window_start"] == date(2021, 1, 1)
+    assert cohort_arm_scan(arms) is None
@@ -0,0 +1,66 @@
+import pytest
+
+from poc.db.config import settings
+from poc.intent.fast_path import parse_fast_path
+
+
+def _accepted(question):
+    intent, info = parse_fast_path(question)
+    return intent is not None and info["confidence"] >= settings.FAST_PATH_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("How many diabetes patients?", {"task_type": "count", "condition": "type 2 diabetes"}),
+    ("How many female diabetes patients between 2020 and 2024?",
+     {"task_type": "count", "time_window_start": "2020-01-01", "time_window_end": "2024-12-31",
+      "demographic_filters": {"gender": "F"}}),
+    ("How many patients with hypertension in 2021?",
+     {"condition": "hypertension", "time_window_start": "2021-01-01", "time_window_end": "2021-12-31"}),
+    ("Trend of type 2 diabetes by year", {"task_type": "trend", "group_by": ["year"]}),
+    ("高血压患者按性别分布", {"task_type": "distribution", "group_by": ["gender"], "condition": "hypertension"}),
+    ("2020年到2024年女性糖尿病患者有多少", {"task_type": "count", "time_window_start": "2020-01-01"}),
+    ("trend of hypertension by gender", {"task_type": "trend", "group_by": ["year", "gender"]}),
+    ("按性别统计每年高血压人数", {"task_type": "trend", "group_by": ["year", "gender"]}),
+    ("yearly trend of diabetes by sex from 2018 to 2023",
+     {"group_by": ["year", "gender"], "time_window_start": "2018-01-01", "time_window_end": "2023-12-31"}),
+    ("how many patients with hypertension by gender and year", {"task_type": "trend", "group_by": ["year", "gender"]}),
+    ("monthly trend of diabetes in women", {"group_by": ["month"], "demographic_filters": {"gender": "F"}}),
+])
+def test_accepts_fully_explained_questions(question, expected):
+    intent, info = parse_fast_path(question)
+    assert _accepted(question), info
+    dumped = intent.model_dump()
+    for field, value in expected.items():
+        if isinstance(value, dict):
+            assert {k: dumped[field][k] for k in value} == value
+        else:
+            assert dumped[field] == value
+
+
+@pytest.mark.parametrize("question, reason", [
+    ("How many gestational diabetes patients?", "unknown condition modifier"),
+    ("How many type 1 diabetes patients?", "unknown condition modifier"),
+    ("妊娠糖尿病患者有多少", "unknown condition modifier"),
+    ("How many hypertension patients died?", "unexplained words"),
+    ("How many diabetes patients in Beijing in 2020?", "unexplained words"),
+    ("How many diabetes patients are pregnant?", "unexplained words"),
+    ("糖尿病死亡患者多少", "unexplained words"),
+    ("How many diabetes patients in 12 hospitals?", "unparsed number"),
+    ("How many diabetes patients by year of birth?", "unexplained words"),
+    ("How many diabetes patients in the first year?", "unexplained words"),
+])
+def test_bails_on_unexplained_words(question, reason):
+    intent, info = parse_fast_path(question)
+    assert intent is None and not _accepted(question)
+    assert info["reason"] == reason and info["residual"]
+
+
+@pytest.mark.parametrize("question", [
+    "Compare diabetes and hypertension patients",
+    "How many diabetes patients in the last 3 years?",
+    "How many diabetes patients without hypertension?",
+    "How many diabetes patients taking metformin?",
+])
+def test_bails_on_unsupported_signals(question):
+    intent, info = parse_fast_path(question)
+    assert intent is None and info["reason"].startswith(("unsupported", "multiple"))
@@ -0,0 +1,35 @@
+from sqlalchemy import inspect
+
+from poc.db.database import get_db_manager
+from poc.db.index_advisor import advise, index_ddl
+
+
+def _indexes():
+    insp = inspect(get_db_manager().engine)
+    return {t: sorted(i["name"] for i in insp.get_indexes(t)) for t in ("person", "condition_occurrence")}
+
+
+def test_advise_runs_no_ddl(omop_db):
+    before = _indexes()
+    result = advise(log=lambda _: None)
+    assert any(r["status"] == "recommended" for r in result["indexes"])
+    assert _indexes() == before
+    assert result["after_method"] is None
+    assert all(s["after"] is None and s["speedup"] is None for s in result["shapes"])
+
+
+def test_apply_creates_indexes(omop_db):
+    result = advise(apply=True, log=lambda _: None)
+    created = [r["name"] for r in result["indexes"] if r["status"] == "created"]
+    assert created and result["after_method"] == "applied"
+    names = {n for ns in _indexes().values() for n in ns}
+    assert set(created) <= names
+    assert all(s["after"] is not None for s in result["shapes"])
+
+
+def test_postgres_apply_ddl_is_concurrent():
+    ddl = index_ddl("condition_occurrence", ("condition_concept_id",), ("person_id",), "postgres", concurrently=True)
+    assert ddl.startswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS ")
+    assert "INCLUDE (person_id)" in ddl
+    assert "IF NOT EXISTS" not in index_ddl("person", ("person_id",), (), "postgres", if_not_exists=False)
+    assert "CONCURRENTLY" not in index_ddl("person", ("person_id",), (), "sqlite", concurrently=True)
@@ -0,0 +1,178 @@
+import logging
+
+import pytest
+from sqlalchemy import text
+
+from poc.db.config import settings
+from poc.db.database import get_db_manager
+from poc.db.feasibility_cube import get_feasibility_cube
+from poc.db.feasibility_sample import get_feasibility_sample
+from poc.db.parquet_extract import get_parquet_extract
+from poc.execution.executor import run_sql, run_write
+from poc.execution.sql_generator import intent_to_template, cube_template, sample_template, extract_template
+from poc.intent.schema import FeasibilityIntent
+
+
+def _template(task):
+    intent = FeasibilityIntent(task_type=task, condition="type 2 diabetes", time_window_start="2020-01-01",
+                               time_window_end="2024-12-31", demographic_filters={"gender": "F"},
+                               research_question="q")
+    extra = {"condition_concept_id": 201826, "demographic_filters": {"gender": "F", "gender_concept_id": 8532}}
+    return intent_to_template(intent, extra, "sqlite")
+
+
+def _counts(rows):
+    return {r.get("period"): r["count"] for r in rows}
+
+
+def _base(task):
+    tpl, params = _template(task)
+    return _counts(run_sql(tpl.sql, params))
+
+
+def _cube(task):
+    tpl, params = _template(task)
+    return _counts(run_sql(cube_template(tpl, params)[0].sql, params))
+
+
+def _sample(task):
+    # APPROX_SAMPLE_RATE=1.0：样本即全部记录，原始计数应与基础表一致
+    tpl, params = _template(task)
+    return _counts(run_sql(sample_template(tpl).sql, params))
+
+
+def _extract(task):
+    tpl, params = _template(task)
+    return _counts(get_parquet_extract().run(extract_template(tpl, params)[0].sql, params))
+
+
+def _direct(sql):
+    """绕过 run_write 直接写库（模拟 ETL）"""
+    with get_db_manager().engine.begin() as conn:
+        conn.execute(text(sql))
+
+
+def _female_person():
+    with get_db_manager().engine.connect() as conn:
+        return conn.execute(text("SELECT MIN(person_id) FROM person WHERE gender_concept_id = 8532")).scalar()
+
+
+@pytest.fixture
+def aggregates(omop_db, monkeypatch):
+    monkeypatch.setattr(settings, "APPROX_SAMPLE_RATE", 1.0)
+    built = {"cube": (get_feasibility_cube(), _cube), "sample": (get_feasibility_sample(), _sample)}
+    for agg, _ in built.values():
+        agg.build(log=lambda *_: None)
+    return built
+
+
+def _assert_fresh_and_matching(aggregates):
+    for name, (agg, query) in aggregates.items():
+        agg.wait()
+        assert agg.ensure_fresh() is None, name
+        for task in ("count", "trend"):
+            assert query(task) == _base(task), (name, task)
+
+
+@pytest.mark.parametrize("write", ["run_write", "direct"])
+def test_append_is_absorbed_incrementally(aggregates, write):
+    before = _base("count")
+    sql = f"INSERT INTO condition_occurrence VALUES (5001, {_female_person()}, 201826, '2021-05-01')"
+    run_write(sql) if write == "run_write" else _direct(sql)
+    assert _base("count") != before
+    _assert_fresh_and_matching(aggregates)
+    assert get_feasibility_cube().stats()["rebuilds"] == 1
+
+
+def test_update_via_run_write_rebuilds(aggregates):
+    run_write("UPDATE condition_occurrence SET condition_concept_id = 201826 WHERE condition_occurrence_id <= 300")
+    for name, (agg, _) in aggregates.items():
+        assert agg.ensure_fresh() == "stale", name
+        # 内存 SQLite 是表级锁：逐个等待重建完成，不让两个重建并发
+        agg.wait()
+    _assert_fresh_and_matching(aggregates)
+
+
+def test_update_outside_run_write_is_detected_by_checksum(aggregates):
+    _direct("UPDATE condition_occurrence SET condition_concept_id = 201826 WHERE condition_occurrence_id <= 300")
+    _direct("DELETE FROM condition_occurrence WHERE condition_occurrence_id BETWEEN 301 AND 400")
+    for name, (agg, _) in aggregates.items():
+        # 校验间隔已到：本次请求仍使用旧数据，后台校验发现不一致后标记 stale
+        agg._verified_at = 0.0
+        assert agg.ensure_fresh() is None, name
+        agg.wait()
+        assert agg.ensure_fresh() == "stale", name
+        agg.wait()
+    _assert_fresh_and_matching(aggregates)
+
+
+def test_expired_aggregate_is_rebuilt(aggregates):
+    cube = get_feasibility_cube()
+    with get_db_manager().session() as s:
+        cube._set_meta(s.connection(), built_at="2000-01-01T00:00:00")
+    assert cube.ensure_fresh() == "stale"
+    cube.wait()
+    assert cube.ensure_fresh() is None and cube.stats()["rebuilds"] == 2
+
+
+def test_rebuild_failure_is_logged_and_backs_off(aggregates, monkeypatch, caplog):
+    cube = get_feasibility_cube()
+    calls = []
+
+    def _fail(log=print):
+        calls.append(1)
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(cube, "build", _fail)
+    cube.mark_stale()
+    with caplog.at_level(logging.ERROR, logger="poc.db.feasibility_cube"):
+        for _ in range(3):
+            assert cube.ensure_fresh() == "stale"
+            cube.wait()
+    assert len(calls) == 1
+    assert cube.stats()["rebuild_failures"] == 1
+    assert "disk full" in caplog.text
+
+
+def test_extract_matches_base_after_append_and_update(omop_db):
+    pytest.importorskip("duckdb")
+    pytest.importorskip("pandas")
+    extract = get_parquet_extract()
+    extract.build(log=lambda *_: None)
+    checks = {"extract": (extract, _extract)}
+    _assert_fresh_and_matching(checks)
+
+    run_write(f"INSERT INTO condition_occurrence VALUES (5001, {_female_person()}, 201826, '2021-05-01')")
+    _assert_fresh_and_matching(checks)
+
+    run_write("UPDATE condition_occurrence SET condition_concept_id = 201826 WHERE condition_occurrence_id <= 300")
+    assert extract.ensure_fresh() == "stale"
+    _assert_fresh_and_matching(checks)
+
+    _direct("DELETE FROM condition_occurrence WHERE condition_occurrence_id BETWEEN 301 AND 400")
+    assert not extract.verify()
+    assert extract.ensure_fresh() == "stale"
+    _assert_fresh_and_matching(checks)
+
+
+@pytest.mark.parametrize("task", ["count", "trend"])
+def test_extract_dry_run_uses_explain_without_scanning(omop_db, monkeypatch, task):
+    pytest.importorskip("duckdb")
+    pytest.importorskip("pandas")
+    from poc.execution.executor import run_dry
+
+    monkeypatch.setattr(settings, "DRY_RUN_MODE", "estimate")
+    extract = get_parquet_extract()
+    extract.build(log=lambda *_: None)
+    tpl, params = _template(task)
+    sql = extract_template(tpl, params)[0].sql
+
+    def _no_scan(*_):
+        raise AssertionError("dry-run must not execute the query on the extract")
+
+    monkeypatch.setattr(extract, "run", _no_scan)
+    monkeypatch.setattr(extract, "stream", _no_scan)
+    dry = run_dry(sql, params, "extract")
+    assert dry["method"] == "explain" and dry["estimated_rows"] >= 1
+    if task == "count":
+        assert dry["estimated_rows"] == 1
@@ -0,0 +1,47 @@
+import os
+
+from poc.execution.executor import run_read_only, run_write
+from poc.execution.result_cache import ResultCache
+
+COUNT_SQL = "SELECT COUNT(*) AS n FROM condition_occurrence WHERE condition_concept_id = :cid"
+
+
+def _n(collected):
+    return collected["rows"][0]["n"]
+
+
+def test_run_write_invalidates_cached_result(omop_db, base_count):
+    params = {"cid": 201826}
+    first, info = run_read_only(COUNT_SQL, params)
+    assert not info["hit"]
+    again, info = run_read_only(COUNT_SQL, params)
+    assert info["hit"] and _n(again) == _n(first)
+
+    run_write("INSERT INTO condition_occurrence VALUES (100001, 1, 201826, '2024-06-01')")
+    after, info = run_read_only(COUNT_SQL, params)
+    assert not info["hit"]
+    assert _n(after) == _n(first) + 1 == base_count("c.condition_concept_id = 201826")
+
+
+def test_disk_tier_is_json_and_sees_other_process_invalidation(tmp_path):
+    a = ResultCache(disk_dir=str(tmp_path))
+    b = ResultCache(disk_dir=str(tmp_path))
+    key = a.make_key("SELECT 1", ["person"], None, a.watermark(["person"]))
+    a.put(key, {"rows": [{"n": 1}]}, ["person"], a.watermark(["person"]))
+    assert os.path.exists(tmp_path / f"{key}.json")
+
+    # b 从磁盘层读取 a 写入的条目
+    value, tier = b.get(key)
+    assert value == {"rows": [{"n": 1}]} and tier == "disk"
+
+    # a（另一个进程）使表失效后，b 不再返回旧条目，且新水位下的键与旧键不同
+    a.invalidate_tables(["person"])
+    assert b.get(key) == (None, None)
+    assert b.make_key("SELECT 1", ["person"], None, b.watermark(["person"])) != key
+
+
+def test_disk_tier_ignores_non_json_files(tmp_path):
+    cache = ResultCache(disk_dir=str(tmp_path))
+    key = cache.make_key("SELECT 1", ["person"])
+    (tmp_path / f"{key}.json").write_bytes(b"\x80\x04K\x01.")
+    assert cache.get(key) == (None, None)
@@ -0,0 +1,37 @@
+import time
+import threading
+
+from poc.execution import scheduler
+from poc.execution.scheduler import run_dag
+from poc.utils.deadline import Deadline
+
+PLAN = [{"id": "a", "action": "slow"}, {"id": "b", "action": "slow"}, {"id": "c", "action": "slow", "depends_on": ["a"]}]
+
+
+def _slow(step, deps):
+    time.sleep(0.3)
+    return {}, {}
+
+
+def test_deadline_marks_running_and_queued_steps():
+    _, records = run_dag(PLAN, {"slow": _slow}, max_workers=1, deadline=Deadline.after(0.05))
+    status = {r["step_id"]: r["status"] for r in records}
+    assert status == {"a": "timeout", "b": "timeout", "c": "skipped"}
+    assert all("elapsed_ms" in r and "_t_end" not in r for r in records)
+
+
+def test_worker_starting_after_abandon_keeps_timeout_record(monkeypatch):
+    """工作线程已开始、尚未登记开始时 deadline 到期：abandon 的记录不能被工作线程覆盖"""
+    started = threading.Event()
+    start = scheduler._DagRun.start
+
+    def _late_start(self, record):
+        time.sleep(0.2)
+        ok = start(self, record)
+        started.set()
+        return ok
+
+    monkeypatch.setattr(scheduler._DagRun, "start", _late_start)
+    _, records = run_dag(PLAN[:1], {"slow": _slow}, deadline=Deadline.after(0.05))
+    assert started.wait(2)
+    assert records[0]["status"] == "timeout" and records[0]["error"] == "request deadline exceeded"
@@ -0,0 +1,33 @@
+import pytest
+import sqlglot
+
+from poc.utils import sqlglot_utils
+from poc.utils.sqlglot_utils import AnalyzedSQL, get_sql_operation_type
+
+SQLS = [
+    "SELECT COUNT(*) FROM condition_occurrence WHERE condition_concept_id = :cid",
+    "INSERT INTO person VALUES (1, 8507, 1980)",
+    "UPDATE person SET year_of_birth = 1981 WHERE person_id = 1",
+    "DELETE FROM condition_occurrence WHERE person_id = 1",
+    "CREATE INDEX ix_p ON person (year_of_birth)",
+    "SELECT 1; DELETE FROM person",
+]
+
+
+@pytest.mark.parametrize("sql", SQLS)
+def test_operations_come_from_the_cached_ast(sql, monkeypatch):
+    expected = get_sql_operation_type(sql)
+    analyzed = AnalyzedSQL(sql)
+    assert analyzed.ast is not None
+
+    def _no_reparse(*_, **__):
+        raise AssertionError("operations must not re-parse the SQL")
+
+    monkeypatch.setattr(sqlglot, "parse", _no_reparse)
+    monkeypatch.setattr(sqlglot_utils, "parse_one", _no_reparse)
+    assert analyzed.operations == expected
+
+
+def test_operations_of_unparsable_sql():
+    ops = AnalyzedSQL("SELEC FROM WHERE (").operations
+    assert ops[0]["type"] == "ERROR"
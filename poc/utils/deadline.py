@@ -0,0 +1,72 @@
+"""
+请求级截止时间（deadline）
+
+一次流水线运行创建一个 Deadline，通过 contextvars 传递到每个步骤：
+- 数据库：转换为语句超时（PostgreSQL: SET LOCAL statement_timeout；SQLite: progress handler 中断）
+- LLM：转换为 OpenAI 客户端的单次请求 timeout
+超时统一抛出 DeadlineExceeded，执行 DAG 中对应步骤的审计状态记为 timeout
+"""
+import time
+import contextlib
+import contextvars
+from typing import Optional
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求级截止时间已到"""
+
+
+class Deadline:
+    def __init__(self, expires_at: Optional[float] = None):
+        """
+        :param expires_at: time.monotonic() 时间点；None 表示不限时
+        """
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds: Optional[float]) -> "Deadline":
+        """seconds 秒后到期；seconds 为 None 或 <= 0 时不限时"""
+        if not seconds or seconds <= 0:
+            return cls(None)
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> Optional[float]:
+        """剩余秒数（不小于 0）；不限时返回 None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self) -> Optional[int]:
+        rem = self.remaining()
+        return None if rem is None else max(1, int(rem * 1000))
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self, what: str = "request"):
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline exceeded before {what}")
+
+
+_CURRENT: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("poc_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """当前上下文的 deadline（未设置时为 None）"""
+    return _CURRENT.get()
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline: Optional[Deadline]):
+    """在 with 块内设置当前 deadline（线程池中的步骤需在工作线程内重新进入）"""
+    token = _CURRENT.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _CURRENT.reset(token)
+
+
+def check_deadline(what: str = "request"):
+    d = current_deadline()
+    if d is not None:
+        d.check(what)
@@ -0,0 +1,131 @@
+"""
+增量 JSON 对象解析（用于 LLM 流式输出）
+
+- 跳过第一个 "{" 之前的内容（```json 代码块标记、前导说明文字等）
+- 顶层字段的值一完成就回调 on_field(key, value)，不必等整个对象结束
+- 顶层对象闭合后 feed() 返回 True，调用方可立即停止读取（丢弃模型在 JSON 之后的多余输出）
+"""
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_UNPARSED = object()
+
+
+class JSONObjectStream:
+    def __init__(self, on_field: Optional[Callable[[str, Any], None]] = None):
+        """
+        :param on_field: 顶层字段完成时的回调 on_field(key, value)；回调中的异常不会中断解析
+        """
+        self.on_field = on_field
+        self.received: List[str] = []   # 收到的全部文本（解析失败时回退使用）
+        self.fields: Dict[str, Any] = {}
+        self.field_ms: Dict[str, float] = {}
+        self.done = False
+
+        self._t0 = time.perf_counter()
+        self._raw: List[str] = []       # 从第一个 "{" 开始的文本
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._expect_key = False
+        self._key_start: Optional[int] = None
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.received)
+
+    def feed(self, chunk: str) -> bool:
+        """输入一段文本；顶层对象已闭合时返回 True"""
+        self.received.append(chunk)
+        for ch in chunk:
+            if self.done:
+                break
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._raw = ["{"]
+                    self._expect_key = True
+                continue
+            self._raw.append(ch)
+            self._step(ch, len(self._raw) - 1)
+        return self.done
+
+    def _step(self, ch: str, pos: int):
+        if self._in_str:
+            if self._esc:
+                self._esc = False
+            elif ch == "\\":
+                self._esc = True
+            elif ch == '"':
+                self._in_str = False
+                if self._depth == 1:
+                    self._string_closed(pos)
+            return
+
+        if ch == '"':
+            self._in_str = True
+            if self._depth == 1 and self._expect_key:
+                self._key_start = pos
+                self._expect_key = False
+        elif ch == ":" and self._depth == 1 and self._key is not None and self._value_start is None:
+            self._value_start = pos + 1
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]":
+            self._depth -= 1
+            if self._depth == 0:
+                self._emit(pos)
+                self.done = True
+        elif ch == "," and self._depth == 1:
+            self._emit(pos)
+            self._expect_key = True
+
+    def _string_closed(self, pos: int):
+        if self._key is None and self._key_start is not None:
+            # 顶层键
+            self._key = self._loads(self._key_start, pos + 1)
+        elif self._value_start is not None:
+            # 顶层字符串值在闭合引号处即完成，不必等到后面的逗号
+            self._emit(pos + 1)
+
+    def _emit(self, end: int):
+        if self._key is not None and self._value_start is not None:
+            value = self._loads(self._value_start, end)
+            if value is not _UNPARSED:
+                key = self._key
+                self.fields[key] = value
+                self.field_ms[key] = round((time.perf_counter() - self._t0) * 1000, 1)
+                if self.on_field is not None:
+                    try:
+                        self.on_field(key, value)
+                    except Exception:
+                        pass
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+    def _loads(self, start: int, end: int):
+        text = "".join(self._raw[start:end]).strip()
+        if not text:
+            return _UNPARSED
+        try:
+            return json.loads(text)
+        except ValueError:
+            return _UNPARSED
+
+    def result(self) -> dict:
+        """完整的顶层对象（仅在 done 后可用）"""
+        if not self.done:
+            raise ValueError("JSON object is not complete")
+        return json.loads("".join(self._raw))
+
+    def timings(self) -> Dict[str, Any]:
+        """审计用：首个字段完成耗时、各字段完成耗时（毫秒，自创建起）"""
+        return {
+            "first_field_ms": min(self.field_ms.values()) if self.field_ms else None,
+            "field_ms": dict(self.field_ms),
+            "complete": self.done,
+        }
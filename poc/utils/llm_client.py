@@ -1,19 +1,451 @@
+"""
+LLM 客户端管理
+
+- 进程内共享的 OpenAI / AsyncOpenAI 客户端（httpx 连接池 + keep-alive），不再每次请求重新握手
+- 每个后端一个并发上限（信号量）
+- 失败重试：指数退避 + 全抖动（full jitter），重试时优先换到其他后端
+- 多后端：主后端（LLM_MODE / LLM_BASE_URL / LLM_MODEL）+ 可选托管回退（LLM_FALLBACK_*），
+  按延迟 EWMA 与在途请求数路由，连续失败的后端冷却一段时间
+- 请求级 deadline：剩余时间作为每次 HTTP 请求的超时，到期抛出 DeadlineExceeded
+- 流式调用：逐块交给调用方，调用方可随时停止读取
+"""
 import os
+import time
+import random
+import asyncio
+import threading
+import weakref
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
+
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    OpenAI, AsyncOpenAI,
+    APIConnectionError, APITimeoutError, RateLimitError, InternalServerError,
+)
+
+from poc.db.config import settings
+from poc.utils.deadline import current_deadline, DeadlineExceeded
 
 load_dotenv()
 
-def get_llm():
+# 可重试的错误：连接失败 / 超时 / 限流 / 5xx
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+# EWMA 平滑系数
+_EWMA_ALPHA = 0.3
+
+
+def _delta_text(chunk) -> Optional[str]:
+    """流式响应块中的文本增量（usage 块等没有 choices）"""
+    if not chunk.choices:
+        return None
+    return chunk.choices[0].delta.content
+
+
+def get_llm_model() -> str:
+    """当前配置的主模型名（不创建客户端；意图缓存键使用）"""
+    default = "llama3:latest" if os.getenv("LLM_MODE", "local") == "local" else "gpt-4o-mini"
+    return os.getenv("LLM_MODEL", default)
+
+
+def _backend_configs() -> List[Dict[str, Any]]:
+    """从环境变量读取后端配置：主后端 + 可选回退后端（配置了 LLM_FALLBACK_MODEL 时启用）"""
     mode = os.getenv("LLM_MODE", "local")
     if mode == "local":
-        base_url = os.getenv("LLM_BASE_URL", "http://127.0.0.1:11434/v1")
-        api_key  = os.getenv("LLM_API_KEY", "ollama")
-        model    = os.getenv("LLM_MODEL", "llama3:latest")
-        client = OpenAI(base_url=base_url, api_key=api_key)
-        return client, model
+        primary = {
+            "name": "local",
+            "base_url": os.getenv("LLM_BASE_URL", "http://127.0.0.1:11434/v1"),
+            "api_key": os.getenv("LLM_API_KEY", "ollama"),
+        }
     else:
-        api_key  = os.getenv("LLM_API_KEY")
-        model    = os.getenv("LLM_MODEL", "gpt-4o-mini")
-        client = OpenAI(api_key=api_key)
-        return client, model
+        primary = {"name": "hosted", "base_url": None, "api_key": os.getenv("LLM_API_KEY")}
+    primary["model"] = get_llm_model()
+    primary["max_concurrency"] = settings.LLM_MAX_CONCURRENCY
+    configs = [primary]
+
+    fallback_model = os.getenv("LLM_FALLBACK_MODEL")
+    if fallback_model:
+        configs.append({
+            "name": "fallback",
+            "base_url": os.getenv("LLM_FALLBACK_BASE_URL") or None,
+            "api_key": os.getenv("LLM_FALLBACK_API_KEY") or os.getenv("OPENAI_API_KEY"),
+            "model": fallback_model,
+            "max_concurrency": int(os.getenv("LLM_FALLBACK_MAX_CONCURRENCY", str(settings.LLM_MAX_CONCURRENCY))),
+        })
+    return configs
+
+
+class LLMBackend:
+    """一个 OpenAI 兼容端点：共享客户端、并发上限、延迟统计"""
+
+    def __init__(self, name: str, base_url: Optional[str], api_key: Optional[str], model: str, max_concurrency: int):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+
+        self._lock = threading.Lock()
+        self._client: Optional[OpenAI] = None
+        self._sem = threading.BoundedSemaphore(self.max_concurrency)
+        # AsyncOpenAI 的连接池与信号量绑定事件循环，按循环分别创建
+        self._async: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+        self.ewma_ms: Optional[float] = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self._stats = {"requests": 0, "failures": 0, "retries": 0}
+
+    # -----------------------
+    # 客户端
+    # -----------------------
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_concurrency,
+            max_keepalive_connections=self.max_concurrency,
+            keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+        )
+
+    def client(self) -> OpenAI:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAI(
+                        base_url=self.base_url,
+                        api_key=self.api_key,
+                        max_retries=0,  # 由 LLMClientManager 统一重试
+                        timeout=settings.LLM_HTTP_TIMEOUT,
+                        http_client=httpx.Client(limits=self._limits(), timeout=settings.LLM_HTTP_TIMEOUT),
+                    )
+        return self._client
+
+    def _async_state(self) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        state = self._async.get(loop)
+        if state is None:
+            state = {
+                "client": AsyncOpenAI(
+                    base_url=self.base_url,
+                    api_key=self.api_key,
+                    max_retries=0,
+                    timeout=settings.LLM_HTTP_TIMEOUT,
+                    http_client=httpx.AsyncClient(limits=self._limits(), timeout=settings.LLM_HTTP_TIMEOUT),
+                ),
+                "sem": asyncio.Semaphore(self.max_concurrency),
+            }
+            self._async[loop] = state
+        return state
+
+    def async_client(self) -> AsyncOpenAI:
+        return self._async_state()["client"]
+
+    # -----------------------
+    # 路由统计
+    # -----------------------
+    def available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def score(self) -> float:
+        """
+        路由打分（越小越优先）：延迟 EWMA × (1 + 在途与排队请求数 / 并发上限)；
+        尚无样本时视为 0（先各试一次），同分按配置顺序优先
+        """
+        load = self.in_flight / self.max_concurrency
+        return (self.ewma_ms or 0.0) * (1 + load)
+
+    def _begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self._stats["requests"] += 1
+
+    def _abort(self):
+        # 请求被取消或未拿到槽位（不是后端故障）：只释放在途计数
+        with self._lock:
+            self.in_flight -= 1
+
+    def _retry(self):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def _end(self, elapsed_ms: Optional[float]):
+        with self._lock:
+            self.in_flight -= 1
+            if elapsed_ms is None:
+                self._stats["failures"] += 1
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= settings.LLM_FAILURE_THRESHOLD:
+                    self.cooldown_until = time.monotonic() + settings.LLM_COOLDOWN_S
+            else:
+                self.consecutive_failures = 0
+                self.cooldown_until = 0.0
+                self.ewma_ms = elapsed_ms if self.ewma_ms is None else (
+                    _EWMA_ALPHA * elapsed_ms + (1 - _EWMA_ALPHA) * self.ewma_ms
+                )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out.update({
+                "model": self.model,
+                "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+                "in_flight": self.in_flight,
+                "cooling_down": not self.available(),
+            })
+        return out
+
+
+class LLMClientManager:
+    """进程内共享：按延迟路由到可用后端，失败时退避重试"""
+
+    def __init__(self, backends: List[LLMBackend], max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 8.0):
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = backends
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def primary(self) -> LLMBackend:
+        return self.backends[0]
+
+    def route(self, exclude: Tuple[str, ...] = ()) -> LLMBackend:
+        """选择打分最低的可用后端；全部冷却中时忽略冷却状态"""
+        candidates = [b for b in self.backends if b.name not in exclude] or self.backends
+        healthy = [b for b in candidates if b.available()] or candidates
+        return min(healthy, key=lambda b: (b.score(), self.backends.index(b)))
+
+    def _backoff(self, attempt: int) -> float:
+        # 全抖动：[0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _slot_wait() -> Optional[float]:
+        """等待并发槽位的上限：deadline 剩余时间；未设置 deadline 时一直等待"""
+        deadline = current_deadline()
+        if deadline is None or deadline.expires_at is None:
+            return None
+        return deadline.remaining()
+
+    @staticmethod
+    def _timeout() -> Optional[float]:
+        """单次请求超时：deadline 剩余时间与 LLM_HTTP_TIMEOUT 取小"""
+        deadline = current_deadline()
+        if deadline is None or deadline.expires_at is None:
+            return settings.LLM_HTTP_TIMEOUT
+        deadline.check("LLM request")
+        return min(settings.LLM_HTTP_TIMEOUT, deadline.remaining())
+
+    @staticmethod
+    def _deadline_error(e: Exception) -> Exception:
+        deadline = current_deadline()
+        if deadline is not None and deadline.expired():
+            return DeadlineExceeded(f"LLM request timed out at request deadline: {e}")
+        return e
+
+    def _sleep_budget(self, attempt: int) -> Optional[float]:
+        """重试前的退避时间；deadline 剩余时间不足时返回 None（不再重试）"""
+        delay = self._backoff(attempt)
+        deadline = current_deadline()
+        if deadline is not None and deadline.expires_at is not None and deadline.remaining() <= delay:
+            return None
+        return delay
+
+    def _run(self, call: Callable[[LLMBackend, Optional[float]], Any]):
+        """
+        路由 + 并发槽位 + 退避重试的通用调用：call(backend, timeout) 发出一次请求
+        Returns:
+            (call 的返回值, call_info)；call_info: {"backend", "model", "attempts", "latency_ms"}
+        """
+        tried: Tuple[str, ...] = ()
+        for attempt in range(self.max_retries + 1):
+            backend = self.route(exclude=tried)
+            timeout = self._timeout()
+            backend._begin()  # 排队等待槽位的请求也计入负载，路由时避开积压的后端
+            if not backend._sem.acquire(timeout=self._slot_wait()):
+                backend._abort()
+                raise DeadlineExceeded(f"Timed out waiting for LLM backend '{backend.name}' concurrency slot")
+            t0 = time.perf_counter()
+            try:
+                result = call(backend, timeout)
+            except RETRYABLE_ERRORS as e:
+                backend._end(None)
+                err = self._deadline_error(e)
+                delay = None if err is not e or attempt == self.max_retries else self._sleep_budget(attempt)
+                if delay is None:
+                    raise err from e
+                backend._retry()
+                tried += (backend.name,)
+                time.sleep(delay)
+                continue
+            except Exception:
+                backend._end(None)
+                raise
+            finally:
+                backend._sem.release()
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            backend._end(elapsed_ms)
+            return result, {"backend": backend.name, "model": backend.model,
+                            "attempts": attempt + 1, "latency_ms": round(elapsed_ms, 1)}
+
+    async def _arun(self, call: Callable[[LLMBackend, AsyncOpenAI, Optional[float]], Awaitable]):
+        """_run 的异步版本：call(backend, async client, timeout) 为协程"""
+        tried: Tuple[str, ...] = ()
+        for attempt in range(self.max_retries + 1):
+            backend = self.route(exclude=tried)
+            timeout = self._timeout()
+            state = backend._async_state()
+            backend._begin()
+            try:
+                await asyncio.wait_for(state["sem"].acquire(), timeout=self._slot_wait())
+            except asyncio.TimeoutError:
+                backend._abort()
+                raise DeadlineExceeded(f"Timed out waiting for LLM backend '{backend.name}' concurrency slot")
+            except asyncio.CancelledError:
+                backend._abort()
+                raise
+            t0 = time.perf_counter()
+            try:
+                result = await call(backend, state["client"], timeout)
+            except RETRYABLE_ERRORS as e:
+                backend._end(None)
+                err = self._deadline_error(e)
+                delay = None if err is not e or attempt == self.max_retries else self._sleep_budget(attempt)
+                if delay is None:
+                    raise err from e
+                backend._retry()
+                tried += (backend.name,)
+                await asyncio.sleep(delay)
+                continue
+            except asyncio.CancelledError:
+                backend._abort()
+                raise
+            except Exception:
+                backend._end(None)
+                raise
+            finally:
+                state["sem"].release()
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            backend._end(elapsed_ms)
+            return result, {"backend": backend.name, "model": backend.model,
+                            "attempts": attempt + 1, "latency_ms": round(elapsed_ms, 1)}
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **params):
+        """
+        同步调用 chat.completions.create（model 由路由到的后端决定）
+        Returns:
+            (response, call_info)
+        """
+        return self._run(lambda backend, timeout: backend.client().chat.completions.create(
+            model=backend.model, messages=messages, timeout=timeout, **params
+        ))
+
+    async def achat_completion(self, messages: List[Dict[str, Any]], **params):
+        """chat_completion 的异步版本"""
+        return await self._arun(lambda backend, client, timeout: client.chat.completions.create(
+            model=backend.model, messages=messages, timeout=timeout, **params
+        ))
+
+    def stream_completion(self, messages: List[Dict[str, Any]], consume: Callable[[str], bool], **params):
+        """
+        流式调用：每个文本增量交给 consume(text)，consume 返回 True 时立即停止读取并关闭连接
+        （本地模型常在 JSON 之后继续输出解释文字）
+        只有在收到第一个增量之前失败才会重试，已输出的内容不会重复交给 consume
+        Returns:
+            (stream_info, call_info)；stream_info: {"ttft_ms", "chunks", "stopped_early"}
+        """
+        def _call(backend, timeout):
+            info = {"ttft_ms": None, "chunks": 0, "stopped_early": False}
+            t0 = time.perf_counter()
+            stream = backend.client().chat.completions.create(
+                model=backend.model, messages=messages, timeout=timeout, stream=True, **params
+            )
+            try:
+                for chunk in stream:
+                    text = _delta_text(chunk)
+                    if not text:
+                        continue
+                    if info["ttft_ms"] is None:
+                        info["ttft_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                    info["chunks"] += 1
+                    if consume(text):
+                        info["stopped_early"] = True
+                        break
+            except RETRYABLE_ERRORS as e:
+                if info["chunks"]:
+                    raise self._interrupted(e) from e
+                raise
+            finally:
+                stream.close()
+            return info
+
+        return self._run(_call)
+
+    async def astream_completion(self, messages: List[Dict[str, Any]], consume: Callable[[str], bool], **params):
+        """stream_completion 的异步版本"""
+        async def _call(backend, client, timeout):
+            info = {"ttft_ms": None, "chunks": 0, "stopped_early": False}
+            t0 = time.perf_counter()
+            stream = await client.chat.completions.create(
+                model=backend.model, messages=messages, timeout=timeout, stream=True, **params
+            )
+            try:
+                async for chunk in stream:
+                    text = _delta_text(chunk)
+                    if not text:
+                        continue
+                    if info["ttft_ms"] is None:
+                        info["ttft_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                    info["chunks"] += 1
+                    if consume(text):
+                        info["stopped_early"] = True
+                        break
+            except RETRYABLE_ERRORS as e:
+                if info["chunks"]:
+                    raise self._interrupted(e) from e
+                raise
+            finally:
+                await stream.close()
+            return info
+
+        return await self._arun(_call)
+
+    def _interrupted(self, e: Exception) -> Exception:
+        # 流已输出部分内容后中断：不能重试（consume 已收到前半段）
+        err = self._deadline_error(e)
+        return err if err is not e else RuntimeError(f"LLM stream interrupted: {e}")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {b.name: b.stats() for b in self.backends}
+
+
+_MANAGER: Optional[LLMClientManager] = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def get_llm_manager() -> LLMClientManager:
+    """获取进程内共享的 LLM 客户端管理器（后端配置来自环境变量，重试 / 并发配置来自 Settings）"""
+    global _MANAGER
+    if _MANAGER is None:
+        with _MANAGER_LOCK:
+            if _MANAGER is None:
+                _MANAGER = LLMClientManager(
+                    [LLMBackend(**cfg) for cfg in _backend_configs()],
+                    max_retries=settings.LLM_MAX_RETRIES,
+                    backoff_base=settings.LLM_BACKOFF_BASE,
+                    backoff_max=settings.LLM_BACKOFF_MAX,
+                )
+    return _MANAGER
+
+
+def get_llm():
+    """主后端的共享客户端，返回 (OpenAI client, model)"""
+    backend = get_llm_manager().primary()
+    return backend.client(), backend.model
+
+
+def get_async_llm():
+    """get_llm 的异步版本，返回 (AsyncOpenAI client, model)；需在事件循环中调用"""
+    backend = get_llm_manager().primary()
+    return backend.async_client(), backend.model
@@ -1,7 +1,10 @@
-from .sqlglot_utils import get_statement_type, get_tables
+from .sqlglot_utils import AnalyzedSQL, analyze_sql
 
-def assess_risk(sql: str, estimated_rows: int | None = None):
-    st = get_statement_type(sql)
+def assess_risk(sql: str | AnalyzedSQL, estimated_rows: int | None = None, estimated_cost: float | None = None):
+    from poc.db.config import settings
+
+    analyzed = sql if isinstance(sql, AnalyzedSQL) else analyze_sql(sql)
+    st = analyzed.statement_type
     risk = "low"
     needs_approval = False
 
@@ -13,14 +16,21 @@ def assess_risk(sql: str, estimated_rows: int | None = None):
     else:
         risk = "medium"
 
-    if estimated_rows is not None:
-        if estimated_rows > 10000:
-            # 简单规则：行数大提升风险
-            risk = "medium" if risk == "low" else risk
+    # 简单规则：估算行数或规划器代价过大时提升风险
+    too_many_rows = estimated_rows is not None and estimated_rows > settings.RISK_ROW_THRESHOLD
+    too_costly = (
+        estimated_cost is not None
+        and settings.RISK_COST_THRESHOLD > 0
+        and estimated_cost > settings.RISK_COST_THRESHOLD
+    )
+    if too_many_rows or too_costly:
+        risk = "medium" if risk == "low" else risk
 
     return {
         "statement_type": st,
-        "tables": get_tables(sql),
+        "tables": list(analyzed.tables),
         "risk": risk,
-        "needs_approval": needs_approval
+        "needs_approval": needs_approval,
+        "estimated_rows": estimated_rows,
+        "estimated_cost": estimated_cost,
     }
@@ -1,35 +1,157 @@
+import hashlib
+from functools import cached_property, lru_cache
+from typing import Any, Dict, List, Optional, Union
+
 import sqlglot
 from sqlglot import parse_one, exp
 
 READ_ONLY_TYPES = {"SELECT"}
 
-def get_statement_type(sql: str) -> str:
-    try:
-        node = parse_one(sql)
-        return node.key.upper()
-    except Exception:
-        return "UNKNOWN"
+# SQL 模板的书写方言：模板按 PostgreSQL 语法书写，再转译到实际数据库的方言
+TEMPLATE_DIALECT = "postgres"
+
+# analyze_sql 缓存的 SQL 文本数（LRU）
+ANALYSIS_CACHE_SIZE = 1024
+
+
+# =====================================================
+# SQL 分析对象：一条 SQL 只解析一次
+# =====================================================
+
+class AnalyzedSQL:
+    """
+    一条 SQL 的分析结果：AST 只解析一次，语句类型 / 表 / 只读 / 操作类型 / 规范化指纹 / 转译文本
+    在首次访问时计算并缓存；同一 SQL 文本经 analyze_sql 共享同一个对象（AST 只读，不要原地修改）
+    """
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self._asts: Dict[Optional[str], Any] = {}
+        self._transpiled: Dict[tuple, str] = {}
+
+    def __repr__(self) -> str:
+        return f"AnalyzedSQL({self.sql[:60]!r})"
+
+    def parse(self, read: Optional[str] = None) -> exp.Expression:
+        """按 read 方言解析（结果与解析错误都会缓存）；解析失败时抛出异常"""
+        if read not in self._asts:
+            try:
+                self._asts[read] = parse_one(self.sql, read=read)
+            except Exception as e:
+                self._asts[read] = e
+        node = self._asts[read]
+        if isinstance(node, Exception):
+            raise node
+        return node
+
+    @cached_property
+    def ast(self) -> Optional[exp.Expression]:
+        """默认方言下的 AST；解析失败时为 None"""
+        try:
+            return self.parse()
+        except Exception:
+            return None
+
+    @cached_property
+    def statement_type(self) -> str:
+        return self.ast.key.upper() if self.ast is not None else "UNKNOWN"
+
+    @cached_property
+    def tables(self) -> List[str]:
+        return [t.name for t in self.ast.find_all(exp.Table)] if self.ast is not None else []
+
+    @cached_property
+    def read_only(self) -> bool:
+        return self.statement_type in READ_ONLY_TYPES
+
+    @cached_property
+    def operations(self) -> List[Dict[str, Any]]:
+        """操作类型（CRUD / DDL，见 get_sql_operation_type），由缓存的 AST 得出；多条语句解析为 Block"""
+        if self.ast is None:
+            # 解析失败：按原逻辑给出 ERROR 条目
+            return get_sql_operation_type(self.sql)
+        block = getattr(exp, "Block", None)
+        return operation_types(self.ast.expressions if block and isinstance(self.ast, block) else [self.ast])
 
-def is_read_only(sql: str) -> bool:
-    t = get_statement_type(sql)
-    return t in READ_ONLY_TYPES
+    @cached_property
+    def fingerprint(self) -> str:
+        """规范化 SQL 指纹：AST 重新生成（统一大小写、空白、引号）后取 sha256；解析失败时按空白规范化"""
+        if self.ast is not None:
+            canonical = self.ast.sql(normalize=True, comments=False)
+        else:
+            canonical = " ".join(self.sql.split())
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def transpiled(self, write: str = None, read: str = TEMPLATE_DIALECT) -> str:
+        """转译到 write 方言（默认当前配置的数据库），:name 绑定参数保持不变；解析失败时抛出异常"""
+        from poc.db.database import sql_dialect
+
+        write = write or sql_dialect()
+        key = (write, read)
+        if key not in self._transpiled:
+            # transform 默认复制 AST，缓存的 AST 不会被修改
+            self._transpiled[key] = self.parse(read).transform(_portable(write)).sql(dialect=write)
+        return self._transpiled[key]
+
+
+@lru_cache(maxsize=ANALYSIS_CACHE_SIZE)
+def analyze_sql(sql: str) -> AnalyzedSQL:
+    """取 SQL 的分析对象（按文本 LRU 缓存；同一次运行中风险评估 / 缓存键 / 审计 / 重放共享）"""
+    return AnalyzedSQL(sql)
+
+def _analyzed(sql: Union[str, AnalyzedSQL]) -> AnalyzedSQL:
+    return sql if isinstance(sql, AnalyzedSQL) else analyze_sql(sql)
+
+
+def get_statement_type(sql: Union[str, AnalyzedSQL]) -> str:
+    return _analyzed(sql).statement_type
+
+def is_read_only(sql: Union[str, AnalyzedSQL]) -> bool:
+    return _analyzed(sql).read_only
 
 def wrap_count_subquery(sql: str) -> str:
     # SELECT COUNT(*) FROM ( <sql> ) t
     return f"SELECT COUNT(*) AS estimated_rows FROM ({sql}) t"
 
-def get_tables(sql: str):
-    try:
-        node = parse_one(sql)
-        return [t.name for t in node.find_all(exp.Table)]
-    except Exception:
-        return []
+def get_tables(sql: Union[str, AnalyzedSQL]) -> List[str]:
+    # 返回副本：调用方可能修改列表，不能影响缓存
+    return list(_analyzed(sql).tables)
+
+def _portable(dialect: str):
+    """sqlglot 转译时的修正：保留 :name 绑定参数；补上目标方言缺少的日期函数"""
+    def _fix(node):
+        # sqlglot 会把占位符改写成目标驱动风格（%(name)s / $name），
+        # 这里保持 :name，由 SQLAlchemy text() 统一转换
+        if isinstance(node, exp.Placeholder) and node.name:
+            return exp.var(f":{node.name}")
+        # SQLite 没有 EXTRACT：按年分桶改为 CAST(STRFTIME('%Y', x) AS INTEGER)
+        if dialect == "sqlite" and isinstance(node, exp.Extract) and node.this.name.upper() == "YEAR":
+            year = exp.Anonymous(this="STRFTIME", expressions=[exp.Literal.string("%Y"), node.expression])
+            return exp.cast(year, "INTEGER")
+        # SQLite 没有 DATE_TRUNC：按月截断改为 DATE(x, 'start of month')
+        if (dialect == "sqlite" and isinstance(node, (exp.DateTrunc, exp.TimestampTrunc))
+                and node.text("unit").upper() == "MONTH"):
+            return exp.Anonymous(this="DATE", expressions=[node.this, exp.Literal.string("start of month")])
+        return node
+    return _fix
+
+def transpile_sql(sql: Union[str, AnalyzedSQL], write: str = None, read: str = TEMPLATE_DIALECT) -> str:
+    """
+    把 SQL 从 read 方言转译到 write 方言（默认当前配置的数据库），:name 绑定参数保持不变
+    """
+    return _analyzed(sql).transpiled(write, read)
 
-def pretty(sql: str) -> str:
+def pretty(sql: Union[str, AnalyzedSQL], dialect: str = None) -> str:
+    """按当前数据库方言规范化 SQL（展示用）；解析失败时原样返回"""
+    analyzed = _analyzed(sql)
     try:
-        return sqlglot.transpile(sql, read="duckdb", write="sqlite")[0]
+        from poc.db.database import sql_dialect
+
+        dialect = dialect or sql_dialect()
+        return analyzed.transpiled(write=dialect, read=dialect)
     except Exception:
-        return sql
+        return analyzed.sql
+
 def get_sql_operation_type(sql_code):
     """
     解析 SQL 并返回操作类型 (CRUD / DDL) 以及具体的命令
@@ -39,7 +161,11 @@ def get_sql_operation_type(sql_code):
         parsed_expressions = sqlglot.parse(sql_code)
     except Exception as e:
         return [{"sql": sql_code, "type": "ERROR", "detail": str(e)}]
+    return operation_types(parsed_expressions)
+
 
+def operation_types(parsed_expressions: List[exp.Expression]) -> List[Dict[str, Any]]:
+    """已解析语句的操作类型（get_sql_operation_type / AnalyzedSQL.operations 共用，不再解析）"""
     results = []
 
     for expression in parsed_expressions:
@@ -0,0 +1,106 @@
+"""
+概念祖先 / 后代闭包（OMOP concept_ancestor）
+
+concept_ancestor 本身就是传递闭包（每个祖先到其全部后代各一行，含自身）。
+构建时按祖先分组、后代升序，写成 CSR 形式的三个数组（与概念索引同一目录）：
+- anc_key.u32    有后代记录的祖先概念 ID，升序
+- anc_off.u32    每个祖先的后代在 anc_desc 中的起始偏移（len(anc_key) + 1 项）
+- anc_desc.u32   后代概念 ID（每组内升序，包含祖先自身）
+
+查询：祖先 ID 二分定位（O(log n)），后代是 mmap 上的零拷贝切片；请求期间不执行递归 SQL。
+"""
+import os
+import bisect
+import threading
+from array import array
+from typing import Dict, Any, Optional
+
+from poc.db.config import settings
+from poc.vocab.concept_index import MappedArrays, write_arrays, read_vocab_rows
+
+_FILES = {
+    "anc_key": ("anc_key.u32", "I", 4),
+    "anc_off": ("anc_off.u32", "I", 4),
+    "anc_desc": ("anc_desc.u32", "I", 4),
+}
+
+
+def build_ancestry(ancestor_path: str, out_dir: str, concept_ids: Optional[array] = None, log=print) -> Dict[str, Any]:
+    """
+    从 CONCEPT_ANCESTOR.csv 构建闭包数组（由 build_concept_index 调用）
+    :param concept_ids: 概念索引中的概念 ID（升序）；给出时只保留两端都在索引中的行
+    :return: 统计信息（写入概念索引 meta.json 的 ancestry 字段）
+    """
+    def _known(cid: int) -> bool:
+        if concept_ids is None:
+            return True
+        i = bisect.bisect_left(concept_ids, cid)
+        return i < len(concept_ids) and concept_ids[i] == cid
+
+    groups: Dict[int, array] = {}
+    rows = 0
+    for row in read_vocab_rows(ancestor_path):
+        anc, desc = int(row["ancestor_concept_id"]), int(row["descendant_concept_id"])
+        if _known(anc) and _known(desc):
+            groups.setdefault(anc, array("I")).append(desc)
+            rows += 1
+
+    anc_key, anc_off, anc_desc = array("I"), array("I", [0]), array("I")
+    widest = 0
+    for anc in sorted(groups):
+        descendants = set(groups.pop(anc))
+        descendants.add(anc)    # 个别词表缺少 0 级自身行
+        anc_key.append(anc)
+        anc_desc.extend(sorted(descendants))
+        anc_off.append(len(anc_desc))
+        widest = max(widest, len(descendants))
+
+    write_arrays(out_dir, _FILES, {"anc_key": anc_key, "anc_off": anc_off, "anc_desc": anc_desc})
+    log(f"ancestry: {len(anc_key)} ancestors, {len(anc_desc)} closure rows")
+    return {"rows": rows, "ancestors": len(anc_key), "closure_rows": len(anc_desc), "max_descendants": widest}
+
+
+class ConceptAncestry(MappedArrays):
+    """只读祖先 / 后代闭包（mmap）"""
+
+    def __init__(self, path: str):
+        super().__init__(path, _FILES)
+
+    def descendants(self, concept_id: int) -> memoryview:
+        """
+        concept_id 的全部后代（升序，包含自身）；不在闭包中的概念只返回自身
+        返回 mmap 上的切片，需要列表时调用 .tolist()
+        """
+        k = bisect.bisect_left(self._anc_key, concept_id)
+        if k < len(self._anc_key) and self._anc_key[k] == concept_id:
+            return self._anc_desc[self._anc_off[k]:self._anc_off[k + 1]]
+        return memoryview(array("I", [concept_id]))
+
+    def descendant_count(self, concept_id: int) -> int:
+        k = bisect.bisect_left(self._anc_key, concept_id)
+        if k < len(self._anc_key) and self._anc_key[k] == concept_id:
+            return self._anc_off[k + 1] - self._anc_off[k]
+        return 1
+
+    def is_descendant(self, concept_id: int, ancestor_id: int) -> bool:
+        desc = self.descendants(ancestor_id)
+        i = bisect.bisect_left(desc, concept_id)
+        return i < len(desc) and desc[i] == concept_id
+
+
+_ANCESTRY: Optional[ConceptAncestry] = None
+_ANCESTRY_LOADED = False
+_ANCESTRY_LOCK = threading.Lock()
+
+
+def get_concept_ancestry() -> Optional[ConceptAncestry]:
+    """进程内共享的闭包；概念索引目录中没有闭包文件时返回 None（条件只匹配概念自身）"""
+    global _ANCESTRY, _ANCESTRY_LOADED
+    if not _ANCESTRY_LOADED:
+        with _ANCESTRY_LOCK:
+            if not _ANCESTRY_LOADED:
+                path = settings.CONCEPT_INDEX_DIR
+                if path and os.path.exists(os.path.join(path, _FILES["anc_key"][0])):
+                    _ANCESTRY = ConceptAncestry(path)
+                _ANCESTRY_LOADED = True
+    return _ANCESTRY
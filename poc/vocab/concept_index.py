@@ -0,0 +1,536 @@
+"""
+OMOP 概念索引（concept / concept_synonym 词表）
+
+离线构建：从 Athena 导出的 CONCEPT.csv / CONCEPT_SYNONYM.csv（制表符分隔）批量加载，
+写成一组定长二进制数组文件（CONCEPT_INDEX_DIR）；运行时以 mmap 只读映射，
+不占用进程堆、多进程共享页缓存，请求期间不访问数据库。
+
+文件布局（本机字节序，meta.json 记录 byteorder 与各名称表）：
+- ids.u32                       概念 ID 升序；下标即概念序号
+- name_off.u32 / names.utf8     概念名（偏移表 N+1 项）
+- domain.u8 / vocab.u8 / standard.u8
+                                domain_id / vocabulary_id 编号、standard_concept（S / C / 0）
+- entry_concept.u32 / entry_kind.u8 / entry_off.u32 / entry_text.utf8
+                                词条（概念名 + 同义词）：所属概念序号、类型（0 名称 / 1 同义词）、规范化文本
+- key_hash.u64 / key_entry.u32  规范化词条的 64 位哈希（升序）-> 词条：精确 / 同义词查找（二分）
+- tri_key.u32 / tri_off.u32 / tri_post.u32
+                                三元组 -> 词条倒排表：模糊查找（稀有三元组取候选，再按 Dice 系数精确重排）
+- anc_key.u32 / anc_off.u32 / anc_desc.u32
+                                祖先 -> 后代闭包（可选，见 poc/vocab/concept_ancestor.py）
+
+用法：
+    python -m poc.vocab.concept_index build /path/to/athena --domains Condition,Drug,Gender
+    python -m poc.vocab.concept_index lookup "type 2 diabetes" --domain Condition
+"""
+import os
+import re
+import sys
+import csv
+import json
+import mmap
+import time
+import zlib
+import bisect
+import shutil
+import hashlib
+import argparse
+import datetime
+import functools
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Set
+
+from poc.db.config import settings
+
+FORMAT_VERSION = 1
+
+# 内置种子映射：优先于词表（与本地样例数据一致；未构建索引时也能解析常见条件）
+CONDITION_CONCEPT_MAP = {
+    "type 2 diabetes": 319835,
+    "t2dm": 319835,
+    "diabetes": 319835,
+    "hypertension": 201826,
+}
+
+# 性别映射：字符串 -> concept_id
+GENDER_CONCEPT_MAP = {
+    "M": 8507,  # Male
+    "F": 8532,  # Female
+    "male": 8507,
+    "female": 8532,
+}
+
+_KIND_NAME, _KIND_SYNONYM = 0, 1
+_KIND_LABELS = ("name", "synonym")
+
+# 模糊查找：从最稀有的三元组开始累计倒排表，累计长度超过预算后不再读取更高频的三元组
+# （"ion"、"  d" 这类片段几乎命中所有词条，对候选没有区分度）；计数最高的若干候选按 Dice 系数精确重排
+_FUZZY_POSTINGS_BUDGET = 50_000
+_FUZZY_CANDIDATES = 500
+
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+# (文件名, array 类型码, 单元素字节数)
+_FILES = {
+    "ids": ("ids.u32", "I", 4),
+    "name_off": ("name_off.u32", "I", 4),
+    "names": ("names.utf8", "B", 1),
+    "domain": ("domain.u8", "B", 1),
+    "vocab": ("vocab.u8", "B", 1),
+    "standard": ("standard.u8", "B", 1),
+    "entry_concept": ("entry_concept.u32", "I", 4),
+    "entry_kind": ("entry_kind.u8", "B", 1),
+    "entry_off": ("entry_off.u32", "I", 4),
+    "entry_text": ("entry_text.utf8", "B", 1),
+    "key_hash": ("key_hash.u64", "Q", 8),
+    "key_entry": ("key_entry.u32", "I", 4),
+    "tri_key": ("tri_key.u32", "I", 4),
+    "tri_off": ("tri_off.u32", "I", 4),
+    "tri_post": ("tri_post.u32", "I", 4),
+}
+
+
+def normalize_term(term: str) -> str:
+    """规范化词条：NFKC、小写、标点与下划线视为空白、合并空白（"Type-2 Diabetes" -> "type 2 diabetes"）"""
+    t = unicodedata.normalize("NFKC", term or "").lower()
+    return " ".join(_NON_WORD_RE.sub(" ", t).split())
+
+
+def _key_hash(norm: str) -> int:
+    return int.from_bytes(hashlib.blake2b(norm.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def trigrams(norm: str) -> Set[int]:
+    """规范化词条的三元组编码（前补两个空格、后补一个空格，与 pg_trgm 相同）"""
+    padded = f"  {norm} "
+    return {zlib.crc32(padded[i:i + 3].encode("utf-8")) for i in range(len(padded) - 2)}
+
+
+# =====================================================
+# 构建
+# =====================================================
+
+def _find_file(vocab_dir: str, name: str) -> Optional[str]:
+    for candidate in (name, name.lower()):
+        path = os.path.join(vocab_dir, candidate)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_vocab_rows(path: str) -> Iterator[Dict[str, str]]:
+    # Athena 导出为制表符分隔、不加引号（概念名中可能出现双引号）
+    csv.field_size_limit(sys.maxsize)
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        yield from csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+
+
+def _code(table: Dict[str, int], value: str, what: str) -> int:
+    if value not in table:
+        if len(table) >= 255:
+            raise ValueError(f"Too many distinct {what} values for a u8 code (> 255)")
+        table[value] = len(table) + 1   # 0 表示空
+    return table[value]
+
+
+def build_concept_index(
+    vocab_dir: str,
+    out_dir: Optional[str] = None,
+    domains: Optional[Iterable[str]] = None,
+    log=print,
+) -> Dict[str, Any]:
+    """
+    从 Athena 词表目录构建概念索引
+    :param vocab_dir: 含 CONCEPT.csv（必需）与 CONCEPT_SYNONYM.csv、CONCEPT_ANCESTOR.csv（可选）的目录
+    :param out_dir: 输出目录，默认 settings.CONCEPT_INDEX_DIR；构建完成后整体替换旧索引
+    :param domains: 只收录这些 domain_id（如 Condition / Drug / Gender），None 表示全部
+    :return: meta（概念数、词条数、三元组数、构建耗时等）
+    """
+    out_dir = out_dir or settings.CONCEPT_INDEX_DIR
+    concept_path = _find_file(vocab_dir, "CONCEPT.csv")
+    if concept_path is None:
+        raise FileNotFoundError(f"CONCEPT.csv not found in {vocab_dir}")
+    synonym_path = _find_file(vocab_dir, "CONCEPT_SYNONYM.csv")
+    domain_filter = set(domains) if domains else None
+    t0 = time.perf_counter()
+
+    # 1) 概念：跳过已作废（invalid_reason = D / U）的概念
+    ids, names = array("I"), []
+    dom, voc, std = array("B"), array("B"), array("B")
+    domain_codes: Dict[str, int] = {}
+    vocab_codes: Dict[str, int] = {}
+    for row in read_vocab_rows(concept_path):
+        if row.get("invalid_reason") or (domain_filter and row["domain_id"] not in domain_filter):
+            continue
+        ids.append(int(row["concept_id"]))
+        names.append(row["concept_name"])
+        dom.append(_code(domain_codes, row["domain_id"], "domain_id"))
+        voc.append(_code(vocab_codes, row["vocabulary_id"], "vocabulary_id"))
+        std.append(ord(row["standard_concept"][:1]) if row.get("standard_concept") else 0)
+    log(f"concepts: {len(ids)} ({time.perf_counter() - t0:.1f}s)")
+
+    order = sorted(range(len(ids)), key=ids.__getitem__)
+    ids = array("I", (ids[i] for i in order))
+    names = [names[i] for i in order]
+    dom = array("B", (dom[i] for i in order))
+    voc = array("B", (voc[i] for i in order))
+    std = array("B", (std[i] for i in order))
+
+    # 2) 同义词（按概念序号归组，去掉与概念名相同或重复的同义词）
+    synonyms: Dict[int, List[str]] = {}
+    if synonym_path:
+        for row in read_vocab_rows(synonym_path):
+            cid = int(row["concept_id"])
+            i = bisect.bisect_left(ids, cid)
+            if i < len(ids) and ids[i] == cid:
+                synonyms.setdefault(i, []).append(row["concept_synonym_name"])
+
+    # 3) 词条、精确键、三元组倒排表
+    name_off, blob = array("I", [0]), bytearray()
+    entry_concept, entry_kind = array("I"), array("B")
+    entry_off, entry_text = array("I", [0]), bytearray()
+    hashes = array("Q")
+    postings: Dict[int, array] = {}
+
+    def _add_entry(concept_idx: int, kind: int, norm: str):
+        entry = len(entry_concept)
+        entry_concept.append(concept_idx)
+        entry_kind.append(kind)
+        entry_text.extend(norm.encode("utf-8"))
+        entry_off.append(len(entry_text))
+        hashes.append(_key_hash(norm))
+        for g in trigrams(norm):
+            postings.setdefault(g, array("I")).append(entry)
+
+    for i, name in enumerate(names):
+        blob += name.encode("utf-8")
+        name_off.append(len(blob))
+        norm = normalize_term(name)
+        seen = {norm}
+        if norm:
+            _add_entry(i, _KIND_NAME, norm)
+        for syn in synonyms.pop(i, ()):
+            syn_norm = normalize_term(syn)
+            if syn_norm and syn_norm not in seen:
+                seen.add(syn_norm)
+                _add_entry(i, _KIND_SYNONYM, syn_norm)
+    log(f"entries: {len(entry_concept)} ({time.perf_counter() - t0:.1f}s)")
+
+    key_order = sorted(range(len(hashes)), key=hashes.__getitem__)
+    key_hash = array("Q", (hashes[i] for i in key_order))
+    key_entry = array("I", key_order)
+
+    tri_key, tri_off, tri_post = array("I"), array("I", [0]), array("I")
+    for g in sorted(postings):
+        tri_key.append(g)
+        tri_post.extend(postings[g])
+        tri_off.append(len(tri_post))
+
+    arrays = {
+        "ids": ids, "name_off": name_off, "names": array("B", blob),
+        "domain": dom, "vocab": voc, "standard": std,
+        "entry_concept": entry_concept, "entry_kind": entry_kind,
+        "entry_off": entry_off, "entry_text": array("B", entry_text),
+        "key_hash": key_hash, "key_entry": key_entry,
+        "tri_key": tri_key, "tri_off": tri_off, "tri_post": tri_post,
+    }
+    meta = {
+        "format": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "built_at": datetime.datetime.utcnow().isoformat(),
+        "source": os.path.abspath(vocab_dir),
+        "domain_filter": sorted(domain_filter) if domain_filter else None,
+        "concepts": len(ids),
+        "entries": len(entry_concept),
+        "trigrams": len(tri_key),
+        "postings": len(tri_post),
+        "domains": [d for d, _ in sorted(domain_codes.items(), key=lambda kv: kv[1])],
+        "vocabularies": [v for v, _ in sorted(vocab_codes.items(), key=lambda kv: kv[1])],
+        "build_s": None,
+    }
+
+    # 写入临时目录后整体替换，读取方不会看到半成品
+    tmp_dir = out_dir.rstrip("/\\") + ".building"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    write_arrays(tmp_dir, _FILES, arrays)
+
+    # 祖先 / 后代闭包（CONCEPT_ANCESTOR.csv 存在时）
+    ancestor_path = _find_file(vocab_dir, "CONCEPT_ANCESTOR.csv")
+    if ancestor_path:
+        from poc.vocab.concept_ancestor import build_ancestry
+        meta["ancestry"] = build_ancestry(ancestor_path, tmp_dir, ids, log)
+    meta["build_s"] = round(time.perf_counter() - t0, 2)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    old_dir = out_dir.rstrip("/\\") + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    log(f"index written to {out_dir} ({meta['build_s']}s)")
+    return meta
+
+
+def write_arrays(out_dir: str, files: Dict[str, tuple], arrays: Dict[str, array]):
+    """按 files 布局（{key: (文件名, 类型码, 字节数)}）把 array 写成原始二进制文件"""
+    for key, (filename, typecode, size) in files.items():
+        arr = arrays[key]
+        if arr.itemsize != size:
+            raise RuntimeError(f"array('{typecode}') is {arr.itemsize} bytes on this platform, expected {size}")
+        with open(os.path.join(out_dir, filename), "wb") as f:
+            arr.tofile(f)
+
+
+# =====================================================
+# 查询
+# =====================================================
+
+class MappedArrays:
+    """一组 mmap 只读映射的数组文件；每个数组以 self._<key> 的 memoryview 访问"""
+
+    def __init__(self, path: str, files: Dict[str, tuple]):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported concept index format: {self.meta.get('format')}")
+        if self.meta.get("byteorder") != sys.byteorder:
+            raise ValueError(f"Concept index was built on a {self.meta.get('byteorder')}-endian machine")
+        self.path = path
+        self._maps: List[mmap.mmap] = []
+        self._views: Dict[str, memoryview] = {
+            key: self._open(filename, typecode) for key, (filename, typecode, _) in files.items()
+        }
+        for key, view in self._views.items():
+            setattr(self, "_" + key, view)
+
+    def _open(self, filename: str, typecode: str) -> memoryview:
+        path = os.path.join(self.path, filename)
+        if os.path.getsize(path) == 0:
+            return memoryview(b"").cast(typecode)
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        return memoryview(mm).cast(typecode)
+
+    def close(self):
+        for view in self._views.values():
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self._maps.clear()
+
+
+class ConceptIndex(MappedArrays):
+    """只读概念索引（mmap）；所有查找都是内存映射数组上的二分与倒排表计数，线程安全"""
+
+    def __init__(self, path: str):
+        super().__init__(path, _FILES)
+        self._domain_names = [None] + self.meta["domains"]
+        self._vocab_names = [None] + self.meta["vocabularies"]
+        self._domain_codes = {d: i for i, d in enumerate(self._domain_names) if d}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    # -----------------------
+    # 概念属性
+    # -----------------------
+
+    def _position(self, concept_id: int) -> Optional[int]:
+        i = bisect.bisect_left(self._ids, concept_id)
+        return i if i < len(self._ids) and self._ids[i] == concept_id else None
+
+    def _name(self, i: int) -> str:
+        return bytes(self._names[self._name_off[i]:self._name_off[i + 1]]).decode("utf-8")
+
+    def _entry_str(self, entry: int) -> str:
+        return bytes(self._entry_text[self._entry_off[entry]:self._entry_off[entry + 1]]).decode("utf-8")
+
+    def _record(self, i: int) -> Dict[str, Any]:
+        return {
+            "concept_id": self._ids[i],
+            "concept_name": self._name(i),
+            "domain_id": self._domain_names[self._domain[i]],
+            "vocabulary_id": self._vocab_names[self._vocab[i]],
+            "standard_concept": chr(self._standard[i]) if self._standard[i] else None,
+        }
+
+    def get(self, concept_id: int) -> Optional[Dict[str, Any]]:
+        i = self._position(concept_id)
+        return None if i is None else self._record(i)
+
+    def _accepts(self, i: int, domain_code: Optional[int], standard_only: bool) -> bool:
+        if domain_code is not None and self._domain[i] != domain_code:
+            return False
+        return not standard_only or self._standard[i] == ord("S")
+
+    def _domain_code(self, domain: Optional[str]) -> Optional[int]:
+        # 索引中不存在的 domain：用 -1 使所有候选都不匹配
+        return None if domain is None else self._domain_codes.get(domain, -1)
+
+    def _match(self, i: int, match: str, score: float) -> Dict[str, Any]:
+        out = self._record(i)
+        out["match"] = match
+        out["score"] = round(score, 4)
+        return out
+
+    # -----------------------
+    # 查找
+    # -----------------------
+
+    def lookup_exact(self, term: str, domain: Optional[str] = None, standard_only: bool = False) -> List[Dict[str, Any]]:
+        """规范化后精确匹配概念名或同义词；概念名匹配排在同义词之前，标准概念优先"""
+        norm = normalize_term(term)
+        if not norm:
+            return []
+        h = _key_hash(norm)
+        domain_code = self._domain_code(domain)
+        found: Dict[int, int] = {}
+        j = bisect.bisect_left(self._key_hash, h)
+        while j < len(self._key_hash) and self._key_hash[j] == h:
+            entry = self._key_entry[j]
+            j += 1
+            i, kind = self._entry_concept[entry], self._entry_kind[entry]
+            if not self._accepts(i, domain_code, standard_only) or self._entry_str(entry) != norm:
+                continue    # 64 位哈希碰撞时文本不同
+            found[i] = min(kind, found.get(i, kind))
+        ranked = sorted(found.items(), key=lambda kv: (kv[1], self._standard[kv[0]] != ord("S"), kv[0]))
+        return [self._match(i, _KIND_LABELS[kind], 1.0) for i, kind in ranked]
+
+    def search_fuzzy(
+        self,
+        term: str,
+        domain: Optional[str] = None,
+        standard_only: bool = False,
+        limit: int = 5,
+        min_score: float = 0.5,
+    ) -> List[Dict[str, Any]]:
+        """
+        三元组模糊查找（拼写错误、词序差异、缺少修饰词），按 Dice 系数排序
+        候选只来自较稀有的三元组，结果是近似的：只与高频片段重合的词条可能找不到
+        """
+        norm = normalize_term(term)
+        grams = trigrams(norm) if norm else set()
+        if not grams:
+            return []
+        lists = []
+        for g in grams:
+            k = bisect.bisect_left(self._tri_key, g)
+            if k < len(self._tri_key) and self._tri_key[k] == g:
+                lists.append((self._tri_off[k + 1] - self._tri_off[k], self._tri_off[k]))
+        lists.sort()
+        counts: Counter = Counter()
+        read = 0
+        for n, start in lists:
+            if read and read + n > _FUZZY_POSTINGS_BUDGET:
+                break
+            counts.update(self._tri_post[start:start + n].tolist())
+            read += n
+
+        domain_code = self._domain_code(domain)
+        best: Dict[int, Any] = {}
+        for entry, _ in counts.most_common(_FUZZY_CANDIDATES):
+            i = self._entry_concept[entry]
+            if not self._accepts(i, domain_code, standard_only):
+                continue
+            entry_grams = trigrams(self._entry_str(entry))
+            score = 2 * len(grams & entry_grams) / (len(grams) + len(entry_grams))
+            if score >= min_score and score > best.get(i, (0.0,))[0]:
+                best[i] = (score, self._entry_kind[entry])
+        ranked = sorted(best.items(), key=lambda kv: (-kv[1][0], kv[1][1], kv[0]))[:limit]
+        return [self._match(i, "fuzzy", score) for i, (score, _) in ranked]
+
+    def lookup(
+        self,
+        term: str,
+        domain: Optional[str] = None,
+        standard_only: bool = False,
+        fuzzy: bool = True,
+        limit: int = 5,
+        min_score: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        """精确 / 同义词匹配优先，没有结果时回退模糊查找"""
+        matches = self.lookup_exact(term, domain, standard_only)
+        if matches or not fuzzy:
+            return matches[:limit]
+        min_score = settings.CONCEPT_FUZZY_MIN_SCORE if min_score is None else min_score
+        return self.search_fuzzy(term, domain, standard_only, limit, min_score)
+
+
+_INDEX: Optional[ConceptIndex] = None
+_INDEX_LOADED = False
+_INDEX_LOCK = threading.Lock()
+
+
+def get_concept_index() -> Optional[ConceptIndex]:
+    """进程内共享的概念索引；CONCEPT_INDEX_DIR 下没有索引时返回 None（只使用内置种子映射）"""
+    global _INDEX, _INDEX_LOADED
+    if not _INDEX_LOADED:
+        with _INDEX_LOCK:
+            if not _INDEX_LOADED:
+                path = settings.CONCEPT_INDEX_DIR
+                if path and os.path.exists(os.path.join(path, "meta.json")):
+                    _INDEX = ConceptIndex(path)
+                _INDEX_LOADED = True
+    return _INDEX
+
+
+@functools.lru_cache(maxsize=4096)
+def _resolve(name: str, domain: str) -> Optional[Dict[str, Any]]:
+    norm = normalize_term(name)
+    if domain == "Condition" and norm in CONDITION_CONCEPT_MAP:
+        return {"concept_id": CONDITION_CONCEPT_MAP[norm], "concept_name": name, "match": "seed", "score": 1.0}
+    index = get_concept_index()
+    if index is None:
+        return None
+    matches = index.lookup(name, domain=domain, standard_only=True, limit=1)
+    return matches[0] if matches else None
+
+
+def resolve_concept(name: str, domain: str = "Condition") -> Optional[Dict[str, Any]]:
+    """
+    名称 -> 标准概念：内置种子映射 → 索引精确 / 同义词 → 模糊（结果按名称缓存）
+    Returns:
+        {"concept_id", "concept_name", "match": seed / name / synonym / fuzzy, "score", ...}；找不到时为 None
+    """
+    if not isinstance(name, str) or not name.strip():
+        return None
+    match = _resolve(name, domain)
+    return dict(match) if match else None
+
+
+# =====================================================
+# CLI
+# =====================================================
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Build or query the OMOP concept index")
+    sub = ap.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="build the index from Athena vocabulary files")
+    b.add_argument("vocab_dir", help="directory containing CONCEPT.csv and CONCEPT_SYNONYM.csv")
+    b.add_argument("--out", default=None, help="index directory (default: CONCEPT_INDEX_DIR)")
+    b.add_argument("--domains", default=None, help="comma-separated domain_id filter, e.g. Condition,Drug,Gender")
+    q = sub.add_parser("lookup", help="look up a term")
+    q.add_argument("term")
+    q.add_argument("--domain", default=None)
+    q.add_argument("--standard-only", action="store_true")
+    q.add_argument("--limit", type=int, default=5)
+    args = ap.parse_args()
+
+    if args.command == "build":
+        meta = build_concept_index(args.vocab_dir, args.out, args.domains.split(",") if args.domains else None)
+        print(json.dumps(meta, ensure_ascii=False, indent=2))
+    else:
+        index = get_concept_index()
+        if index is None:
+            sys.exit(f"No concept index at {settings.CONCEPT_INDEX_DIR}; run the build command first")
+        t = time.perf_counter()
+        matches = index.lookup(args.term, domain=args.domain, standard_only=args.standard_only, limit=args.limit)
+        elapsed_us = (time.perf_counter() - t) * 1e6
+        print(json.dumps(matches, ensure_ascii=False, indent=2))
+        print(f"{elapsed_us:.0f} µs")